@@ -0,0 +1,149 @@
+"""
+    Fake pytubefix objects pointed at the local MediaServer.
+    They implement just the parts of YouTube / Stream / StreamQuery / Playlist
+    that YoutubeDownloader uses, so the real download paths run offline.
+    Register a FakeYouTube with `install()` and `YoutubeDownloader(fake.watch_url)`
+    picks it up through the process-wide metadata cache.
+"""
+
+from src.cache import metadata_cache
+
+
+class FakeStream:
+    """A stream served by the bench server."""
+
+    def __init__(self, url, itag, filesize, mime_type, resolution=None, abr=None, progressive=False):
+        self.url = url
+        self.itag = itag
+        self.filesize = filesize
+        self.filesize_approx = filesize
+        self.mime_type = mime_type
+        self.type, self.subtype = mime_type.split("/")
+        self.resolution = resolution
+        self.abr = abr
+        self.is_progressive = progressive
+        self.is_adaptive = not progressive
+        self.includes_audio_track = progressive or self.type == "audio"
+        self.includes_video_track = progressive or self.type == "video"
+
+    def __repr__(self):
+        return f"<FakeStream itag={self.itag} mime={self.mime_type} res={self.resolution} abr={self.abr}>"
+
+
+class FakeStreamQuery:
+    """The subset of pytubefix's StreamQuery used by YoutubeDownloader."""
+
+    def __init__(self, streams):
+        self.fmt_streams = list(streams)
+
+    def __iter__(self):
+        return iter(self.fmt_streams)
+
+    def __len__(self):
+        return len(self.fmt_streams)
+
+    def filter(self, progressive=None, adaptive=None, res=None, mime_type=None,
+               file_extension=None, only_audio=None, abr=None, **_):
+        result = self.fmt_streams
+        if progressive:
+            result = [s for s in result if s.is_progressive]
+        if adaptive:
+            result = [s for s in result if s.is_adaptive]
+        if res:
+            result = [s for s in result if s.resolution == res]
+        if mime_type:
+            result = [s for s in result if s.mime_type == mime_type]
+        if file_extension:
+            result = [s for s in result if s.subtype == file_extension]
+        if only_audio:
+            result = [s for s in result if s.type == "audio" and not s.is_progressive]
+        if abr:
+            result = [s for s in result if s.abr == abr]
+        return FakeStreamQuery(result)
+
+    def order_by(self, attribute):
+        return FakeStreamQuery(sorted(self.fmt_streams, key=lambda s: int(str(getattr(s, attribute) or 0).rstrip("kbps") or 0)))
+
+    def desc(self):
+        return FakeStreamQuery(reversed(self.fmt_streams))
+
+    def asc(self):
+        return self
+
+    def first(self):
+        return self.fmt_streams[0] if self.fmt_streams else None
+
+    def get_by_itag(self, itag):
+        return next((s for s in self.fmt_streams if s.itag == int(itag)), None)
+
+    def get_highest_resolution(self):
+        progressive = [s for s in self.fmt_streams if s.is_progressive]
+        return max(progressive, key=lambda s: int(s.resolution.rstrip("p")), default=None)
+
+    def get_audio_only(self):
+        audio = [s for s in self.fmt_streams if s.type == "audio" and not s.is_progressive]
+        return max(audio, key=lambda s: int(s.abr.rstrip("kbps")), default=None)
+
+
+class FakeYouTube:
+    """A video with a fixed catalog of fake streams."""
+
+    def __init__(self, video_id, streams, title="Bench video", author="bench", length=60, views=0):
+        assert len(video_id) == 11, "YouTube video ids are 11 characters"
+        self.video_id = video_id
+        self.title = title
+        self.author = author
+        self.length = length
+        self.views = views
+        self.watch_url = f"https://www.youtube.com/watch?v={video_id}"
+        self.thumbnail_url = ""
+        self._vid_info = None
+        self.streams = FakeStreamQuery(streams)
+
+    def register_on_progress_callback(self, func):
+        pass
+
+
+class FakePlaylist:
+    """A playlist of FakeYouTube objects with pytubefix's generator interface."""
+
+    def __init__(self, videos, title="Bench playlist", playlist_id="PLbench"):
+        self.videos = list(videos)
+        self.title = title
+        self.playlist_id = playlist_id
+
+    def url_generator(self):
+        for yt in self.videos:
+            yield yt.watch_url
+
+    @property
+    def video_urls(self):
+        return list(self.url_generator())
+
+
+def install(*videos):
+    """Makes fake videos resolvable by URL through the shared metadata cache."""
+    for yt in videos:
+        metadata_cache.put(yt)
+    return videos
+
+
+def make_video(server, video_id, progressive=None, video=None, audio=None, **kwargs):
+    """
+    Registers media on `server` and builds a FakeYouTube around it.
+    :param progressive: Bytes of a progressive 360p MP4, or None
+    :param video: Bytes of an adaptive video MP4 track (served as 720p), or None
+    :param audio: Bytes of an adaptive audio M4A track (served as 128kbps), or None
+    :rtype: FakeYouTube
+    """
+    streams = []
+    if progressive is not None:
+        url = server.add_bytes(f"{video_id}_18", progressive)
+        streams.append(FakeStream(url, 18, len(progressive), "video/mp4", resolution="360p", progressive=True))
+    if video is not None:
+        url = server.add_bytes(f"{video_id}_136", video)
+        streams.append(FakeStream(url, 136, len(video), "video/mp4", resolution="720p"))
+    if audio is not None:
+        url = server.add_bytes(f"{video_id}_140", audio)
+        streams.append(FakeStream(url, 140, len(audio), "audio/mp4", abr="128kbps"))
+    return FakeYouTube(video_id, streams, **kwargs)
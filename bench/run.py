@@ -0,0 +1,225 @@
+"""
+    Offline benchmark for Download, DownloadAudio and _download_adaptive.
+
+    Usage:
+        python -m bench.run --size-mb 64 --connections 1 4 8 --latency-ms 20 --throttle-kbps 4000
+        python -m bench.run --save before.json
+        python -m bench.run --save after.json --compare before.json
+        python -m bench.run --scenarios clip adaptive --adaptive-seconds 600 --clip-seconds 30
+        python -m bench.run --scenarios adaptive --merger ffmpeg remux
+
+    Every scenario runs in a fresh process against a local MediaServer with
+    fake pytubefix objects, so peak RSS is per scenario and no network is used.
+    Recorded per run: wall time, throughput, time to first byte (first chunk
+    handed to the output), merge tail (time between the last transferred byte
+    and the merged result, adaptive only, per --merger), peak RSS, request count and
+    bytes sent by the server (for clips, compare with the adaptive scenario).
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from src.merge import MERGERS
+
+SCENARIOS = ("progressive", "audio", "adaptive", "clip")
+FIXTURE_DIR = os.path.join(tempfile.gettempdir(), "ytd_bench")
+
+
+class _Recorder:
+    """Progress-bar stand-in that timestamps the first and last progress update."""
+
+    def __init__(self):
+        self.first = None
+        self.last = None
+
+    def progress(self, percent, text=None):
+        # Completion messages ("Download complete!", "Merge complete!") are not transferred chunks
+        if not (text or "").startswith("Downloading"):
+            return
+        now = time.monotonic()
+        if self.first is None:
+            self.first = now
+        self.last = now
+
+
+def _peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS and kilobytes on Linux
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def run_scenario(params):
+    """
+    Runs one benchmark in the current process. Called in a fresh worker process.
+    :param params: Scenario parameters (see `main`)
+    :return: Measured metrics
+    :rtype: dict
+    """
+    from bench.server import MediaServer, synthetic_bytes
+    from bench.fakes import make_video, install
+    from src.main import YoutubeDownloader
+
+    scenario = params["scenario"]
+    adaptive = scenario in ("adaptive", "clip")
+    with MediaServer(latency=params["latency_ms"] / 1000,
+                     throttle_bps=params["throttle_kbps"] * 1000 if params["throttle_kbps"] else None) as server:
+        size = params["size_mb"] * 1024 * 1024
+        if scenario == "progressive":
+            yt = make_video(server, "benchprog01", progressive=synthetic_bytes(size, seed=1))
+        elif scenario == "audio":
+            yt = make_video(server, "benchaudio1", audio=synthetic_bytes(size, seed=2))
+        else:
+            with open(params["video_track"], "rb") as f:
+                video = f.read()
+            with open(params["audio_track"], "rb") as f:
+                audio = f.read()
+            yt = make_video(server, "benchadapt1", video=video, audio=audio, length=params["adaptive_seconds"])
+        install(yt)
+
+        downloader = YoutubeDownloader(
+            yt.watch_url,
+            connections=params["connections"],
+            chunk_size=params["chunk_kb"] * 1024,
+            use_cache=False,
+            resume_min_size=None if not params["resume"] else 0,
+        )
+        recorder = _Recorder()
+        started = time.monotonic()
+        if scenario == "progressive":
+            buffer = downloader.Download("360p", st_progress_bar=recorder)
+        elif scenario == "audio":
+            buffer = downloader.DownloadAudio("128kbps", st_progress_bar=recorder)
+        elif scenario == "clip":
+            # From the middle of the tracks
+            start = max(0, (params["adaptive_seconds"] - params["clip_seconds"]) / 2)
+            buffer = downloader.DownloadClip("720p", start, start + params["clip_seconds"], st_progress_bar=recorder)
+        else:
+            buffer = downloader.Download("720p", st_progress_bar=recorder, merger=params["merger"])
+        finished = time.monotonic()
+
+        if buffer is None:
+            raise RuntimeError(f"{scenario} download returned no buffer")
+        nbytes = buffer.size
+        buffer.close()
+        seconds = finished - started
+        return {
+            **params,
+            "bytes": nbytes,
+            "seconds": round(seconds, 4),
+            "throughput_mbps": round(nbytes * 8 / seconds / 1e6, 2) if seconds else None,
+            "ttfb_seconds": round(recorder.first - started, 4) if recorder.first else None,
+            "merge_tail_seconds": round(finished - recorder.last, 4) if adaptive and recorder.last else None,
+            "peak_rss_kb": _peak_rss_kb(),
+            "requests": server.requests,
+            "bytes_sent": server.bytes_sent,
+            "tcp_connections": server.connections,
+        }
+
+
+def _key(result):
+    key = f"{result['scenario']}/c{result['connections']}/k{result['chunk_kb']}"
+    merger = result.get("merger")
+    return key if merger in (None, "ffmpeg") else f"{key}/{merger}"
+
+
+def compare(results, baseline):
+    """Prints per-scenario deltas against a previous run's saved results."""
+    previous = {_key(r): r for r in baseline.get("results", [])}
+    print("\nComparison against baseline:")
+    print(f"{'scenario':<28}{'Mbps':>10}{'Δ%':>9}{'peak RSS MB':>14}{'Δ%':>9}")
+    for result in results:
+        old = previous.get(_key(result))
+        if old is None:
+            print(f"{_key(result):<28}{'(no baseline)':>10}")
+            continue
+
+        def delta(new, before):
+            if not new or not before:
+                return "n/a"
+            return f"{(new - before) / before * 100:+.1f}"
+        rss = (result["peak_rss_kb"] or 0) / 1024
+        print(f"{_key(result):<28}{result['throughput_mbps']:>10}{delta(result['throughput_mbps'], old['throughput_mbps']):>9}"
+              f"{rss:>14.1f}{delta(result['peak_rss_kb'], old['peak_rss_kb']):>9}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m bench.run", description="Offline download benchmarks.")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--size-mb", type=int, default=32, help="Size of synthetic progressive/audio media")
+    parser.add_argument("--adaptive-seconds", type=int, default=60, help="Duration of the generated adaptive tracks")
+    parser.add_argument("--adaptive-height", type=int, default=720, help="Height of the generated adaptive video track")
+    parser.add_argument("--clip-seconds", type=int, default=10, help="Length of the clip cut from the adaptive tracks")
+    parser.add_argument("--connections", type=int, nargs="+", default=[1, 4], help="Connection counts to test")
+    parser.add_argument("--chunk-kb", type=int, default=1024, help="Range size in KB")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Injected latency per request")
+    parser.add_argument("--throttle-kbps", type=float, default=0, help="Per-connection throttle in kB/s, 0 for none")
+    parser.add_argument("--merger", nargs="+", choices=MERGERS, default=["ffmpeg"],
+                        help="Mergers to test in the adaptive scenario")
+    parser.add_argument("--resume", action="store_true", help="Force the resumable (partial file) path")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per configuration")
+    parser.add_argument("--save", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Compare against a JSON file written by --save")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    base = {
+        "size_mb": args.size_mb, "chunk_kb": args.chunk_kb, "latency_ms": args.latency_ms,
+        "throttle_kbps": args.throttle_kbps, "resume": args.resume,
+        "adaptive_seconds": args.adaptive_seconds, "clip_seconds": args.clip_seconds,
+    }
+
+    scenarios = list(args.scenarios)
+    if "adaptive" in scenarios or "clip" in scenarios:
+        if shutil.which("ffmpeg") is None:
+            print("ffmpeg not found, skipping the adaptive and clip scenarios.")
+            scenarios = [s for s in scenarios if s not in ("adaptive", "clip")]
+        else:
+            from bench.server import make_test_tracks
+            base["video_track"], base["audio_track"] = make_test_tracks(
+                FIXTURE_DIR, seconds=args.adaptive_seconds, height=args.adaptive_height
+            )
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for scenario in scenarios:
+        for merger in (args.merger if scenario == "adaptive" else [None]):
+            for connections in args.connections:
+                for _ in range(args.repeat):
+                    params = {**base, "scenario": scenario, "connections": connections, "merger": merger}
+                    # A fresh process per run keeps peak RSS and caches independent
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                        result = pool.submit(run_scenario, params).result()
+                    results.append(result)
+                    print(f"{_key(result):<28} {result['throughput_mbps']:>8} Mbps  "
+                          f"ttfb={result['ttfb_seconds']}s  merge_tail={result['merge_tail_seconds']}s  "
+                          f"rss={(result['peak_rss_kb'] or 0) // 1024}MB  requests={result['requests']}  "
+                          f"sent={result['bytes_sent'] // 1024}KB  "
+                          f"tcp_connections={result['tcp_connections']}")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"created": time.time(), "results": results}, f, indent=2)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(results, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
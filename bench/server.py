@@ -0,0 +1,192 @@
+"""
+    Local stand-in for YouTube's media servers.
+    Serves registered byte blobs or files over HTTP with YouTube-style
+    `range=start-end` query parameters as well as standard Range headers,
+    and can inject per-request latency, per-connection throttling and failures.
+"""
+
+import os
+import random
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+WRITE_BLOCK_SIZE = 64 * 1024
+
+
+def synthetic_bytes(size : int, seed=0):
+    """
+    Deterministic pseudo-random bytes, cheap to generate for large sizes.
+    :rtype: bytes
+    """
+    block = random.Random(seed).randbytes(min(size, 1024 * 1024) or 1)
+    repeats, rest = divmod(size, len(block))
+    return block * repeats + block[:rest]
+
+
+class MediaServer:
+    """
+    A threaded HTTP server holding named media blobs.
+    `url(name)` returns a URL that already has a query string, like a signed
+    YouTube stream URL, so pytubefix-style `&range=` suffixes work.
+    """
+
+    def __init__(self, latency=0.0, throttle_bps=None, fail_rate=0.0, fail_status=503, retry_after=None,
+                 host="127.0.0.1", port=0):
+        """
+        :param latency: Seconds to wait before answering each request
+        :param throttle_bps: Maximum bytes per second per connection, None for unlimited
+        :param fail_rate: Probability (0-1) that a request fails with `fail_status`
+        :param fail_status: HTTP status of failed requests, e.g. 503 or 429
+        :param retry_after: Retry-After header (seconds) sent with failed requests, None for none
+        """
+        self.latency = latency
+        self.throttle_bps = throttle_bps
+        self.fail_rate = fail_rate
+        self.fail_status = fail_status
+        self.retry_after = retry_after
+        self.media = {}
+        self.requests = 0
+        self.connections = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    def add_bytes(self, name : str, data : bytes):
+        self.media[name] = data
+        return self.url(name)
+
+    def add_file(self, name : str, path : str):
+        with open(path, "rb") as f:
+            return self.add_bytes(name, f.read())
+
+    def url(self, name : str):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/media/{name}?source=bench"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True, name="bench-server")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.connections += 1
+
+            def do_HEAD(self):
+                self._serve(body=False)
+
+            def do_GET(self):
+                self._serve(body=True)
+
+            def _serve(self, body):
+                with server._lock:
+                    server.requests += 1
+                if server.latency:
+                    time.sleep(server.latency)
+
+                parsed = urlparse(self.path)
+                name = parsed.path.rsplit("/", 1)[-1]
+                data = server.media.get(name)
+                if data is None:
+                    self.send_error(404)
+                    return
+                if server.fail_rate and random.random() < server.fail_rate:
+                    self.send_response(server.fail_status)
+                    if server.retry_after is not None:
+                        self.send_header("Retry-After", str(server.retry_after))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                start, end, partial = 0, len(data) - 1, False
+                query_range = parse_qs(parsed.query).get("range")
+                header_range = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+                if query_range:
+                    start, end = (int(x) for x in query_range[0].split("-"))
+                elif header_range:
+                    start = int(header_range.group(1))
+                    end = int(header_range.group(2)) if header_range.group(2) else len(data) - 1
+                    partial = True
+                end = min(end, len(data) - 1)
+                if start > end:
+                    self.send_error(416)
+                    return
+
+                payload = memoryview(data)[start:end + 1]
+                self.send_response(206 if partial else 200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(payload)))
+                self.send_header("Accept-Ranges", "bytes")
+                if partial:
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+                self.end_headers()
+                if body:
+                    self._write_throttled(payload)
+
+            def _write_throttled(self, payload):
+                started = time.monotonic()
+                sent = 0
+                for offset in range(0, len(payload), WRITE_BLOCK_SIZE):
+                    block = payload[offset:offset + WRITE_BLOCK_SIZE]
+                    try:
+                        self.wfile.write(block)
+                    except (BrokenPipeError, ConnectionResetError):
+                        return
+                    sent += len(block)
+                    if server.throttle_bps:
+                        ahead = sent / server.throttle_bps - (time.monotonic() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+                with server._lock:
+                    server.bytes_sent += sent
+
+        return Handler
+
+
+def make_test_tracks(directory : str, seconds=30, height=360):
+    """
+    Generates a small fragmented MP4 video track and an M4A audio track with FFmpeg,
+    laid out like YouTube's adaptive (DASH) streams. Files are reused when present.
+    :return: (video_path, audio_path)
+    :rtype: tuple[str, str]
+    """
+    import subprocess
+    os.makedirs(directory, exist_ok=True)
+    video_path = os.path.join(directory, f"video_{seconds}s_{height}p_dash.mp4")
+    audio_path = os.path.join(directory, f"audio_{seconds}s_dash.m4a")
+    # Like YouTube's: ftyp, moov, one segment index (sidx), then moof/mdat fragments
+    frag = ["-movflags", "dash+global_sidx"]
+    if not os.path.exists(video_path):
+        subprocess.run(["ffmpeg", "-y", "-loglevel", "error",
+                        "-f", "lavfi", "-i", f"testsrc=duration={seconds}:size={height * 16 // 9}x{height}:rate=25",
+                        "-c:v", "mpeg4", "-q:v", "5", "-g", "50", *frag, video_path], check=True)
+    if not os.path.exists(audio_path):
+        subprocess.run(["ffmpeg", "-y", "-loglevel", "error",
+                        "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+                        "-c:a", "aac", "-b:a", "128k", *frag, "-frag_duration", "10000000", audio_path], check=True)
+    return video_path, audio_path
@@ -1,36 +1,52 @@
 from pytubefix import YouTube
-from urllib.error import URLError
-import re, time
+import re
+import time
+from src.cache import metadata_cache, video_id_from_url
+from src.metrics import phase
 # DO NOT import streamlit here. Keep utils separate from the UI.
 
 # This is the correct way to patch the default_range_size
 from pytubefix import request
 request.default_range_size = 1048576  # 1MB chunk size
 
+# Watch pages, InnerTube and playlist requests reuse pooled keep-alive connections,
+# and are retried with backoff behind the shared circuit breaker
+from src import transport
+transport.install()
+
 def safe_filename(name: str) -> str:
     """حذف کاراکترهای غیرمجاز از اسم فایل برای ویندوز"""
     return re.sub(r'[<>:"/\\|?*]', '_', name)
 
-def safe_youtube(url, retries=3, delay=3):
+def safe_youtube(url, use_cache=True):
     """
-    Tries to get a YouTube object, retrying on URLError.
-    Raises an exception if it fails after all retries.
+    Gets a YouTube object.
+    Objects are shared through the process-wide metadata cache, so a video
+    that was already resolved (by any session) is not fetched again.
+    On a miss the player response is loaded right away (pytubefix would only
+    fetch it when metadata is first read), so the "resolve" phase times the
+    real requests; they are retried with backoff by src.resilience (see `transport.install`).
+    :raises Exception: Whatever pytubefix raises when the video cannot be loaded
     """
-    last_exception = None
-    for i in range(retries):
-        try:
-            return YouTube(
-                url,
-                on_progress_callback=None,
-                on_complete_callback=None
-            )
-        except URLError as e:
-            print(f"Connection error: {e}, retrying {i+1}/{retries} ...")
-            last_exception = e
-            time.sleep(delay)
-            
-    # If loop finishes without returning, raise the last error
-    raise Exception(f"❌ Failed to connect after {retries} retries. Error: {last_exception}")
+    with phase("resolve") as labels:
+        video_id = video_id_from_url(url)
+        if use_cache and video_id:
+            cached = metadata_cache.get(video_id)
+            if cached is not None:
+                labels["cache"] = "hit"
+                return cached
+        labels["cache"] = "miss"
+
+        requested_at = time.time()
+        yt = YouTube(
+            url,
+            on_progress_callback=None,
+            on_complete_callback=None
+        )
+        _ = yt.vid_info  # force the metadata fetch inside the resolve phase; pytubefix loads it lazily
+        if use_cache:
+            metadata_cache.put(yt, created_at=requested_at)
+        return yt
 
 def is_playlist_url(url: str) -> bool:
     """Quick check to see if the provided URL is a YouTube playlist URL."""
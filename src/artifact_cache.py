@@ -0,0 +1,208 @@
+"""
+    Content-addressable on-disk cache of finished downloads.
+    Artifacts are keyed by video_id, itag(s) and output format, so both single
+    progressive streams and merged adaptive outputs can be served from disk.
+    Writes are atomic (temp file + os.replace) and the cache is kept under a
+    byte budget by evicting the least recently used files.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from src.buffers import SpooledBuffer
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "ytd_artifacts")
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024 * 1024  # 5GB
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def artifact_key(video_id : str, itags, fmt : str):
+    """
+    Builds the cache key for an artifact.
+    :param video_id: The YouTube video id
+    :param itags: The itag, or the itags of all merged streams (order matters)
+    :param fmt: The output format, e.g. "mp4" or "m4a"
+    :rtype: str
+    """
+    if isinstance(itags, (int, str)):
+        itags = [itags]
+    raw = f"{video_id}:{'+'.join(str(i) for i in itags)}:{fmt}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ArtifactCache:
+    """LRU-by-access-time file cache with a total byte budget."""
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param directory: Where cached files are stored
+        :param max_bytes: Total size budget; 0 disables the cache
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path(self, key : str):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get_path(self, video_id, itags, fmt):
+        """
+        Returns the path of a cached artifact and marks it as recently used, or None.
+        :rtype: str | None
+        """
+        if not self.enabled:
+            return None
+        path = self._path(artifact_key(video_id, itags, fmt))
+        try:
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def open(self, video_id, itags, fmt):
+        """
+        Opens a cached artifact as a read-only buffer that does not own the file.
+        :rtype: SpooledBuffer | None
+        """
+        path = self.get_path(video_id, itags, fmt)
+        if path is None:
+            return None
+        try:
+            return SpooledBuffer.from_file(path, owned=False)
+        except OSError:
+            # Evicted between the lookup and the open
+            return None
+
+    def _commit(self, key, write):
+        """Runs `write(fileobj)` into a temp file next to the target, then renames it into place."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        self.evict(keep=path)
+        return path
+
+    def put_buffer(self, video_id, itags, fmt, buffer):
+        """
+        Stores a finished buffer. The buffer's position is left unchanged.
+        :return: The path of the cached file, or None if caching is disabled or failed
+        """
+        if not self.enabled:
+            return None
+        try:
+            return self._commit(artifact_key(video_id, itags, fmt), lambda f: f.write(buffer.getbuffer()))
+        except OSError as e:
+            logging.warning(f"Failed to cache artifact for {video_id}: {e}")
+            return None
+
+    def put_file(self, video_id, itags, fmt, src_path : str, move=False):
+        """
+        Stores a finished file, moving it into the cache when `move` is True.
+        :return: The path of the cached file, or None if caching is disabled or failed
+        """
+        if not self.enabled:
+            return None
+        key = artifact_key(video_id, itags, fmt)
+        try:
+            if move:
+                path = self._path(key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                try:
+                    # Atomic when src and cache share a filesystem
+                    os.replace(src_path, path)
+                    self.evict(keep=path)
+                    return path
+                except OSError:
+                    pass
+
+            def _copy(f):
+                with open(src_path, "rb") as src:
+                    shutil.copyfileobj(src, f, COPY_CHUNK_SIZE)
+            path = self._commit(key, _copy)
+            if move:
+                os.remove(src_path)
+            return path
+        except OSError as e:
+            logging.warning(f"Failed to cache artifact for {video_id}: {e}")
+            return None
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith(".tmp_"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used artifacts until the cache fits its byte budget.
+        :param keep: A path that must survive, e.g. the artifact that was just written
+        """
+        with self._lock:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    # Readers that already opened the file keep their handle on POSIX
+                    os.remove(path)
+                    total -= size
+                    self.evictions += 1
+                except OSError as e:
+                    logging.warning(f"Failed to evict cached artifact {path}: {e}")
+
+    def stats(self):
+        """
+        Hit/miss counters and current disk usage.
+        :rtype: dict
+        """
+        entries = self._entries()
+        with self._lock:
+            return {
+                "files": len(entries),
+                "bytes": sum(size for _, size, _ in entries),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+artifact_cache = ArtifactCache(
+    directory=os.environ.get("YTD_ARTIFACT_CACHE_DIR", DEFAULT_CACHE_DIR),
+    max_bytes=int(os.environ.get("YTD_ARTIFACT_CACHE_BYTES", DEFAULT_MAX_BYTES)),
+)
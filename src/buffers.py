@@ -0,0 +1,282 @@
+"""
+    Result buffers for finished downloads.
+    Small results stay in memory; anything larger than the spool threshold
+    is moved to a temp file and read back through mmap.
+"""
+
+import io
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+import weakref
+
+from src.metrics import BUFFERED_BYTES
+
+DEFAULT_SPOOL_THRESHOLD = 32 * 1024 * 1024  # 32MB
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Open buffers, for the buffered-bytes gauge
+_live_buffers = weakref.WeakSet()
+_live_buffers_lock = threading.Lock()
+
+
+class SpooledBuffer(io.RawIOBase):
+    """
+    A readable/writable binary buffer that spills to disk above `threshold` bytes.
+    Once spilled, `getbuffer()` returns a zero-copy memoryview over an mmap of the file.
+    `close()` releases the memory or removes the temp file, whichever applies.
+    """
+
+    def __init__(self, threshold=DEFAULT_SPOOL_THRESHOLD, dir=None):
+        """
+        :param threshold: Size in bytes above which the buffer moves to a temp file
+        :param dir: Directory for the temp file, defaults to the system temp dir
+        """
+        super().__init__()
+        self.threshold = threshold
+        self.dir = dir
+        self._mem = io.BytesIO()
+        self._file = None
+        self._path = None
+        self._owned = True
+        self._mmap = None
+        self._lock = threading.RLock()
+        with _live_buffers_lock:
+            _live_buffers.add(self)
+
+    @classmethod
+    def from_file(cls, path : str, owned=True):
+        """
+        Wraps an existing file as a disk-backed buffer without copying it.
+        :param path: Path of the file to wrap
+        :param owned: If True the file is deleted when the buffer is closed
+        :rtype: SpooledBuffer
+        """
+        buffer = cls()
+        buffer._mem = None
+        buffer._file = open(path, "r+b" if owned else "rb")
+        buffer._path = path
+        buffer._owned = owned
+        return buffer
+
+    # --- state ---
+
+    @property
+    def on_disk(self):
+        """True once the buffer has spilled to (or was created from) a file."""
+        return self._file is not None
+
+    @property
+    def path(self):
+        """Path of the backing file, or None while the buffer is in memory."""
+        return self._path
+
+    @property
+    def owned(self):
+        """False when the backing file belongs to someone else (e.g. the artifact cache)."""
+        return self._owned
+
+    @property
+    def size(self):
+        """Current size of the buffer in bytes."""
+        with self._lock:
+            if self.closed:
+                return 0
+            if self._file is not None:
+                self._file.flush()
+                return os.fstat(self._file.fileno()).st_size
+            return self._mem.getbuffer().nbytes
+
+    def _active(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed buffer.")
+        return self._file if self._file is not None else self._mem
+
+    def rollover(self):
+        """Moves an in-memory buffer to a temp file, keeping the current position."""
+        with self._lock:
+            if self._file is not None or self.closed:
+                return
+            pos = self._mem.tell()
+            fd, path = tempfile.mkstemp(prefix="ytbuf_", suffix=".bin", dir=self.dir)
+            f = os.fdopen(fd, "w+b")
+            f.write(self._mem.getbuffer())
+            f.seek(pos)
+            self._file, self._path, self._mem = f, path, None
+
+    # --- io.RawIOBase interface ---
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def write(self, b):
+        with self._lock:
+            if self._file is None and self._mem.tell() + len(b) > self.threshold:
+                self.rollover()
+            self._drop_mmap()
+            return self._active().write(b)
+
+    def read(self, size=-1):
+        with self._lock:
+            return self._active().read(size)
+
+    def readall(self):
+        return self.read(-1)
+
+    def readinto(self, b):
+        with self._lock:
+            return self._active().readinto(b)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        with self._lock:
+            return self._active().seek(offset, whence)
+
+    def tell(self):
+        with self._lock:
+            return self._active().tell()
+
+    def flush(self):
+        if not self.closed and self._file is not None:
+            self._file.flush()
+
+    # --- zero-copy access ---
+
+    def getbuffer(self):
+        """
+        Returns a read-only view of the whole buffer without copying it.
+        For disk-backed buffers the view is backed by an mmap of the file.
+        :rtype: memoryview
+        """
+        with self._lock:
+            self._active()
+            if self._file is None:
+                return self._mem.getbuffer().toreadonly()
+            if self._mmap is None:
+                self._file.flush()
+                if os.fstat(self._file.fileno()).st_size == 0:
+                    return memoryview(b"")
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(self._mmap)
+
+    def getvalue(self):
+        """
+        Returns the whole buffer as bytes, like `io.BytesIO.getvalue`.
+        This is a full copy in memory, also for a disk-backed buffer; `getbuffer()` is the zero-copy view.
+        :rtype: bytes
+        """
+        with self._lock:
+            if self._file is None:
+                return self._active().getvalue()
+            return bytes(self.getbuffer())
+
+    def _drop_mmap(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # A caller still holds a view; the map is freed with it
+                pass
+            self._mmap = None
+
+    def close(self):
+        """Releases the in-memory data or closes and removes the temp file."""
+        with self._lock:
+            if self.closed:
+                return
+            self._drop_mmap()
+            if self._file is not None:
+                self._file.close()
+                if self._owned and self._path:
+                    try:
+                        os.remove(self._path)
+                    except OSError as e:
+                        logging.warning(f"Failed to remove spooled buffer {self._path}: {e}")
+            self._mem = None
+            self._file = None
+            super().close()
+
+
+def buffered_bytes(on_disk : bool):
+    """Total size of the open buffers that are (or are not) backed by a file."""
+    with _live_buffers_lock:
+        buffers = list(_live_buffers)
+    return sum(buffer.size for buffer in buffers if buffer.on_disk == on_disk)
+
+
+BUFFERED_BYTES.set_function(lambda: buffered_bytes(False), storage="memory")
+BUFFERED_BYTES.set_function(lambda: buffered_bytes(True), storage="disk")
+
+
+def share_buffer(buffer):
+    """
+    Returns an independent buffer with the same content, for another reader.
+    A file the buffer does not own is simply reopened; anything else is copied.
+    :rtype: SpooledBuffer
+    """
+    with buffer._lock:
+        if buffer.on_disk and not buffer.owned:
+            return SpooledBuffer.from_file(buffer.path, owned=False)
+        copy = SpooledBuffer(threshold=buffer.threshold)
+        copy.write(buffer.getbuffer())
+        copy.seek(0)
+        return copy
+
+
+def save_buffer(buffer, path : str):
+    """
+    Atomically puts the buffer's content at `path`, copying only when nothing else works.
+    A file the buffer owns is moved there, and the buffer keeps reading it without
+    owning it; a file it does not own (an artifact cache entry) is hard-linked.
+    In-memory buffers, and files on another file system, are copied.
+    :param buffer: A SpooledBuffer
+    :param path: Where the content goes; an existing file is replaced
+    """
+    tmp_path = os.path.join(os.path.dirname(path) or ".", f".tmp_{uuid.uuid4().hex}")
+    with buffer._lock:
+        if buffer.on_disk:
+            buffer.flush()
+            try:
+                if buffer.owned:
+                    os.replace(buffer.path, path)
+                    buffer._path, buffer._owned = path, False
+                    return
+                os.link(buffer.path, tmp_path)
+                os.replace(tmp_path, path)
+                return
+            except OSError as e:
+                _remove_quietly(tmp_path)
+                logging.debug(f"Copying buffer to {path} instead of moving or linking it: {e}")
+        try:
+            with open(tmp_path, "wb") as f:
+                buffer.seek(0)
+                shutil.copyfileobj(buffer, f, COPY_CHUNK_SIZE)
+            os.replace(tmp_path, path)
+        except BaseException:
+            _remove_quietly(tmp_path)
+            raise
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def release_buffer(buffer):
+    """Closes a result buffer if it is one; safe to call with None."""
+    if buffer is not None and hasattr(buffer, "close"):
+        try:
+            buffer.close()
+        except Exception as e:
+            logging.warning(f"Failed to release buffer: {e}")
@@ -0,0 +1,139 @@
+"""
+    Bulk playlist download into a single ZIP file.
+    Items run on a bounded worker pool; each finished item is written into the
+    ZIP on disk straight away and its buffer released, so memory stays bounded
+    by the number of workers rather than the size of the playlist.
+    A `stop` event ends the whole download early: items that have not started
+    are skipped and running ones stop at their next progress update.
+"""
+
+import logging
+import shutil
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from src.Safe import safe_filename
+from src.buffers import release_buffer
+from src.main import YoutubeDownloader
+from src.resilience import RetryPolicy
+from src.transcode import audio_format as audio_format_spec, DEFAULT_BITRATE
+
+DEFAULT_WORKERS = 3
+DEFAULT_ITEM_RETRIES = 2
+RETRY_DELAY = 2
+# Requests are already retried individually; a whole item is retried after a longer, jittered pause
+ITEM_RETRY_POLICY = RetryPolicy(max_retries=DEFAULT_ITEM_RETRIES, base_delay=RETRY_DELAY, max_delay=60)
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadStopped(Exception):
+    """Raised inside an item's download once the playlist download was stopped."""
+
+
+class _StopCheck:
+    """Progress-bar stand-in that interrupts an item's download once `stop` is set."""
+
+    def __init__(self, stop):
+        self._stop = stop
+
+    def progress(self, percent, text=None):
+        # A finished item is returned as usual, so its buffer is released with the others
+        if percent < 100 and self._stop.is_set():
+            raise DownloadStopped()
+
+
+def _download_item(index, url, quality, audio, retries, audio_format="m4a", bitrate=DEFAULT_BITRATE, session=None,
+                   stop=None):
+    """
+    Downloads one playlist entry, retrying the whole item on failure.
+    :param stop: Optional threading.Event; once set, the item gives up without retrying
+    :return: A result dict; `buffer` is set on success, `error` on failure
+    :rtype: dict
+    """
+    result = {"index": index, "url": url, "title": None, "ok": False, "error": None,
+              "attempts": 0, "bytes": 0, "seconds": 0.0, "buffer": None}
+    progress = _StopCheck(stop) if stop is not None else None
+    started = time.monotonic()
+    for attempt in range(1, retries + 2):
+        if stop is not None and stop.is_set():
+            result["error"] = "Stopped"
+            break
+        result["attempts"] = attempt
+        try:
+            downloader = YoutubeDownloader(url, session=session)
+            if not downloader.yt:
+                raise RuntimeError("Could not load video")
+            result["title"] = downloader.yt.title
+            if audio:
+                buffer = downloader.DownloadAudio(quality=quality, st_progress_bar=progress,
+                                                  audio_format=audio_format, bitrate=bitrate)
+            else:
+                buffer = downloader.Download(quality=quality, st_progress_bar=progress)
+            if buffer is None:
+                raise RuntimeError(f"No stream available for {quality}")
+            result.update(ok=True, error=None, buffer=buffer, bytes=buffer.size)
+            break
+        except Exception as e:
+            if stop is not None and stop.is_set():
+                result["error"] = "Stopped"
+                break
+            logging.warning("Playlist item %s failed (attempt %s): %s", index, attempt, e)
+            result["error"] = str(e)
+            if attempt <= retries:
+                time.sleep(ITEM_RETRY_POLICY.delay(attempt - 1))
+    result["seconds"] = round(time.monotonic() - started, 3)
+    return result
+
+
+def _write_member(zf, arcname, buffer):
+    """Copies a finished buffer into the ZIP in chunks, without loading it whole."""
+    buffer.seek(0)
+    with zf.open(arcname, "w", force_zip64=True) as member:
+        shutil.copyfileobj(buffer, member, COPY_CHUNK_SIZE)
+
+
+def download_playlist_zip(urls, zip_path : str, quality, audio=False, workers=DEFAULT_WORKERS,
+                          retries=DEFAULT_ITEM_RETRIES, on_item_done=None, audio_format="m4a", bitrate=DEFAULT_BITRATE,
+                          session=None, stop=None):
+    """
+    Downloads every URL into one ZIP file, writing each item as soon as it finishes.
+    :param urls: Video URLs in playlist order
+    :param zip_path: Path of the ZIP file to create
+    :param quality: Video resolution (e.g. "720p") or audio bitrate / "highest"
+    :param audio: Download audio only instead of video
+    :param workers: Number of items downloaded at the same time
+    :param retries: Retries per item before it is reported as failed
+    :param on_item_done: Optional callback (done_count, total, result), called from this thread
+    :param audio_format: Audio output format; transcoded formats share the process-wide encoder slots
+    :param bitrate: Target bitrate when transcoding
+    :param session: Who the playlist is for; all items share that session's bandwidth and fair share
+    :param stop: Optional threading.Event that ends the download early; the remaining items are reported as stopped
+    :return: Per-item result dicts (without buffers), in playlist order
+    :rtype: list[dict]
+    """
+    urls = list(urls)
+    ext = audio_format_spec(audio_format)["ext"] if audio else ".mp4"
+    results = []
+
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf, \
+            ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="bulk") as pool:
+        futures = [pool.submit(_download_item, i, url, quality, audio, retries, audio_format, bitrate, session, stop)
+                   for i, url in enumerate(urls, 1)]
+        for future in as_completed(futures):
+            result = future.result()
+            buffer = result.pop("buffer")
+            if buffer is not None:
+                try:
+                    arcname = f"{result['index']:03d} - {safe_filename(result['title'] or 'video')}{ext}"
+                    _write_member(zf, arcname, buffer)
+                    result["file_name"] = arcname
+                except Exception as e:
+                    result.update(ok=False, error=f"Failed to write to ZIP: {e}")
+                finally:
+                    release_buffer(buffer)
+            results.append(result)
+            if on_item_done:
+                on_item_done(len(results), len(urls), result)
+
+    return sorted(results, key=lambda r: r["index"])
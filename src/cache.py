@@ -0,0 +1,211 @@
+"""
+    Process-wide metadata cache for pytubefix YouTube objects.
+    Entries are keyed by video_id, expire after a TTL or when YouTube's
+    deciphered stream URLs expire, and are evicted least-recently-used first.
+    The cache is a module-level singleton, so all Streamlit sessions share it.
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from pytubefix import YouTube, extract
+
+DEFAULT_TTL = 6 * 60 * 60            # 6 hours
+DEFAULT_MAX_ENTRIES = 512
+URL_EXPIRY_MARGIN = 10 * 60          # drop entries 10 minutes before stream URLs expire
+SAVE_INTERVAL = 60                   # seconds between disk snapshots
+
+
+def video_id_from_url(url : str):
+    """Extracts the 11 character video_id from a YouTube URL, or None if there is none."""
+    try:
+        return extract.video_id(url)
+    except Exception:
+        return None
+
+
+class _Entry:
+    __slots__ = ("yt", "watch_url", "vid_info", "created_at")
+
+    def __init__(self, yt=None, watch_url=None, vid_info=None, created_at=None):
+        self.yt = yt
+        self.watch_url = watch_url
+        self.vid_info = vid_info
+        self.created_at = created_at if created_at is not None else time.time()
+
+    def loaded_vid_info(self):
+        """The player response if it has been fetched already, without triggering a fetch."""
+        if self.yt is not None:
+            return getattr(self.yt, "_vid_info", None)
+        return self.vid_info
+
+    def expires_at(self, ttl):
+        """
+        The earlier of the TTL deadline and the stream URL expiry reported by YouTube.
+        `created_at` is never later than the real fetch time, so this errs on the safe side.
+        """
+        deadline = self.created_at + ttl
+        vid_info = self.loaded_vid_info() or {}
+        expires_in = vid_info.get("streamingData", {}).get("expiresInSeconds")
+        if expires_in:
+            deadline = min(deadline, self.created_at + int(expires_in) - URL_EXPIRY_MARGIN)
+        return deadline
+
+
+class MetadataCache:
+    """
+    TTL + LRU cache of YouTube objects (metadata and stream catalog) keyed by video_id.
+    Optionally snapshots the fetched player responses to a JSON file so a restart
+    does not start cold.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES, persist_path=None):
+        """
+        :param ttl: Maximum age of an entry in seconds
+        :param max_entries: Maximum number of entries before LRU eviction
+        :param persist_path: Optional JSON file used to persist entries across restarts
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.persist_path = persist_path
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._last_save = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        if persist_path:
+            self.load()
+
+    def get(self, video_id : str):
+        """
+        Returns the cached YouTube object for `video_id`, or None on a miss.
+        :rtype: YouTube | None
+        """
+        with self._lock:
+            entry = self._entries.get(video_id)
+            if entry is not None and time.time() >= entry.expires_at(self.ttl):
+                del self._entries[video_id]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(video_id)
+            self.hits += 1
+            if entry.yt is None:
+                # Restored from disk: rebuild the object around the saved player response
+                entry.yt = YouTube(entry.watch_url)
+                entry.yt.vid_info = entry.vid_info
+                entry.vid_info = None
+            return entry.yt
+
+    def put(self, yt, created_at=None):
+        """
+        Stores a YouTube object. Putting the object that is already cached only
+        refreshes its LRU position and keeps its original timestamp.
+        :param created_at: When its player response was requested, defaults to now
+        """
+        video_id = getattr(yt, "video_id", None)
+        if not video_id:
+            return
+        with self._lock:
+            entry = self._entries.get(video_id)
+            if entry is None or entry.yt is not yt:
+                self._entries[video_id] = _Entry(yt=yt, watch_url=yt.watch_url, created_at=created_at)
+            self._entries.move_to_end(video_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        self._maybe_save()
+
+    def invalidate(self, video_id : str):
+        """Drops one entry, e.g. after its stream URLs were rejected by YouTube."""
+        with self._lock:
+            self._entries.pop(video_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Hit/miss counters and current size.
+        :rtype: dict
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    # --- persistence ---
+
+    def _maybe_save(self):
+        if self.persist_path and time.monotonic() - self._last_save >= SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        """Writes every entry whose player response is loaded to `persist_path` atomically."""
+        if not self.persist_path:
+            return
+        now = time.time()
+        with self._lock:
+            self._last_save = time.monotonic()
+            snapshot = {}
+            for video_id, entry in self._entries.items():
+                vid_info = entry.loaded_vid_info()
+                if vid_info and now < entry.expires_at(self.ttl):
+                    snapshot[video_id] = {
+                        "watch_url": entry.watch_url,
+                        "vid_info": vid_info,
+                        "created_at": entry.created_at,
+                    }
+        tmp_path = f"{self.persist_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.persist_path)
+        except OSError as e:
+            logging.warning(f"Failed to persist metadata cache: {e}")
+
+    def load(self):
+        """Restores unexpired entries from `persist_path`, if it exists."""
+        try:
+            with open(self.persist_path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable metadata cache {self.persist_path}: {e}")
+            return
+        now = time.time()
+        with self._lock:
+            for video_id, data in snapshot.items():
+                entry = _Entry(watch_url=data["watch_url"], vid_info=data["vid_info"], created_at=data["created_at"])
+                if now < entry.expires_at(self.ttl):
+                    self._entries[video_id] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+metadata_cache = MetadataCache(
+    ttl=int(os.environ.get("YTD_METADATA_CACHE_TTL", DEFAULT_TTL)),
+    max_entries=int(os.environ.get("YTD_METADATA_CACHE_SIZE", DEFAULT_MAX_ENTRIES)),
+    persist_path=os.environ.get("YTD_METADATA_CACHE_FILE") or None,
+)
+if metadata_cache.persist_path:
+    atexit.register(metadata_cache.save)
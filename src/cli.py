@@ -0,0 +1,242 @@
+"""
+    Headless batch downloader for cron and pipeline jobs.
+
+    Usage:
+        python -m src.cli urls.txt -o downloads -q 720p -j 4
+        python -m src.cli urls.txt -o music --audio -q highest --audio-format mp3 --bitrate 192k
+        python -m src.cli urls.txt -o links -q 720p --export-links aria2
+        python -m src.cli urls.txt -o clips -q 720p --clip 1:02:00-1:04:00
+
+    The input file holds one video or playlist URL per line (blank lines and
+    lines starting with '#' are ignored). Playlists are expanded to their videos.
+    When everything is done a JSON report with per-item timings, bytes,
+    throughput and failures is written next to the downloads. With
+    --export-links nothing is downloaded; the direct stream URLs are written
+    as a download-manager import list instead. With --clip only that time
+    range of every video is downloaded.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+
+from src.Safe import safe_filename, is_playlist_url
+from src.buffers import release_buffer
+from src.clip import parse_timestamp, format_timestamp
+from src.engine import DownloadEngine, DEFAULT_MAX_CONCURRENT
+from src.links import LinkBatch, EXPORT_FORMATS
+from src.merge import MERGERS
+from src.metrics import registry, configure_json_logging
+from src.playlist import LazyPlaylist
+from src.transfer import DEFAULT_CONNECTIONS
+from src.transcode import AUDIO_FORMATS, DEFAULT_BITRATE, audio_format
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def read_urls(path : str):
+    """Reads URLs from a file, skipping blank lines and comments."""
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+
+def expand_urls(urls):
+    """Replaces every playlist URL with the URLs of its videos, keeping order."""
+    expanded = []
+    for url in urls:
+        if is_playlist_url(url):
+            try:
+                expanded.extend(LazyPlaylist(url).load_all())
+            except Exception as e:
+                logging.error("Failed to list playlist %s: %s", url, e)
+                expanded.append(url)
+        else:
+            expanded.append(url)
+    return expanded
+
+
+def parse_clip(value : str):
+    """
+    Parses a --clip range such as "90-120" or "1:02:00-1:04:00".
+    :return: (start, end) in seconds
+    :rtype: tuple[float, float]
+    """
+    try:
+        start, end = (parse_timestamp(part) for part in value.split("-"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected START-END, e.g. 1:30-2:45, got {value!r}")
+    if end <= start:
+        raise argparse.ArgumentTypeError(f"the clip must end after it starts: {value!r}")
+    return start, end
+
+
+def _save(buffer, path : str):
+    buffer.seek(0)
+    with open(path, "wb") as f:
+        shutil.copyfileobj(buffer, f, COPY_CHUNK_SIZE)
+
+
+async def _download_item(engine, index, url, args):
+    """
+    Downloads one URL into the output directory.
+    :return: The item's report entry
+    :rtype: dict
+    """
+    item = {"index": index, "url": url, "title": None, "ok": False, "file": None,
+            "bytes": 0, "seconds": 0.0, "throughput_bps": 0.0, "error": None}
+    started = time.monotonic()
+    buffer = None
+    try:
+        downloader = await engine.resolve(url)
+        if not downloader.yt:
+            raise RuntimeError("Could not load video")
+        item["title"] = downloader.yt.title
+        buffer = await engine.download(downloader, args.quality, audio=args.audio,
+                                       audio_format=args.audio_format, bitrate=args.bitrate, clip=args.clip,
+                                       merger=args.merger)
+        if buffer is None:
+            raise RuntimeError(f"No stream available for {args.quality}")
+        ext = audio_format(args.audio_format)["ext"] if args.audio else ".mp4"
+        name = downloader.yt.title
+        if args.clip:
+            name += " [" + "-".join(format_timestamp(t).replace(":", ".") for t in args.clip) + "]"
+        path = os.path.join(args.output, safe_filename(f"{name}{ext}"))
+        await asyncio.to_thread(_save, buffer, path)
+        item.update(ok=True, file=path, bytes=os.path.getsize(path))
+    except Exception as e:
+        logging.error("Failed to download %s: %s", url, e)
+        item["error"] = str(e)
+    finally:
+        release_buffer(buffer)
+    item["seconds"] = round(time.monotonic() - started, 3)
+    if item["seconds"] > 0:
+        item["throughput_bps"] = round(item["bytes"] / item["seconds"], 1)
+    print(f"[{'OK' if item['ok'] else 'FAIL'}] {item['title'] or url} ({item['bytes']} bytes, {item['seconds']}s)")
+    return item
+
+
+async def run(urls, args):
+    """
+    Downloads every URL with at most `args.jobs` transfers in flight.
+    :return: The full report
+    :rtype: dict
+    """
+    engine = DownloadEngine(max_concurrent=args.jobs, connections=args.connections)
+    # Also bound metadata resolution, not just the transfers the engine limits
+    slots = asyncio.Semaphore(args.jobs)
+
+    async def _bounded(index, url):
+        async with slots:
+            return await _download_item(engine, index, url, args)
+
+    started = time.monotonic()
+    items = await asyncio.gather(*(_bounded(i, url) for i, url in enumerate(urls, 1)))
+    wall = round(time.monotonic() - started, 3)
+    total_bytes = sum(item["bytes"] for item in items)
+    failures = [item for item in items if not item["ok"]]
+    return {
+        "quality": args.quality,
+        "audio": args.audio,
+        "audio_format": args.audio_format if args.audio else None,
+        "clip": list(args.clip) if args.clip else None,
+        "concurrency": args.jobs,
+        "connections": args.connections,
+        "items": items,
+        "summary": {
+            "total": len(items),
+            "succeeded": len(items) - len(failures),
+            "failed": len(failures),
+            "bytes": total_bytes,
+            "wall_seconds": wall,
+            "throughput_bps": round(total_bytes / wall, 1) if wall > 0 else 0.0,
+        },
+        "failures": [{"url": item["url"], "error": item["error"]} for item in failures],
+    }
+
+
+def export_links(urls, args):
+    """
+    Resolves direct links for every URL and writes them in the `--export-links` format.
+    :return: The process exit code
+    :rtype: int
+    """
+    links = LinkBatch(urls, args.quality, only_audio=args.audio, workers=args.jobs)
+    links.resolve()
+    spec = EXPORT_FORMATS[args.export_links]
+    path = os.path.join(args.output, f"links{spec['ext']}")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(spec["render"](links))
+    for entry in links.failed:
+        print(f"[FAIL] {entry['title'] or entry['url']}: {entry['error']}")
+    print(f"{len(links.ready)}/{len(links)} links written to {path}")
+    return 0 if not links.failed else 1
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m src.cli", description="Batch YouTube downloader.")
+    parser.add_argument("input", help="File with one video or playlist URL per line")
+    parser.add_argument("-o", "--output", default="downloads", help="Output directory (default: downloads)")
+    parser.add_argument("-q", "--quality", default="highest",
+                        help="Video resolution like 720p, audio bitrate like 128kbps, or 'highest' (default)")
+    parser.add_argument("--audio", action="store_true", help="Download audio only")
+    parser.add_argument("--audio-format", choices=list(AUDIO_FORMATS), default="m4a",
+                        help="Audio output format; anything but m4a is transcoded with FFmpeg (default: m4a)")
+    parser.add_argument("--bitrate", default=DEFAULT_BITRATE,
+                        help=f"Target bitrate when transcoding audio (default: {DEFAULT_BITRATE})")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_MAX_CONCURRENT,
+                        help=f"Videos downloaded at the same time (default: {DEFAULT_MAX_CONCURRENT})")
+    parser.add_argument("-c", "--connections", type=int, default=DEFAULT_CONNECTIONS,
+                        help=f"Parallel connections per video (default: {DEFAULT_CONNECTIONS})")
+    parser.add_argument("--clip", type=parse_clip, default=None, metavar="START-END",
+                        help="Download only this time range, e.g. 1:30-2:45 (audio clips are saved as m4a)")
+    parser.add_argument("--merger", choices=list(MERGERS), default=None,
+                        help="How video and audio are merged: ffmpeg, or the built-in remux "
+                             "(default: $YTD_MERGER or ffmpeg)")
+    parser.add_argument("--export-links", choices=list(EXPORT_FORMATS), default=None,
+                        help="Write direct stream URLs for a download manager instead of downloading")
+    parser.add_argument("--report", default=None, help="Report path (default: <output>/report.json)")
+    parser.add_argument("--metrics-file", default=None,
+                        help="Also write Prometheus-format metrics here (e.g. for node_exporter's textfile collector)")
+    parser.add_argument("--log-json", action="store_true", help="Log as JSON lines, including per-phase timings")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.clip and args.audio and args.audio_format != "m4a":
+        parser.error("--clip cuts audio without re-encoding; use --audio-format m4a")
+    if args.log_json:
+        configure_json_logging()
+    else:
+        logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(message)s")
+    os.makedirs(args.output, exist_ok=True)
+
+    urls = expand_urls(read_urls(args.input))
+    if not urls:
+        print("No URLs found in input file.")
+        return 1
+    if args.export_links:
+        return export_links(urls, args)
+
+    report = asyncio.run(run(urls, args))
+    report_path = args.report or os.path.join(args.output, "report.json")
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    if args.metrics_file:
+        with open(args.metrics_file, "w", encoding="utf-8") as f:
+            f.write(registry.render())
+
+    summary = report["summary"]
+    print(f"{summary['succeeded']}/{summary['total']} downloaded, {summary['bytes']} bytes in "
+          f"{summary['wall_seconds']}s ({summary['throughput_bps']} B/s). Report: {report_path}")
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
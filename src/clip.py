@@ -0,0 +1,218 @@
+"""
+    Time-range clips that transfer only the requested segment.
+    YouTube's adaptive MP4 streams are fragmented (DASH on demand profile): an
+    init segment (ftyp + moov) is followed by a segment index (sidx) giving the
+    byte size and duration of every fragment. A clip reads the init segment and
+    the index with one ranged request, picks the fragments that cover the time
+    window, fetches only their bytes and lets FFmpeg trim and remux the result
+    into a standalone file. Bytes transferred scale with the clip length.
+"""
+
+import struct
+import subprocess
+import time
+from collections import namedtuple
+
+from src.metrics import phase, MERGE_TAIL_SECONDS
+
+PROBE_BYTES = 64 * 1024              # enough for ftyp + moov + the sidx of a typical video
+
+
+class ClipError(Exception):
+    """Raised when a clip cannot be cut from a stream's index."""
+
+
+# One fragment: inclusive byte range in the stream, start time and duration in seconds
+Segment = namedtuple("Segment", ["start", "end", "time", "duration"])
+
+
+def parse_timestamp(value):
+    """
+    Parses "90", "1:30", "1:02:03.5" or a number into seconds.
+    :rtype: float
+    :raises ValueError: For anything else, or a negative time
+    """
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    else:
+        parts = str(value).strip().split(":")
+        if not 1 <= len(parts) <= 3 or not all(part.strip() for part in parts):
+            raise ValueError(f"Invalid timestamp: {value!r}")
+        seconds = 0.0
+        for part in parts:
+            seconds = seconds * 60 + float(part)
+    if seconds < 0:
+        raise ValueError(f"Invalid timestamp: {value!r}")
+    return seconds
+
+
+def format_timestamp(seconds : float):
+    """Formats seconds as H:MM:SS(.mmm), for file names and messages."""
+    whole = int(seconds)
+    text = f"{whole // 3600}:{whole // 60 % 60:02d}:{whole % 60:02d}"
+    millis = round((seconds - whole) * 1000)
+    return f"{text}.{millis:03d}" if millis else text
+
+
+def iter_boxes(data : bytes, offset=0):
+    """
+    Walks the top-level MP4 boxes in `data`, which starts at stream offset `offset`.
+    The last box may extend past the end of `data`.
+    :return: (type, stream offset, size) tuples
+    """
+    pos = 0
+    while pos + 8 <= len(data):
+        size, kind = struct.unpack_from(">I4s", data, pos)
+        header = 8
+        if size == 1:
+            if pos + 16 > len(data):
+                return
+            size = struct.unpack_from(">Q", data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            return                   # box runs to the end of the file
+        if size < header:
+            raise ClipError(f"Corrupt MP4 box at offset {offset + pos}")
+        yield kind.decode("latin-1"), offset + pos, size
+        pos += size
+
+
+def parse_sidx(box : bytes, box_offset : int):
+    """
+    Reads the fragments listed in a `sidx` box.
+    :param box: The whole box, header included
+    :param box_offset: Where the box starts in the stream
+    :rtype: list[Segment]
+    """
+    header = 16 if struct.unpack_from(">I", box, 0)[0] == 1 else 8
+    version = box[header]
+    pos = header + 4 + 4             # version/flags, reference_ID
+    timescale = struct.unpack_from(">I", box, pos)[0]
+    pos += 4
+    if version == 0:
+        earliest, first_offset = struct.unpack_from(">II", box, pos)
+        pos += 8
+    else:
+        earliest, first_offset = struct.unpack_from(">QQ", box, pos)
+        pos += 16
+    count = struct.unpack_from(">H", box, pos + 2)[0]
+    pos += 4
+    if not timescale:
+        raise ClipError("Segment index has no timescale")
+
+    segments = []
+    offset = box_offset + len(box) + first_offset
+    presentation = earliest
+    for _ in range(count):
+        reference, duration = struct.unpack_from(">II", box, pos)
+        pos += 12
+        if reference >> 31:
+            raise ClipError("Nested segment indexes are not supported")
+        size = reference & 0x7FFFFFFF
+        segments.append(Segment(offset, offset + size - 1, presentation / timescale, duration / timescale))
+        offset += size
+        presentation += duration
+    return segments
+
+
+class TrackIndex:
+    """The init segment and fragment list of one adaptive stream."""
+
+    def __init__(self, init : bytes, segments):
+        self.init = init
+        self.segments = segments
+
+    @property
+    def duration(self):
+        last = self.segments[-1]
+        return last.time + last.duration - self.segments[0].time
+
+    def select(self, start : float, end : float):
+        """
+        The consecutive fragments that cover [start, end] (seconds from the stream start).
+        :rtype: list[Segment]
+        """
+        base = self.segments[0].time
+        chosen = [s for s in self.segments
+                  if s.time - base < end and s.time - base + s.duration > start]
+        if not chosen:
+            raise ClipError(f"{format_timestamp(start)}-{format_timestamp(end)} is outside the stream")
+        return chosen
+
+    def span(self, start : float, end : float):
+        """
+        The byte range to fetch for [start, end] and where the clip starts within it.
+        :return: (first byte, last byte, seconds from the first fragment to `start`)
+        :rtype: tuple[int, int, float]
+        """
+        chosen = self.select(start, end)
+        base = self.segments[0].time
+        return chosen[0].start, chosen[-1].end, max(0.0, start - (chosen[0].time - base))
+
+
+def index_range(yt, itag : int):
+    """
+    The last byte of a stream's segment index as listed in the player response, if known.
+    Saves the probe guessing how much of the stream head to read.
+    :rtype: int | None
+    """
+    try:
+        for fmt in yt.streaming_data.get("adaptiveFormats", []):
+            if int(fmt.get("itag", 0)) == int(itag) and "indexRange" in fmt:
+                return int(fmt["indexRange"]["end"])
+    except Exception:
+        pass
+    return None
+
+
+def read_index(fetch, filesize=None, index_end=None):
+    """
+    Reads a fragmented MP4's init segment and segment index from the head of the stream.
+    :param fetch: Callable (start, end) -> bytes for an inclusive byte range of the stream
+    :param filesize: The stream size, to keep the probe inside the file
+    :param index_end: Last byte of the sidx box if known (see `index_range`)
+    :rtype: TrackIndex
+    :raises ClipError: If the stream has no segment index (not fragmented, or not MP4)
+    """
+    probe_end = index_end if index_end is not None else PROBE_BYTES - 1
+    if filesize:
+        probe_end = min(probe_end, filesize - 1)
+    data = fetch(0, probe_end)
+
+    for kind, offset, size in iter_boxes(data):
+        if kind == "sidx":
+            if offset + size > len(data):
+                data += fetch(len(data), offset + size - 1)
+            return TrackIndex(data[:offset], parse_sidx(data[offset:offset + size], offset))
+        if kind in ("moof", "mdat"):
+            break
+    raise ClipError("Stream has no segment index")
+
+
+def ffmpeg_clip_cmd(inputs, output_path : str, duration : float):
+    """
+    Builds the FFmpeg command that trims and remuxes clip inputs without re-encoding.
+    :param inputs: (path, seconds to skip, map specifier) per input, e.g. ("video.mp4", 1.5, "v:0")
+    :param duration: Clip length in seconds
+    :rtype: list[str]
+    """
+    cmd = ["ffmpeg", "-y", "-loglevel", "error"]
+    for path, skip, _ in inputs:
+        cmd += ["-ss", f"{skip:.3f}", "-i", path]
+    for i, (_, _, spec) in enumerate(inputs):
+        cmd += ["-map", f"{i}:{spec}"]
+    return cmd + ["-t", f"{duration:.3f}", "-c", "copy", output_path]
+
+
+def trim(inputs, output_path : str, duration : float):
+    """
+    Runs `ffmpeg_clip_cmd` once the inputs are complete.
+    :raises ClipError: If FFmpeg fails
+    """
+    with phase("merge", mode="clip"):
+        started = time.perf_counter()
+        proc = subprocess.run(ffmpeg_clip_cmd(inputs, output_path, duration),
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        MERGE_TAIL_SECONDS.observe(time.perf_counter() - started)
+    if proc.returncode != 0:
+        raise ClipError(proc.stderr)
@@ -0,0 +1,209 @@
+"""
+    Headless asyncio API around YoutubeDownloader.
+    Resolve, stream selection, download and merge can be awaited from any
+    event loop; the blocking work runs in worker threads and progress is
+    delivered as ProgressEvent objects, either to a callback or through an
+    async iterator. Nothing here depends on Streamlit.
+"""
+
+import asyncio
+import threading
+
+from src.main import YoutubeDownloader
+from src.merge import ffmpeg_merge_cmd, MergeError
+from src.transcode import DEFAULT_BITRATE
+
+DEFAULT_MAX_CONCURRENT = 4
+
+
+class ProgressEvent:
+    """
+    One update from a running download.
+    kind is "progress" (percent/text), "message" (level/text), "done" (result) or "error" (error).
+    """
+
+    __slots__ = ("kind", "percent", "text", "level", "result", "error")
+
+    def __init__(self, kind, percent=None, text=None, level=None, result=None, error=None):
+        self.kind = kind
+        self.percent = percent
+        self.text = text
+        self.level = level
+        self.result = result
+        self.error = error
+
+    def __repr__(self):
+        return f"ProgressEvent(kind={self.kind!r}, percent={self.percent!r}, text={self.text!r})"
+
+
+class _EventProgress:
+    """Stands in for a progress bar and turns `.progress()` calls into events."""
+
+    def __init__(self, emit):
+        self._emit = emit
+
+    def progress(self, percent, text=None):
+        self._emit(ProgressEvent("progress", percent=percent, text=text))
+
+
+class DownloadEngine:
+    """
+    Runs many downloads concurrently on one event loop.
+    The concurrency limit is a thread semaphore, so one engine can be shared
+    by callers on different event loops (e.g. one asyncio.run per Streamlit rerun).
+    """
+
+    def __init__(self, max_concurrent=DEFAULT_MAX_CONCURRENT, **downloader_options):
+        """
+        :param max_concurrent: Maximum number of downloads transferring at the same time
+        :param downloader_options: Extra keyword arguments for every YoutubeDownloader
+        """
+        self.max_concurrent = max_concurrent
+        self.downloader_options = downloader_options
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+
+    @staticmethod
+    def _emitter(on_event):
+        """Wraps a callback so worker threads can call it; it then runs on the caller's loop."""
+        if on_event is None:
+            return lambda event: None
+        loop = asyncio.get_running_loop()
+        return lambda event: loop.call_soon_threadsafe(on_event, event)
+
+    async def resolve(self, url : str, on_event=None):
+        """
+        Loads video or playlist metadata.
+        :param url: A video or playlist URL
+        :param on_event: Optional callback receiving "message" events
+        :rtype: YoutubeDownloader
+        """
+        emit = self._emitter(on_event)
+        on_message = lambda level, text: emit(ProgressEvent("message", level=level, text=text))
+        downloader = await asyncio.to_thread(YoutubeDownloader, url, on_message=on_message, **self.downloader_options)
+        # The callback belongs to this call's loop; later calls install their own
+        downloader.on_message = None
+        return downloader
+
+    async def qualities(self, downloader, audio=False):
+        """
+        Lists the qualities that can be passed to `download`.
+        :rtype: list[str]
+        """
+        if audio:
+            return await asyncio.to_thread(downloader.get_audio_qualities)
+        return await asyncio.to_thread(downloader.get_video_qualities)
+
+    async def select_stream(self, downloader, quality, audio=False):
+        """
+        Picks the stream(s) a download at `quality` would use.
+        :return: {"progressive": stream} / {"audio": stream}, or {"video": stream, "audio": stream} for adaptive
+        :rtype: dict
+        """
+        def _select():
+            if audio:
+                return {"audio": downloader.select_audio_stream(quality)}
+            stream = downloader.select_progressive_stream(quality)
+            if stream is not None:
+                return {"progressive": stream}
+            video_stream, audio_stream = downloader.select_adaptive_streams(quality)
+            return {"video": video_stream, "audio": audio_stream}
+        return await asyncio.to_thread(_select)
+
+    def _download_blocking(self, downloader, quality, audio, emit, audio_format, bitrate, session, clip, merger):
+        with self._slots:
+            previous = downloader.on_message
+            downloader.on_message = lambda level, text: emit(ProgressEvent("message", level=level, text=text))
+            if session is not None:
+                downloader.session = session
+            try:
+                progress = _EventProgress(emit)
+                if clip is not None:
+                    start, end = clip
+                    return downloader.DownloadClip(quality, start, end, st_progress_bar=progress, only_audio=audio)
+                if audio:
+                    return downloader.DownloadAudio(quality=quality, st_progress_bar=progress,
+                                                    audio_format=audio_format, bitrate=bitrate)
+                return downloader.Download(quality=quality, st_progress_bar=progress, merger=merger)
+            finally:
+                downloader.on_message = previous
+
+    async def download(self, target, quality, audio=False, on_event=None, audio_format="m4a", bitrate=DEFAULT_BITRATE,
+                       session=None, clip=None, merger=None):
+        """
+        Downloads (and, for adaptive qualities, merges) one video.
+        Pass a URL to get an independent downloader; a YoutubeDownloader
+        must not run two downloads at the same time.
+        :param target: A video URL or a resolved YoutubeDownloader
+        :param quality: Resolution, bitrate or "highest"
+        :param audio: Download audio only
+        :param on_event: Optional callback receiving ProgressEvents on the calling loop
+        :param audio_format: Audio output format, "m4a" (as downloaded) or one that is transcoded, e.g. "mp3"
+        :param bitrate: Target bitrate when transcoding
+        :param session: Who the download is for, for bandwidth limits and fair scheduling
+        :param clip: Optional (start, end) in seconds; only that part is downloaded (audio clips are m4a)
+        :param merger: How adaptive tracks are merged, "ffmpeg" or "remux" (see src.merge)
+        :return: The result buffer, or None if no suitable stream was found
+        :rtype: SpooledBuffer | None
+        """
+        downloader = target if isinstance(target, YoutubeDownloader) else await self.resolve(target, on_event)
+        if not downloader.yt:
+            return None
+        return await asyncio.to_thread(self._download_blocking, downloader, quality, audio, self._emitter(on_event),
+                                       audio_format, bitrate, session, clip, merger)
+
+    async def events(self, target, quality, audio=False, audio_format="m4a", bitrate=DEFAULT_BITRATE, session=None,
+                     clip=None, merger=None):
+        """
+        Async iterator over a download's events. The last event is "done"
+        (with `result`) or "error" (with `error`).
+        """
+        queue = asyncio.Queue()
+        task = asyncio.create_task(self.download(target, quality, audio, on_event=queue.put_nowait,
+                                                 audio_format=audio_format, bitrate=bitrate, session=session,
+                                                 clip=clip, merger=merger))
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+        while True:
+            event = await queue.get()
+            if event is None:
+                break
+            yield event
+        # Events scheduled from worker threads may still be in flight
+        while not queue.empty():
+            event = queue.get_nowait()
+            if event is not None:
+                yield event
+        if task.exception() is not None:
+            yield ProgressEvent("error", error=task.exception())
+        else:
+            yield ProgressEvent("done", result=task.result())
+
+    async def download_many(self, targets, quality, audio=False, on_event=None, audio_format="m4a",
+                            bitrate=DEFAULT_BITRATE, session=None):
+        """
+        Downloads several videos concurrently, bounded by `max_concurrent`.
+        :param on_event: Optional callback (index, ProgressEvent)
+        :return: One result per target, or the exception it raised
+        :rtype: list
+        """
+        def _for(index):
+            return None if on_event is None else (lambda event: on_event(index, event))
+        return await asyncio.gather(
+            *(self.download(t, quality, audio, on_event=_for(i), audio_format=audio_format, bitrate=bitrate,
+                            session=session)
+              for i, t in enumerate(targets)),
+            return_exceptions=True
+        )
+
+    async def merge(self, video_path : str, audio_path : str, output_path : str):
+        """
+        Merges finished video and audio files with FFmpeg without blocking the loop.
+        :raises MergeError: If FFmpeg fails
+        """
+        proc = await asyncio.create_subprocess_exec(
+            *ffmpeg_merge_cmd(video_path, audio_path, output_path),
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            raise MergeError(stderr.decode("utf-8", errors="replace"))
+        return output_path
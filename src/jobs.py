@@ -0,0 +1,847 @@
+"""
+    Background download jobs that outlive Streamlit reruns and reconnects.
+    Jobs are rows in a local SQLite database; a pool of worker processes
+    claims them one at a time, runs the download and leaves the finished
+    file on disk. The UI only submits jobs and polls their status and progress
+    by job id, so a rerun, a reconnect or a new browser tab picks up the same
+    job. Finished files are kept until collected (or until YTD_JOB_RETENTION
+    seconds have passed), and jobs of a worker that died are queued again.
+    Identical requests (same video, quality, options and slot) share one job.
+    Besides single downloads there are playlist ZIP jobs (kind "playlist_zip"),
+    which download a whole playlist with src.bulk and leave the ZIP.
+    The bandwidth, transfer and merge limits of src.scheduler hold for all
+    workers together: token buckets and merge slots live in the database, and
+    a worker only claims a job while fewer than YTD_MAX_TRANSFERS are running.
+    Caches in memory are per worker process; each worker writes its metrics
+    to the job directory, and the UI process exports them with a "worker" label.
+    Configure with YTD_JOB_DIR, YTD_JOB_WORKERS and YTD_JOB_RETENTION;
+    with YTD_JOB_WORKERS=0 the workers run elsewhere, via `python -m src.jobs`.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from src.cache import video_id_from_url
+from src.metrics import registry, JOBS, SCHEDULER_WAIT_SECONDS
+from src.scheduler import scheduler, BURST_SECONDS, DEFAULT_SESSION
+from src.singleflight import in_flight
+
+DEFAULT_JOB_DIR = os.path.join(tempfile.gettempdir(), "ytd_jobs")
+DEFAULT_WORKERS = 2
+DEFAULT_RETENTION = 24 * 60 * 60     # a finished file nobody collected is removed after a day
+COLLECTED_TTL = 60 * 60              # collected files stay a while, so Save can be clicked again
+POLL_INTERVAL = 0.5                  # seconds an idle worker waits before looking for work again
+PROGRESS_INTERVAL = 0.5              # progress is written at most this often
+HEARTBEAT_INTERVAL = 10
+STALE_AFTER = 60                     # a running job without a heartbeat for this long lost its worker
+MAX_ATTEMPTS = 3                     # times a job is started before a lost worker fails it
+PURGE_INTERVAL = 60
+MAX_TOKEN_WAIT = 1.0                 # a worker waiting for bandwidth looks again at least this often
+BUCKET_IDLE = 60 * 60                # session buckets unused for this long are removed
+METRICS_INTERVAL = 5                 # seconds between a worker's metrics snapshots
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED, COLLECTED = "queued", "running", "done", "failed", "cancelled", "collected"
+STATUSES = (QUEUED, RUNNING, DONE, FAILED, CANCELLED, COLLECTED)
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+READY_STATUSES = (DONE, COLLECTED)
+DOWNLOAD, PLAYLIST_ZIP = "download", "playlist_zip"
+KINDS = (DOWNLOAD, PLAYLIST_ZIP)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL DEFAULT 'download',
+    url TEXT NOT NULL,
+    quality TEXT,
+    options TEXT NOT NULL,
+    slot TEXT,
+    file_name TEXT,
+    mime TEXT,
+    session TEXT,
+    dedupe_key TEXT,
+    status TEXT NOT NULL,
+    percent INTEGER NOT NULL DEFAULT 0,
+    message TEXT,
+    error TEXT,
+    result_path TEXT,
+    size INTEGER,
+    report TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker INTEGER,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    heartbeat_at REAL,
+    finished_at REAL,
+    collected_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+-- Sessions that submitted a job; it is cancelled once the last of them cancels it
+CREATE TABLE IF NOT EXISTS job_sessions (
+    job_id TEXT NOT NULL,
+    session TEXT NOT NULL,
+    PRIMARY KEY (job_id, session)
+);
+-- Token buckets shared by the workers' bandwidth limits
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+-- Held merge slots, one row per holder; a playlist ZIP job may hold several at once
+CREATE TABLE IF NOT EXISTS slot_leases (
+    id INTEGER PRIMARY KEY,
+    job_id TEXT NOT NULL,
+    name TEXT NOT NULL
+);
+"""
+# Columns added after the first release; older databases get them on open
+_ADDED_COLUMNS = {"dedupe_key": "TEXT", "kind": "TEXT NOT NULL DEFAULT 'download'", "report": "TEXT"}
+
+
+class JobError(Exception):
+    """Raised when a job's result cannot be collected."""
+
+
+class JobCancelled(Exception):
+    """Raised inside a worker when its job was cancelled while running."""
+
+
+class JobStore:
+    """
+    The job table, shared by the UI process and every worker.
+    Each thread gets its own connection; the database runs in WAL mode so
+    polling readers never block the workers writing progress.
+    """
+
+    def __init__(self, directory=DEFAULT_JOB_DIR, retention=DEFAULT_RETENTION):
+        """
+        :param directory: Holds the database and the finished files
+        :param retention: Seconds a finished file is kept when nobody collects it
+        """
+        self.directory = directory
+        self.path = os.path.join(directory, "jobs.sqlite3")
+        self.results_dir = os.path.join(directory, "results")
+        self.metrics_dir = os.path.join(directory, "metrics")
+        self.retention = retention
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(self.results_dir, exist_ok=True)
+            # Autocommit; multi-statement updates open their own transaction
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            # WAL is a property of the database file; switching needs a lock another process may hold
+            if conn.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+                conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, kind in _ADDED_COLUMNS.items():
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_dedupe ON jobs (dedupe_key, status)")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """A write transaction; IMMEDIATE takes the write lock up front, so reads inside it stay valid."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def submit(self, url : str, quality, audio=False, audio_format="m4a", bitrate=None, clip=None, slot=None,
+               file_name=None, mime=None, session=None, kind=DOWNLOAD, workers=None):
+        """
+        Queues a download, or joins the queued or running job for the same request.
+        :param url: The video URL, or the playlist URL of a PLAYLIST_ZIP job
+        :param quality: Resolution, bitrate or "highest"
+        :param audio: Download audio only
+        :param audio_format: Audio output format (see `YoutubeDownloader.DownloadAudio`)
+        :param bitrate: Target bitrate when transcoding, None for the default
+        :param clip: Optional (start, end) in seconds
+        :param slot: Where the UI shows the job, e.g. "video" or "playlist:<video_id>"
+        :param file_name: Name the finished file is saved under
+        :param mime: MIME type of the finished file
+        :param session: Who the download is for; a shared job runs for the session that submitted it first
+        :param kind: DOWNLOAD for one video, PLAYLIST_ZIP for a whole playlist in one ZIP
+        :param workers: Videos a PLAYLIST_ZIP job downloads at the same time, None for src.bulk's default
+        :return: The job id
+        :rtype: str
+        :raises ValueError: For an unknown kind
+        """
+        if kind not in KINDS:
+            raise ValueError(f"Unknown job kind {kind!r}, expected one of {', '.join(KINDS)}")
+        options = {"audio": bool(audio), "audio_format": audio_format, "bitrate": bitrate,
+                   "clip": list(clip) if clip else None}
+        # Quality and options pick the streams and the format, so equal keys mean equal files;
+        # a playlist URL can name a video too, so playlists are keyed by the whole URL
+        identity = url if kind == PLAYLIST_ZIP else video_id_from_url(url) or url
+        dedupe_key = json.dumps([identity, quality, options, slot])
+        if kind == PLAYLIST_ZIP:
+            # Only changes how fast the ZIP is made, not what is in it
+            options["workers"] = workers
+        with self._transaction() as conn:
+            row = conn.execute(
+                f"SELECT id FROM jobs WHERE dedupe_key = ? AND status IN ({', '.join('?' * len(ACTIVE_STATUSES))}) "
+                "ORDER BY created_at LIMIT 1",
+                (dedupe_key, *ACTIVE_STATUSES)
+            ).fetchone()
+            if row is not None:
+                job_id = row["id"]
+            else:
+                job_id = uuid.uuid4().hex
+                conn.execute(
+                    "INSERT INTO jobs (id, kind, url, quality, options, slot, file_name, mime, session, dedupe_key, "
+                    "status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, kind, url, quality, json.dumps(options), slot, file_name, mime, session, dedupe_key,
+                     QUEUED, time.time())
+                )
+            conn.execute("INSERT OR IGNORE INTO job_sessions (job_id, session) VALUES (?, ?)",
+                         (job_id, session or DEFAULT_SESSION))
+        return job_id
+
+    @staticmethod
+    def _job(row):
+        job = dict(row)
+        job["options"] = json.loads(job["options"])
+        job["report"] = json.loads(job["report"]) if job["report"] else None
+        return job
+
+    def get(self, job_id : str):
+        """
+        A job as a dict, or None if there is no such job (any more).
+        :rtype: dict | None
+        """
+        row = self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row) if row is not None else None
+
+    def get_many(self, job_ids):
+        """
+        Several jobs at once, in the order given; unknown ids are left out.
+        :rtype: list[dict]
+        """
+        job_ids = list(job_ids)
+        if not job_ids:
+            return []
+        rows = self._conn().execute(
+            f"SELECT * FROM jobs WHERE id IN ({', '.join('?' * len(job_ids))})", job_ids
+        ).fetchall()
+        jobs = {row["id"]: self._job(row) for row in rows}
+        return [jobs[job_id] for job_id in job_ids if job_id in jobs]
+
+    def cancel(self, job_id : str, session=None):
+        """
+        Cancels a queued or running job for `session`. A job shared with other
+        sessions keeps running for them; otherwise a running one stops at its next progress update.
+        :return: True if the job was cancelled
+        :rtype: bool
+        """
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM job_sessions WHERE job_id = ? AND session = ?",
+                         (job_id, session or DEFAULT_SESSION))
+            if conn.execute("SELECT 1 FROM job_sessions WHERE job_id = ?", (job_id,)).fetchone() is not None:
+                return False
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status IN (?, ?)",
+                (CANCELLED, time.time(), job_id, *ACTIVE_STATUSES)
+            )
+        return cursor.rowcount > 0
+
+    def collect(self, job_id : str):
+        """
+        Marks a finished job collected and returns the path of its file.
+        The file stays until COLLECTED_TTL has passed; open it right away.
+        :rtype: str
+        :raises JobError: If the job is not finished or its file was already removed
+        """
+        job = self.get(job_id)
+        if job is None or job["status"] not in READY_STATUSES or not os.path.exists(job["result_path"] or ""):
+            raise JobError("This download is not available any more; please download it again.")
+        self._conn().execute("UPDATE jobs SET status = ?, collected_at = ? WHERE id = ?",
+                             (COLLECTED, time.time(), job_id))
+        return job["result_path"]
+
+    def counts(self):
+        """
+        Number of jobs per status.
+        :rtype: dict
+        """
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    # --- used by workers ---
+
+    def claim(self, worker : int, max_running=None):
+        """
+        Takes a queued job for a worker: the oldest one of the session with the fewest running jobs.
+        :param max_running: Leave the queue alone while this many jobs are running, None for no limit
+        :return: The job, now running, or None if there is nothing to run
+        :rtype: dict | None
+        """
+        now = time.time()
+        # The write lock is taken up front, so two workers never claim the same job
+        with self._transaction() as conn:
+            if max_running and conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?",
+                                            (RUNNING,)).fetchone()[0] >= max_running:
+                return None
+            row = conn.execute(
+                "SELECT id FROM jobs AS queued WHERE status = ? ORDER BY "
+                "(SELECT COUNT(*) FROM jobs AS running WHERE running.status = ? AND running.session IS queued.session), "
+                "created_at LIMIT 1",
+                (QUEUED, RUNNING)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, worker = ?, attempts = attempts + 1, started_at = ?, "
+                    "heartbeat_at = ?, percent = 0, message = NULL WHERE id = ?",
+                    (RUNNING, worker, now, now, row["id"])
+                )
+                conn.execute("DELETE FROM slot_leases WHERE job_id = ?", (row["id"],))
+        return self.get(row["id"]) if row is not None else None
+
+    def progress(self, job_id : str, percent=None, message=None):
+        """
+        Records a running job's progress and heartbeat.
+        :raises JobCancelled: If the job was cancelled in the meantime
+        """
+        cursor = self._conn().execute(
+            "UPDATE jobs SET percent = COALESCE(?, percent), message = COALESCE(?, message), heartbeat_at = ? "
+            "WHERE id = ? AND status = ?",
+            (percent, message, time.time(), job_id, RUNNING)
+        )
+        if cursor.rowcount == 0:
+            raise JobCancelled(job_id)
+
+    def finish(self, job_id : str, result_path : str, report=None):
+        """
+        Marks a job done; a job cancelled in the meantime has its file removed instead.
+        :param report: Optional per-item results of a PLAYLIST_ZIP job (see `src.bulk.download_playlist_zip`)
+        """
+        cursor = self._conn().execute(
+            "UPDATE jobs SET status = ?, percent = 100, result_path = ?, size = ?, report = ?, finished_at = ? "
+            "WHERE id = ? AND status = ?",
+            (DONE, result_path, os.path.getsize(result_path), json.dumps(report) if report is not None else None,
+             time.time(), job_id, RUNNING)
+        )
+        if cursor.rowcount == 0:
+            _remove(result_path)
+
+    def fail(self, job_id : str, error : str):
+        self._conn().execute(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ? AND status = ?",
+            (FAILED, error, time.time(), job_id, RUNNING)
+        )
+
+    def requeue_stale(self):
+        """
+        Queues running jobs whose worker stopped sending heartbeats again,
+        or fails them once they were started MAX_ATTEMPTS times.
+        :return: The number of jobs recovered
+        :rtype: int
+        """
+        cutoff = time.time() - STALE_AFTER
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? "
+                "WHERE status = ? AND heartbeat_at < ? AND attempts >= ?",
+                (FAILED, "The worker running this download stopped.", time.time(), RUNNING, cutoff, MAX_ATTEMPTS)
+            )
+            cursor = conn.execute("UPDATE jobs SET status = ?, worker = NULL WHERE status = ? AND heartbeat_at < ?",
+                                  (QUEUED, RUNNING, cutoff))
+        if cursor.rowcount:
+            logging.warning("Queued %s jobs of stopped workers again", cursor.rowcount)
+        return cursor.rowcount
+
+    def purge(self):
+        """
+        Removes collected jobs after COLLECTED_TTL, and every other finished job after the retention.
+        :return: The number of jobs removed
+        :rtype: int
+        """
+        conn = self._conn()
+        now = time.time()
+        rows = conn.execute(
+            "SELECT id, result_path FROM jobs WHERE (status = ? AND collected_at < ?) "
+            "OR (status IN (?, ?, ?) AND finished_at < ?)",
+            (COLLECTED, now - COLLECTED_TTL, DONE, FAILED, CANCELLED, now - self.retention)
+        ).fetchall()
+        for row in rows:
+            if row["result_path"]:
+                _remove(row["result_path"])
+            conn.execute("DELETE FROM jobs WHERE id = ?", (row["id"],))
+            conn.execute("DELETE FROM job_sessions WHERE job_id = ?", (row["id"],))
+        conn.execute("DELETE FROM buckets WHERE updated < ?", (now - BUCKET_IDLE,))
+        return len(rows)
+
+    # --- worker metrics ---
+
+    def publish_metrics(self, worker : int, snapshot):
+        """Stores a worker's metrics snapshot (see `MetricsRegistry.snapshot`) for the UI process."""
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        path = os.path.join(self.metrics_dir, f"worker-{worker}.json")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+
+    def worker_metrics(self):
+        """
+        The metrics of workers that published recently, as `MetricsRegistry.add_collector` expects them.
+        :return: ({"worker": number}, snapshot) pairs
+        :rtype: list
+        """
+        cutoff = time.time() - STALE_AFTER
+        try:
+            names = sorted(os.listdir(self.metrics_dir))
+        except OSError:
+            return []
+        collected = []
+        for name in names:
+            if not (name.startswith("worker-") and name.endswith(".json")):
+                continue
+            path = os.path.join(self.metrics_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    continue     # the worker is gone
+                with open(path, "r", encoding="utf-8") as f:
+                    collected.append(({"worker": name[len("worker-"):-len(".json")]}, json.load(f)))
+            except (OSError, ValueError):
+                continue
+        return collected
+
+    # --- limits shared by the workers ---
+
+    def take_tokens(self, amount : int, buckets):
+        """
+        Takes `amount` bytes from shared token buckets once all of them have tokens.
+        Like the scheduler's buckets they may go into debt by one grant.
+        :param buckets: (name, rate in bytes per second) pairs; a falsy rate is no limit
+        :return: 0 if the bytes were granted, else the seconds to wait before asking again
+        :rtype: float
+        """
+        buckets = [(name, rate) for name, rate in buckets if rate]
+        now = time.time()
+        with self._transaction() as conn:
+            levels = {}
+            for name, rate in buckets:
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+                capacity = rate * BURST_SECONDS
+                tokens = capacity if row is None else min(capacity, row["tokens"] + (now - row["updated"]) * rate)
+                levels[name] = tokens
+            wait = max((-levels[name] / rate for name, rate in buckets if levels[name] <= 0), default=0.0)
+            for name, _ in buckets:
+                tokens = levels[name] if wait else levels[name] - amount
+                conn.execute("INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                             (name, tokens, now))
+        return wait
+
+    def take_lease(self, job_id : str, name : str, limit : int):
+        """
+        Takes one of `limit` slots called `name` for a running job.
+        Slots of jobs that stopped running (cancelled, or their worker died) are freed on the way.
+        :return: The lease id to release the slot with, or None if all slots are taken
+        :rtype: int | None
+        """
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM slot_leases WHERE job_id NOT IN (SELECT id FROM jobs WHERE status = ?)",
+                         (RUNNING,))
+            if conn.execute("SELECT COUNT(*) FROM slot_leases WHERE name = ?", (name,)).fetchone()[0] >= limit:
+                return None
+            return conn.execute("INSERT INTO slot_leases (job_id, name) VALUES (?, ?)", (job_id, name)).lastrowid
+
+    def release_lease(self, lease : int):
+        self._conn().execute("DELETE FROM slot_leases WHERE id = ?", (lease,))
+
+    def leases(self, name : str):
+        """Number of slots called `name` that are held."""
+        return self._conn().execute("SELECT COUNT(*) FROM slot_leases WHERE name = ?", (name,)).fetchone()[0]
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.warning(f"Failed to remove job file {path}: {e}")
+
+
+class _JobProgress:
+    """Stands in for a progress bar and writes `.progress()` calls to the job, throttled."""
+
+    def __init__(self, store, job_id):
+        self._store = store
+        self._job_id = job_id
+        self._last = 0.0
+
+    def progress(self, percent, text=None):
+        now = time.monotonic()
+        if percent < 100 and now - self._last < PROGRESS_INTERVAL:
+            return
+        self._last = now
+        self._store.progress(self._job_id, percent, text)
+
+
+class _SharedBandwidth:
+    """
+    Takes the place of the scheduler's BandwidthShaper in a worker process:
+    the global and per-session buckets are rows in the job store, so the
+    limits hold for every worker together. A worker runs one job at a time,
+    so there is no queue to keep fair within the process.
+    """
+
+    def __init__(self, store, global_rate=None, session_rate=None):
+        self.store = store
+        self.global_rate = global_rate
+        self.session_rate = session_rate
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.global_rate or self.session_rate)
+
+    @property
+    def waiting(self):
+        return self._waiting
+
+    def acquire(self, amount : int, session=DEFAULT_SESSION):
+        """Blocks until `amount` bytes may be transferred for `session`."""
+        if not self.enabled:
+            return
+        started = time.monotonic()
+        with self._lock:
+            self._waiting += 1
+        try:
+            while True:
+                wait = self.store.take_tokens(amount, [("global", self.global_rate),
+                                                       (f"session:{session}", self.session_rate)])
+                if not wait:
+                    break
+                time.sleep(min(wait, MAX_TOKEN_WAIT))
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        SCHEDULER_WAIT_SECONDS.observe(time.monotonic() - started, queue="bandwidth")
+
+
+class _SharedSlots:
+    """
+    Takes the place of a scheduler FairSlots in a worker process: slots are
+    leases in the job store held for the running job, so `limit` counts every worker.
+    """
+
+    def __init__(self, store, name : str, limit=None):
+        self.store = store
+        self.name = name
+        self.limit = limit
+        self.job_id = None           # the job this worker is running, set by `worker_main`
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self.store.leases(self.name) if self.limit else 0
+
+    @property
+    def waiting(self):
+        return self._waiting
+
+    @contextmanager
+    def slot(self, session=DEFAULT_SESSION):
+        job_id = self.job_id
+        if not self.limit or job_id is None:
+            yield
+            return
+        started = time.monotonic()
+        with self._lock:
+            self._waiting += 1
+        try:
+            lease = self.store.take_lease(job_id, self.name, self.limit)
+            while lease is None:
+                # Stops waiting for a job that was cancelled meanwhile
+                self.store.progress(job_id)
+                time.sleep(POLL_INTERVAL)
+                lease = self.store.take_lease(job_id, self.name, self.limit)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        SCHEDULER_WAIT_SECONDS.observe(time.monotonic() - started, queue=self.name)
+        try:
+            yield
+        finally:
+            self.store.release_lease(lease)
+
+
+def _share_limits(store):
+    """Moves this worker's scheduler limits into the job store; see `_SharedBandwidth` and `_SharedSlots`."""
+    scheduler.bandwidth = _SharedBandwidth(store, scheduler.bandwidth.global_rate, scheduler.bandwidth.session_rate)
+    scheduler.merges = _SharedSlots(store, "merge", scheduler.merges.limit)
+
+
+def _publish_metrics(store, worker):
+    """Snapshots this worker's metrics every METRICS_INTERVAL; `ytd_jobs` is the UI's own."""
+    while True:
+        try:
+            store.publish_metrics(worker, registry.snapshot(exclude=(JOBS.name,)))
+        except OSError as e:
+            logging.warning(f"Failed to publish job worker metrics: {e}")
+        time.sleep(METRICS_INTERVAL)
+
+
+def _heartbeat(store, job_id, stop, cancelled=None, interval=HEARTBEAT_INTERVAL):
+    """
+    Keeps a job alive while it runs without progress, e.g. during a merge.
+    :param cancelled: Optional threading.Event, set once the job was cancelled
+    """
+    while not stop.wait(interval):
+        try:
+            store.progress(job_id)
+        except JobCancelled:
+            if cancelled is not None:
+                cancelled.set()
+            return
+        except sqlite3.Error as e:
+            logging.warning(f"Job heartbeat failed: {e}")
+
+
+def _download(store, job):
+    """
+    Downloads the video, audio or clip of a DOWNLOAD job.
+    :rtype: SpooledBuffer
+    """
+    from src.main import YoutubeDownloader
+    from src.transcode import DEFAULT_BITRATE
+
+    job_id, options = job["id"], job["options"]
+    errors = []
+
+    def on_message(level, text):
+        if level == "error":
+            errors.append(text)
+        else:
+            store.progress(job_id, message=text)
+
+    downloader = YoutubeDownloader(job["url"], on_message=on_message, session=job["session"])
+    if not downloader.yt:
+        raise RuntimeError(errors[-1] if errors else "Could not load video")
+    progress = _JobProgress(store, job_id)
+    if options["clip"]:
+        start, end = options["clip"]
+        buffer = downloader.DownloadClip(job["quality"], start, end, st_progress_bar=progress,
+                                         only_audio=options["audio"])
+    elif options["audio"]:
+        buffer = downloader.DownloadAudio(job["quality"], st_progress_bar=progress,
+                                          audio_format=options["audio_format"],
+                                          bitrate=options["bitrate"] or DEFAULT_BITRATE)
+    else:
+        buffer = downloader.Download(job["quality"], st_progress_bar=progress)
+    if buffer is None:
+        raise RuntimeError(errors[-1] if errors else f"No stream available for {job['quality']}")
+    return buffer
+
+
+def _playlist_zip(store, job, cancelled):
+    """
+    Downloads every video of a PLAYLIST_ZIP job's playlist into one ZIP.
+    :param cancelled: threading.Event set once the job was cancelled; it stops the remaining videos
+    :return: (buffer owning the ZIP, per-item report)
+    :rtype: tuple
+    :raises JobCancelled: If the job was cancelled meanwhile
+    """
+    from src.buffers import SpooledBuffer
+    from src.bulk import download_playlist_zip, DEFAULT_WORKERS as DEFAULT_BULK_WORKERS
+    from src.playlist import LazyPlaylist
+    from src.transcode import DEFAULT_BITRATE
+
+    job_id, options = job["id"], job["options"]
+    store.progress(job_id, 0, "Listing playlist videos...")
+    urls = LazyPlaylist(job["url"]).load_all()
+
+    def on_item_done(done, total, result):
+        status = "✅" if result["ok"] else "❌"
+        try:
+            store.progress(job_id, int(done / total * 100),
+                           f"Downloading {done}/{total}... {status} {result['title'] or result['url']}")
+        except JobCancelled:
+            cancelled.set()
+
+    zip_path = os.path.join(tempfile.gettempdir(), f"playlist_{uuid.uuid4().hex}.zip")
+    try:
+        report = download_playlist_zip(
+            urls, zip_path,
+            quality=job["quality"],
+            audio=options["audio"],
+            workers=options.get("workers") or DEFAULT_BULK_WORKERS,
+            on_item_done=on_item_done,
+            audio_format=options["audio_format"],
+            bitrate=options["bitrate"] or DEFAULT_BITRATE,
+            session=job["session"],
+            stop=cancelled
+        )
+        if cancelled.is_set():
+            raise JobCancelled(job_id)
+        return SpooledBuffer.from_file(zip_path), report
+    except BaseException:
+        _remove(zip_path)
+        raise
+
+
+def run_job(store, job):
+    """
+    Runs one claimed job to completion and records the outcome.
+    :param store: The JobStore the job came from
+    :param job: The job, as returned by `JobStore.claim`
+    """
+    # Imported here so the UI process does not load the download stack just to queue jobs
+    from src.buffers import save_buffer, release_buffer
+
+    job_id = job["id"]
+    stop, cancelled = threading.Event(), threading.Event()
+    # A playlist ZIP reports progress only when a video finishes, so cancellation is looked for more often
+    interval = POLL_INTERVAL if job["kind"] == PLAYLIST_ZIP else HEARTBEAT_INTERVAL
+    threading.Thread(target=_heartbeat, args=(store, job_id, stop, cancelled, interval), daemon=True,
+                     name="job-heartbeat").start()
+    buffer = report = None
+    try:
+        if job["kind"] == PLAYLIST_ZIP:
+            buffer, report = _playlist_zip(store, job, cancelled)
+        else:
+            buffer = _download(store, job)
+
+        ext = os.path.splitext(job["file_name"] or "")[1] or ".bin"
+        result_path = os.path.join(store.results_dir, job_id + ext)
+        # Moves or hard-links the downloaded (or cached) file; only in-memory results are copied
+        save_buffer(buffer, result_path)
+        store.finish(job_id, result_path, report)
+    except JobCancelled:
+        logging.info("Job %s cancelled", job_id)
+    except Exception as e:
+        logging.warning("Job %s failed: %s", job_id, e)
+        store.fail(job_id, str(e))
+    finally:
+        stop.set()
+        release_buffer(buffer)
+
+
+def worker_main(directory : str, worker : int, retention=DEFAULT_RETENTION):
+    """
+    A worker process: claims and runs jobs until its parent goes away.
+    :param directory: The job directory shared with the UI
+    :param worker: This worker's number, recorded on the jobs it runs
+    """
+    store = JobStore(directory, retention=retention)
+    _share_limits(store)
+    # The store already shares identical jobs; running the work on the job's own
+    # thread lets JobCancelled stop it, so `merges.job_id` is only reset once it ended
+    in_flight.enabled = False
+    threading.Thread(target=_publish_metrics, args=(store, worker), daemon=True, name="job-metrics").start()
+    parent = os.getppid()
+    last_purge = 0.0
+    logging.info("Job worker %s started (pid %s)", worker, os.getpid())
+    while os.getppid() == parent:
+        job = store.claim(worker, max_running=scheduler.transfers.limit)
+        if job is not None:
+            scheduler.merges.job_id = job["id"]
+            try:
+                run_job(store, job)
+            finally:
+                scheduler.merges.job_id = None
+            continue
+        if time.monotonic() - last_purge > PURGE_INTERVAL:
+            last_purge = time.monotonic()
+            store.requeue_stale()
+            store.purge()
+        time.sleep(POLL_INTERVAL)
+
+
+class WorkerPool:
+    """The worker processes serving a JobStore; dead workers are replaced on `start()`."""
+
+    def __init__(self, store, workers=DEFAULT_WORKERS):
+        """
+        :param store: The JobStore to serve
+        :param workers: Number of worker processes, i.e. downloads running at the same time
+        """
+        self.store = store
+        self.workers = workers
+        # Spawned, not forked: the UI process runs threads that must not be copied mid-flight
+        self._context = multiprocessing.get_context("spawn")
+        self._processes = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Starts missing workers; safe to call repeatedly."""
+        with self._lock:
+            for worker in range(self.workers):
+                process = self._processes.get(worker)
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    logging.warning("Job worker %s exited with %s; starting a new one", worker, process.exitcode)
+                process = self._context.Process(
+                    target=worker_main, args=(self.store.directory, worker, self.store.retention),
+                    name=f"ytd-job-worker-{worker}", daemon=True
+                )
+                process.start()
+                self._processes[worker] = process
+        return self
+
+    def stop(self, timeout=5.0):
+        """Terminates the workers; their running jobs are queued again by the next pool."""
+        with self._lock:
+            processes, self._processes = list(self._processes.values()), {}
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(timeout)
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        with self._lock:
+            alive = sum(process.is_alive() for process in self._processes.values())
+        return {"workers": self.workers, "alive": alive, **self.store.counts()}
+
+
+job_store = JobStore(
+    directory=os.environ.get("YTD_JOB_DIR", DEFAULT_JOB_DIR),
+    retention=int(os.environ.get("YTD_JOB_RETENTION", DEFAULT_RETENTION)),
+)
+worker_pool = WorkerPool(job_store, workers=int(os.environ.get("YTD_JOB_WORKERS", DEFAULT_WORKERS)))
+for _status in STATUSES:
+    JOBS.set_function(lambda status=_status: job_store.counts().get(status, 0), status=_status)
+registry.add_collector(job_store.worker_metrics)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run download job workers in the foreground.")
+    parser.add_argument("--workers", type=int, default=max(1, worker_pool.workers))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    worker_pool.workers = args.workers
+    worker_pool.start()
+    try:
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            worker_pool.start()
+    except KeyboardInterrupt:
+        worker_pool.stop()
@@ -0,0 +1,188 @@
+"""
+    Batch direct-link resolution for playlists.
+    Every entry is resolved on a bounded worker pool and its signed stream URL
+    kept together with the time YouTube stops accepting it. Refreshing the
+    batch only re-resolves entries that failed or whose link has expired, and
+    the result can be exported for a download manager (a plain URL list or an
+    aria2 input file).
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse, parse_qs
+
+from src.Safe import safe_filename, safe_youtube
+from src.cache import metadata_cache, video_id_from_url, URL_EXPIRY_MARGIN
+from src.metrics import phase
+
+DEFAULT_WORKERS = 8
+DEFAULT_LINK_TTL = 6 * 60 * 60       # YouTube's usual lifetime when a URL carries no `expire` parameter
+
+
+def select_link_stream(yt, quality, only_audio=False):
+    """
+    Picks the stream whose URL is handed to a download manager.
+    Videos prefer the progressive stream and fall back to the adaptive
+    (video-only) stream when the quality is only available that way.
+    :param quality: A resolution, a bitrate, or "highest"
+    :return: The stream, or None if there is none for the quality
+    """
+    if only_audio:
+        if quality == "highest":
+            return yt.streams.get_audio_only()
+        return yt.streams.filter(only_audio=True, abr=quality).first()
+    if quality == "highest":
+        stream = yt.streams.get_highest_resolution()
+    else:
+        stream = yt.streams.filter(progressive=True, res=quality, file_extension="mp4").first()
+    if not stream:
+        stream = yt.streams.filter(adaptive=True, res=quality, mime_type="video/mp4").first()
+    return stream
+
+
+def link_expiry(url : str, resolved_at=None):
+    """
+    The Unix time at which a signed stream URL stops working.
+    Read from the URL's `expire` parameter, or DEFAULT_LINK_TTL after `resolved_at`.
+    """
+    try:
+        return float(parse_qs(urlparse(url).query)["expire"][0])
+    except (KeyError, IndexError, ValueError):
+        return (resolved_at if resolved_at is not None else time.time()) + DEFAULT_LINK_TTL
+
+
+def is_expired(entry, now=None, margin=URL_EXPIRY_MARGIN):
+    """True if the entry has no link, or its link expires within `margin` seconds."""
+    if not entry["link"]:
+        return True
+    now = now if now is not None else time.time()
+    return entry["expires_at"] - margin <= now
+
+
+def _file_name(index, title, stream, only_audio):
+    if only_audio:
+        ext = ".m4a" if stream.subtype == "mp4" else f".{stream.subtype}"
+    else:
+        ext = ".mp4"
+    return f"{index:03d} - {safe_filename(title or 'video')}{ext}"
+
+
+class LinkBatch:
+    """
+    Direct links for a list of video URLs at one quality.
+    Entries are dicts in input order: index, url, title, link, file_name,
+    itag, has_audio (False for video-only adaptive links), expires_at and error.
+    """
+
+    def __init__(self, urls, quality, only_audio=False, workers=DEFAULT_WORKERS):
+        """
+        :param urls: Video URLs, e.g. LazyPlaylist.load_all()
+        :param quality: Resolution, bitrate or "highest", for every entry
+        :param only_audio: Resolve audio streams instead of video
+        :param workers: Number of entries resolved at the same time
+        """
+        self.quality = quality
+        self.only_audio = only_audio
+        self.workers = workers
+        self.entries = [
+            {"index": i, "url": url, "title": None, "link": None, "file_name": None,
+             "itag": None, "has_audio": None, "expires_at": None, "error": None}
+            for i, url in enumerate(urls, 1)
+        ]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def matches(self, quality, only_audio=False):
+        """True if the batch was made for this quality and stream type."""
+        return self.quality == quality and self.only_audio == only_audio
+
+    def stale(self, now=None):
+        """Entries that need (re-)resolving: failed, not yet resolved, or expired."""
+        now = now if now is not None else time.time()
+        return [entry for entry in self.entries if is_expired(entry, now)]
+
+    @property
+    def ready(self):
+        """Entries with a link that is still valid."""
+        now = time.time()
+        return [entry for entry in self.entries if not is_expired(entry, now)]
+
+    @property
+    def failed(self):
+        return [entry for entry in self.entries if entry["error"]]
+
+    @property
+    def expires_at(self):
+        """When the first valid link expires, or None if there are none."""
+        return min((entry["expires_at"] for entry in self.ready), default=None)
+
+    def get(self, url : str):
+        """The entry for a video URL if its link is still valid, else None."""
+        video_id = video_id_from_url(url)
+        now = time.time()
+        for entry in self.entries:
+            same = entry["url"] == url or (video_id is not None and video_id_from_url(entry["url"]) == video_id)
+            if same and not is_expired(entry, now):
+                return entry
+        return None
+
+    def _resolve_entry(self, entry):
+        if entry["link"]:
+            # The cached stream catalog carries the same expired signatures
+            video_id = video_id_from_url(entry["url"])
+            if video_id:
+                metadata_cache.invalidate(video_id)
+        resolved_at = time.time()
+        try:
+            yt = safe_youtube(entry["url"])
+            entry["title"] = yt.title
+            stream = select_link_stream(yt, self.quality, self.only_audio)
+            if stream is None:
+                raise RuntimeError(f"No stream found for {self.quality}.")
+            entry.update(
+                link=stream.url, itag=stream.itag, error=None,
+                has_audio=self.only_audio or stream.includes_audio_track,
+                file_name=_file_name(entry["index"], entry["title"], stream, self.only_audio),
+                expires_at=link_expiry(stream.url, resolved_at),
+            )
+        except Exception as e:
+            logging.warning("Failed to resolve link for %s: %s", entry["url"], e)
+            entry.update(link=None, expires_at=None, error=str(e))
+        return entry
+
+    def resolve(self, on_item_done=None):
+        """
+        Resolves every stale entry in parallel; valid links are kept as they are.
+        :param on_item_done: Optional callback (done_count, total, entry), called from this thread
+        :return: The number of entries that were resolved
+        :rtype: int
+        """
+        stale = self.stale()
+        if not stale:
+            return 0
+        with phase("link_batch", kind="audio" if self.only_audio else "video"), \
+                ThreadPoolExecutor(max_workers=max(1, self.workers), thread_name_prefix="links") as pool:
+            futures = [pool.submit(self._resolve_entry, entry) for entry in stale]
+            for done, future in enumerate(as_completed(futures), 1):
+                entry = future.result()
+                if on_item_done:
+                    on_item_done(done, len(stale), entry)
+        return len(stale)
+
+    def to_url_list(self):
+        """Valid links, one per line, in playlist order."""
+        return "".join(f"{entry['link']}\n" for entry in self.ready)
+
+    def to_aria2(self):
+        """
+        Valid links as an aria2 input file (`aria2c -i links.txt`), with output file names.
+        """
+        return "".join(f"{entry['link']}\n  out={entry['file_name']}\n" for entry in self.ready)
+
+
+EXPORT_FORMATS = {
+    "urls": {"ext": ".txt", "render": LinkBatch.to_url_list},
+    "aria2": {"ext": ".aria2.txt", "render": LinkBatch.to_aria2},
+}
@@ -1,24 +1,52 @@
 """
     YoutubeDownloader class for downloading YouTube videos and audio,
     handling both progressive and adaptive streams with FFmpeg merging.
+    This module is UI-free: status messages go to an `on_message` callback
+    and progress to any object with a `.progress(percent, text=...)` method.
     Author: Mohammad Javad Majlesi
 """
 
 # imports dependencies
 from pytubefix import YouTube, Playlist
-import streamlit as st
 import subprocess
-import os, re, time, io, shutil, tempfile, uuid, logging
+import os, re, time, io, shutil, tempfile, uuid, logging, copy
 from src.Safe import safe_filename, safe_youtube, is_playlist_url
+from src.transfer import (parallel_download, resumable_download, partial_path, partial_lock, discard_partial,
+                          fetch_range_with_retry, StreamUrl, TransferError, DEFAULT_CONNECTIONS)
+from src.cache import metadata_cache
+from src.merge import merge_streams, ffmpeg_available, MergeError
+from src.buffers import SpooledBuffer, DEFAULT_SPOOL_THRESHOLD, share_buffer, release_buffer
+from src.playlist import LazyPlaylist
+from src.artifact_cache import artifact_cache
+from src.metrics import phase, DOWNLOADS_IN_FLIGHT, CLIP_BYTES_SKIPPED
+from src.transcode import transcode_stream, needs_transcode, TranscodeError, DEFAULT_BITRATE
+from src.singleflight import in_flight
+from src.scheduler import scheduler
+from src.links import select_link_stream
+from src.clip import read_index, index_range, trim, format_timestamp, ClipError
+from concurrent.futures import ThreadPoolExecutor
 
 
 class YoutubeDownloader:
-    def __init__(self, url : str):
+    def __init__(self, url : str, connections=DEFAULT_CONNECTIONS, chunk_size=None, use_cache=True,
+                 resume_min_size=DEFAULT_SPOOL_THRESHOLD, on_message=None, session=None):
         """
         YoutubeDownloader constructor.
         :param url: The URL of the YouTube video or playlist
+        :param on_message: Optional callback (level, text) for status messages; level is "info" or "error"
+        :param connections: Number of parallel connections per download
+        :param chunk_size: Size of each ranged request in bytes, defaults to pytubefix's range size
+        :param use_cache: Serve and store finished files in the on-disk artifact cache
+        :param resume_min_size: Streams at least this large are downloaded resumably; None disables resuming
+        :param session: Identifies the user for bandwidth limits and fair scheduling (see src.scheduler)
         """
         self.url = url
+        self.connections = connections
+        self.chunk_size = chunk_size
+        self.use_cache = use_cache
+        self.resume_min_size = resume_min_size
+        self.on_message = on_message
+        self.session = session
         self.st_progress_bar = None
         self.last_percent = 0
         self.is_playlist = is_playlist_url(self.url)
@@ -27,22 +55,37 @@ class YoutubeDownloader:
         
         if self.is_playlist:
             try:
-                self.pl = Playlist(self.url)
-                # Fetch first video to get a 'yt' object for info
-                # We also need .videos for the new playlist logic
-                st.write(f"Loading playlist... found {len(self.pl.videos)} videos.")
-                self.yt = self.pl.videos[0] 
+                # Entries are enumerated and resolved lazily; only the first
+                # page is fetched here, and only the first video is resolved
+                self.pl = LazyPlaylist(self.url)
+                self.pl.prefetch(self.pl.page(0))
+                self._notify("info", f"Loading playlist... {self.pl.title}")
+                self.yt = self.pl.video(0)
             except Exception as e:
-                st.error(f"❌ Failed to load playlist: {e}")
+                self._notify("error", f"❌ Failed to load playlist: {e}")
                 self.pl = None
         else:
             try:
                 self.yt = safe_youtube(self.url)
             except Exception as e:
-                st.error(f"❌ Failed to load video: {e}")
+                self._notify("error", f"❌ Failed to load video: {e}")
                 self.yt = None
 
 
+    def _notify(self, level, text):
+        """
+        Reports a status message to the UI callback, or to the log when there is none.
+        :param level: "info" or "error"
+        :param text: The message
+        """
+        if self.on_message:
+            self.on_message(level, text)
+        elif level == "error":
+            logging.error(text)
+        else:
+            logging.info(text)
+
+
     def on_progress(self, stream , chunk: bytes, bytes_remaining: int):
         """
         Progress callback for pytube.
@@ -66,155 +109,533 @@ class YoutubeDownloader:
             self.st_progress_bar.progress(percent, text=f"Downloading... {percent}%")
 
 
-    def Download(self, quality, st_progress_bar=None):
+    def _span_progress(self, size):
+        """Progress callback for a transfer of `size` bytes that is only part of a stream."""
+        def report(stream, chunk, bytes_remaining):
+            if not self.st_progress_bar or size <= 0:
+                return
+            percent = int((size - bytes_remaining) / size * 100)
+            if percent > self.last_percent:
+                self.last_percent = percent
+                self.st_progress_bar.progress(percent, text=f"Downloading clip... {percent}%")
+        return report
+
+
+    def _refresh_stream_url(self, stream):
+        """
+        Re-resolves the video after YouTube rejected an expired stream URL.
+        :return: A fresh signed URL for the same itag
+        :rtype: str
+        """
+        metadata_cache.invalidate(self.yt.video_id)
+        self.yt = safe_youtube(self.yt.watch_url)
+        fresh = self.yt.streams.get_by_itag(stream.itag)
+        if fresh is None:
+            raise TransferError(f"Stream {stream.itag} is no longer available.")
+        return fresh.url
+
+    def _is_resumable(self, stream):
+        size = getattr(stream, 'filesize', 0) or 0
+        return self.resume_min_size is not None and size > 0 and size >= self.resume_min_size
+
+    def _transfer(self, stream, output, report_progress=True):
+        """
+        Downloads a stream into `output` over parallel ranged connections.
+        Large streams also keep a resumable partial file on disk; see `_transfer_to_file`.
+        :param stream: The stream to download
+        :param output: A writable binary file object
+        :param report_progress: Whether to drive the progress bar from this transfer
+        :return: The number of bytes written
+        :rtype: int
+        """
+        if self._is_resumable(stream):
+            self._transfer_to_file(stream, output, report_progress)
+            return stream.filesize
+        return parallel_download(
+            stream, output,
+            connections=self.connections,
+            chunk_size=self.chunk_size,
+            on_progress=self.on_progress if report_progress else None,
+            refresh_url=lambda: self._refresh_stream_url(stream),
+            session=self.session
+        )
+
+    def _transfer_to_file(self, stream, output=None, report_progress=True):
+        """
+        Downloads a stream to its stable partial path, resuming an earlier attempt if there is one.
+        :param output: Optional file object that also receives the bytes in order
+        :return: The path of the complete file
+        :rtype: str
+        """
+        return resumable_download(
+            stream, partial_path(self.yt.video_id, stream.itag), output,
+            connections=self.connections,
+            chunk_size=self.chunk_size,
+            on_progress=self.on_progress if report_progress else None,
+            refresh_url=lambda: self._refresh_stream_url(stream),
+            session=self.session
+        )
+
+    def _download_single(self, stream, fmt):
+        """
+        Downloads one progressive or audio stream into a result buffer and caches it.
+        Large streams go through a resumable partial file that becomes the result.
+        :rtype: SpooledBuffer
+        """
+        if self._is_resumable(stream):
+            # Held until the file is handed off, so no other worker replays or discards it meanwhile
+            with partial_lock(partial_path(self.yt.video_id, stream.itag)):
+                path = self._transfer_to_file(stream)
+                with phase("handoff", storage="file"):
+                    cached_path = artifact_cache.put_file(self.yt.video_id, stream.itag, fmt, path, move=True) if self.use_cache else None
+                    if cached_path:
+                        return SpooledBuffer.from_file(cached_path, owned=False)
+                    # The buffer removes its file on close; give it one nobody else will open
+                    private_path = os.path.join(tempfile.gettempdir(), f"single_{uuid.uuid4().hex}")
+                    os.replace(path, private_path)
+                    return SpooledBuffer.from_file(private_path)
+
+        buffer = SpooledBuffer()
+        self._transfer(stream, buffer)
+        with phase("handoff", storage="buffer"):
+            buffer.seek(0)
+            self._to_cache(stream.itag, fmt, buffer)
+        return buffer
+
+
+    def _single_flight(self, itags, fmt, work):
+        """
+        Runs `work` once per (video, itags, format) in this process. Identical
+        requests from other sessions that arrive meanwhile attach to it, get its
+        progress and messages, and receive their own buffer over the same result.
+        :param work: Callable taking a private copy of this downloader, returning the result buffer
+        :rtype: SpooledBuffer | None
+        """
+        itags = tuple(itags) if isinstance(itags, (list, tuple)) else (itags,)
+
+        def _run(progress, notify):
+            # The shared work must not use the caller's progress bar or callbacks:
+            # the caller may leave while the others still wait for the result
+            worker = copy.copy(self)
+            worker.st_progress_bar = progress
+            worker.last_percent = 0
+            worker.on_message = notify
+            with scheduler.transfer_slot(worker.session):
+                return work(worker)
+
+        return in_flight.run(
+            (self.yt.video_id, itags, fmt), _run,
+            progress=self.st_progress_bar,
+            on_message=self._notify,
+            share=share_buffer,
+            release=release_buffer
+        )
+
+    def _from_cache(self, itags, fmt):
+        """
+        Returns a finished artifact from the on-disk cache without touching the network.
+        :return: A read-only buffer over the cached file, or None on a miss
+        :rtype: SpooledBuffer | None
+        """
+        if not self.use_cache:
+            return None
+        buffer = artifact_cache.open(self.yt.video_id, itags, fmt)
+        if buffer is not None and self.st_progress_bar:
+            self.st_progress_bar.progress(100, text="Loaded from cache! ✅")
+        return buffer
+
+    def _to_cache(self, itags, fmt, buffer):
+        """Stores a finished buffer in the artifact cache."""
+        if self.use_cache:
+            artifact_cache.put_buffer(self.yt.video_id, itags, fmt, buffer)
+
+
+    @phase("select", kind="progressive")
+    def select_progressive_stream(self, quality):
+        """
+        Picks the progressive (audio + video) MP4 stream for a quality.
+        :param quality: A resolution such as "720p", or "highest"
+        :return: The stream, or None if the quality is only available as adaptive streams
+        """
+        if quality == "highest":
+            return self.yt.streams.get_highest_resolution()
+        return self.yt.streams.filter(progressive=True, res=quality, file_extension="mp4").first()
+
+    @phase("select", kind="adaptive")
+    def select_adaptive_streams(self, quality):
+        """
+        Picks the adaptive MP4 video stream for a quality and the best MP4 audio stream.
+        :return: (video_stream, audio_stream); either may be None
+        :rtype: tuple
+        """
+        video_stream = self.yt.streams.filter(adaptive=True, res=quality, mime_type="video/mp4").first()
+        audio_stream = self.yt.streams.filter(adaptive=True, mime_type="audio/mp4").order_by("abr").desc().first()
+        return video_stream, audio_stream
+
+    @phase("select", kind="audio")
+    def select_audio_stream(self, quality, file_extension=None):
+        """
+        Picks the audio stream for a bitrate, falling back to the default audio stream.
+        :param quality: A bitrate such as "128kbps", or "highest"
+        :param file_extension: Only pick streams in this container, e.g. "mp4"; the default (fallback) stream always is mp4
+        :return: The stream, or None if the video has no audio streams
+        """
+        if quality == "highest":
+            stream = self.yt.streams.get_audio_only()
+        else:
+             stream = self.yt.streams.filter(only_audio=True, abr=quality, file_extension=file_extension).first()
+             
+        if not stream:
+            self._notify("error", f"❌ No audio stream found for {quality}. Falling back to default.")
+            stream = self.yt.streams.get_audio_only()
+            if not stream:
+                self._notify("error", "❌ No audio streams found at all.")
+        return stream
+
+
+    @DOWNLOADS_IN_FLIGHT.track_inprogress(kind="video")
+    @phase("download", kind="video")
+    def Download(self, quality, st_progress_bar=None, merger=None):
         """
         Downloads the video at the specified quality.
         :param quality: The quality of the video to download
         :type quality: str
         :param st_progress_bar: The Streamlit progress bar to update, defaults to None
-        :type st_progress_bar: st.progress, optional
-        :return: The downloaded video as a BytesIO buffer
-        :rtype: io.BytesIO
+        :type st_progress_bar: st.progress or any object with a .progress(percent, text=...) method, optional
+        :param merger: How adaptive tracks are merged: "ffmpeg" or "remux" (see src.merge), defaults to YTD_MERGER
+        :return: The downloaded video, spilled to disk if large
+        :rtype: SpooledBuffer
         """
         if not self.yt:
-            st.error("❌ No video object available to download.")
+            self._notify("error", "❌ No video object available to download.")
             return None
             
-        # Register progress bar and reset percent
+        # Register progress bar and reset percent.
+        # Progress goes through the transfer engine, not the YouTube object,
+        # because cached YouTube objects are shared between sessions.
         self.st_progress_bar = st_progress_bar
         self.last_percent = 0
-        self.yt.register_on_progress_callback(self.on_progress)
 
-        if quality == "highest":
-            stream = self.yt.streams.get_highest_resolution()
-        else:
-            stream = self.yt.streams.filter(progressive=True, res=quality, file_extension="mp4").first()
+        stream = self.select_progressive_stream(quality)
 
         # Adaptive case (video + audio merge)
         if stream is None:
-            st.write("ℹ️ Selected quality is not progressive, attempting to merge audio/video...")
-            return self._download_adaptive(quality)
+            self._notify("info", "ℹ️ Selected quality is not progressive, attempting to merge audio/video...")
+            return self._download_adaptive(quality, merger)
             
         # Progressive case
         else:
-            buffer = io.BytesIO()
-            stream.stream_to_buffer(buffer)
-            buffer.seek(0)
+            cached = self._from_cache(stream.itag, "mp4")
+            if cached is not None:
+                return cached
+            buffer = self._single_flight(stream.itag, "mp4", lambda d: d._download_single(stream, "mp4"))
             if self.st_progress_bar:
                 self.st_progress_bar.progress(100, text="Download complete! ✅")
             return buffer
 
-    def _download_adaptive(self, quality):
+    def _download_adaptive(self, quality, merger=None):
         """
-        Downloads and merges adaptive video and audio streams using FFmpeg.
+        Downloads adaptive video and audio streams concurrently and merges them with FFmpeg,
+        or with the built-in remuxer. Either way the merge runs while the tracks download.
         :param quality: The quality of the video to download
         :type quality: str
-        :return: The merged video as a BytesIO buffer
-        :rtype: io.BytesIO
+        :param merger: "ffmpeg" or "remux", see `src.merge.merge_streams`
+        :return: The merged video as a disk-backed buffer
+        :rtype: SpooledBuffer
         """
-        video_stream = self.yt.streams.filter(adaptive=True, res=quality, mime_type="video/mp4").first()
-        audio_stream = self.yt.streams.filter(adaptive=True, mime_type="audio/mp4").order_by("abr").desc().first()
+        video_stream, audio_stream = self.select_adaptive_streams(quality)
         
         if not video_stream or not audio_stream:
-            st.error(f"❌ No adaptive streams found for {quality}.")
+            self._notify("error", f"❌ No adaptive streams found for {quality}.")
             return None
 
+        if not ffmpeg_available():
+            self._notify(
+                "info",
+                "ℹ️ FFmpeg is not installed, merging with the built-in remuxer. "
+                "If running on Streamlit Cloud, add 'ffmpeg' to your packages.txt file."
+            )
+            merger = "remux"
+
+        itags = [video_stream.itag, audio_stream.itag]
+        cached = self._from_cache(itags, "mp4")
+        if cached is not None:
+            return cached
+        return self._single_flight(itags, "mp4",
+                                   lambda d: d._merge_adaptive(video_stream, audio_stream, itags, merger))
+
+    def _merge_adaptive(self, video_stream, audio_stream, itags, merger=None):
+        """
+        Streams both tracks into the merger and stores the merged file.
+        :return: The merged video as a disk-backed buffer, or None if the merge failed
+        :rtype: SpooledBuffer
+        """
+        output_path = os.path.join(tempfile.gettempdir(), f"merged_{uuid.uuid4().hex}.mp4")
+
+        try:
+            self._notify("info", "Downloading and merging video and audio tracks...")
+            with scheduler.merge_slot(self.session):
+                merge_streams(
+                    video_stream, audio_stream, output_path,
+                    lambda stream, f, report_progress: self._transfer(stream, f, report_progress),
+                    merger=merger
+                )
+            # Both tracks are complete and merged; their resumable copies are no longer needed
+            for track in (video_stream, audio_stream):
+                if self._is_resumable(track):
+                    discard_partial(partial_path(self.yt.video_id, track.itag))
+
+            # Move the merged file into the cache and serve it from there;
+            # otherwise the buffer owns the file and removes it on close
+            with phase("handoff", storage="file"):
+                cached_path = artifact_cache.put_file(self.yt.video_id, itags, "mp4", output_path, move=True) if self.use_cache else None
+                if cached_path:
+                    buffer = SpooledBuffer.from_file(cached_path, owned=False)
+                else:
+                    buffer = SpooledBuffer.from_file(output_path)
+            output_path = None
+            if self.st_progress_bar:
+                self.st_progress_bar.progress(100, text="Merge complete! ✅")
+            return buffer
+
+        except MergeError as e:
+            logging.error("Merge failed: %s", e)
+            self._notify("error", f"❌ Merge failed: {str(e)[:500]}...")
+            return None
+
+        finally:
+            try:
+                if output_path and os.path.exists(output_path):
+                    os.remove(output_path)
+            except Exception as e:
+                logging.warning(f"Failed to remove temp file {output_path}: {e}")
+
+
+    @DOWNLOADS_IN_FLIGHT.track_inprogress(kind="clip")
+    @phase("download", kind="clip")
+    def DownloadClip(self, quality, start, end, st_progress_bar=None, only_audio=False):
+        """
+        Downloads only the part of the video between two timestamps.
+        Just the fragments covering the window are transferred (see src.clip); FFmpeg
+        then trims them without re-encoding, so the clip starts at a keyframe.
+        :param quality: A resolution such as "720p", or an audio bitrate with `only_audio`
+        :param start: Clip start in seconds
+        :param end: Clip end in seconds
+        :param st_progress_bar: The Streamlit progress bar to update, defaults to None
+        :param only_audio: Clip the audio track only, saved as m4a
+        :return: The clip as a disk-backed buffer
+        :rtype: SpooledBuffer
+        """
+        if not self.yt:
+            self._notify("error", "❌ No video object available to download.")
+            return None
+        length = getattr(self.yt, "length", None)
+        if length:
+            end = min(end, length)
+        if not 0 <= start < end:
+            self._notify("error", "❌ The clip must end after it starts, within the video.")
+            return None
+
+        self.st_progress_bar = st_progress_bar
+        self.last_percent = 0
+
+        if only_audio:
+            # Only fragmented MP4 has a segment index to clip by, and the clip is saved as m4a
+            audio_stream = self.select_audio_stream(quality, file_extension="mp4")
+            if not audio_stream:
+                return None
+            streams = [audio_stream]
+        else:
+            video_stream, audio_stream = self.select_adaptive_streams(quality)
+            if not video_stream or not audio_stream:
+                self._notify("error", f"❌ No adaptive streams found for {quality}.")
+                return None
+            streams = [video_stream, audio_stream]
+
         if shutil.which("ffmpeg") is None:
-            st.error(
-                "❌ FFmpeg is not installed. This quality requires merging audio and video. "
+            self._notify(
+                "error",
+                "❌ FFmpeg is not installed. Cutting clips requires it. "
                 "If running on Streamlit Cloud, add 'ffmpeg' to your packages.txt file."
             )
             return None
 
-        tmpdir = tempfile.gettempdir()
-        vid_name = f"temp_video_{uuid.uuid4().hex}.mp4"
-        aud_name = f"temp_audio_{uuid.uuid4().hex}.mp4"
-        out_name = f"merged_{uuid.uuid4().hex}.mp4"
-        
-        video_path, audio_path, output_path = None, None, None
+        itags = [stream.itag for stream in streams]
+        fmt = f"{'m4a' if only_audio else 'mp4'}-clip-{start:.3f}-{end:.3f}"
+        cached = self._from_cache(itags, fmt)
+        if cached is not None:
+            return cached
+        return self._single_flight(itags, fmt, lambda d: d._clip(streams, start, end, fmt))
 
+    def _clip_track(self, stream, start, end, path, report_progress):
+        """
+        Writes the part of one track that covers [start, end] to `path`: its init
+        segment followed by the covering fragments. A track without a segment
+        index is downloaded whole instead.
+        :return: Seconds FFmpeg must skip from the start of the written file
+        :rtype: float
+        """
+        source = StreamUrl(stream.url, lambda: self._refresh_stream_url(stream))
         try:
-            st.write("Downloading video track...")
-            video_path = video_stream.download(output_path=tmpdir, filename=vid_name, max_retries=3)
-            st.write("Downloading audio track...")
-            audio_path = audio_stream.download(output_path=tmpdir, filename=aud_name, max_retries=3)
-            output_path = os.path.join(tmpdir, out_name)
-
-            st.write("Merging files with FFmpeg...")
-            cmd = [
-                "ffmpeg", "-y",
-                "-i", video_path,
-                "-i", audio_path,
-                "-c", "copy",
-                output_path
-            ]
-            
-            proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            
-            if proc.returncode != 0:
-                logging.error("FFmpeg merge failed: %s", proc.stderr)
-                st.error(f"❌ FFmpeg failed: {proc.stderr[:500]}...")
-                return None
+            index = read_index(
+                lambda first, last: fetch_range_with_retry(source, first, last, session=self.session),
+                filesize=getattr(stream, 'filesize', 0), index_end=index_range(self.yt, stream.itag)
+            )
+        except ClipError as e:
+            logging.info("No usable segment index for itag %s (%s); downloading the whole track", stream.itag, e)
+            with open(path, "wb") as f:
+                self._transfer(stream, f, report_progress)
+            if self._is_resumable(stream):
+                discard_partial(partial_path(self.yt.video_id, stream.itag))
+            return start
+        stream.url = source.url
+        first, last, skip = index.span(start, end)
 
-            with open(output_path, "rb") as f:
-                file_data = f.read()
-                
-            buffer = io.BytesIO(file_data)
-            buffer.seek(0)
+        with open(path, "wb") as f:
+            f.write(index.init)
+            parallel_download(
+                stream, f,
+                connections=self.connections,
+                chunk_size=self.chunk_size,
+                on_progress=self._span_progress(last - first + 1) if report_progress else None,
+                refresh_url=lambda: self._refresh_stream_url(stream),
+                session=self.session,
+                span=(first, last)
+            )
+        filesize = getattr(stream, 'filesize', 0) or 0
+        if filesize:
+            CLIP_BYTES_SKIPPED.inc(max(0, filesize - len(index.init) - (last - first + 1)))
+        return skip
+
+    def _clip(self, streams, start, end, fmt):
+        """
+        Fetches the clip's part of every track at the same time and trims them with FFmpeg.
+        The first track reports progress from this thread, like `_merge_adaptive`.
+        :return: The clip as a disk-backed buffer, or None if FFmpeg failed
+        :rtype: SpooledBuffer
+        """
+        workdir = tempfile.mkdtemp(prefix="ytclip_")
+        output_path = os.path.join(tempfile.gettempdir(), f"clip_{uuid.uuid4().hex}.{fmt.split('-')[0]}")
+        try:
+            self._notify("info", f"Downloading {format_timestamp(start)}-{format_timestamp(end)}...")
+            paths = [os.path.join(workdir, f"{i}.{stream.subtype}") for i, stream in enumerate(streams)]
+            with ThreadPoolExecutor(max_workers=len(streams), thread_name_prefix="clip") as pool:
+                others = [pool.submit(self._clip_track, stream, start, end, path, False)
+                          for stream, path in zip(streams[1:], paths[1:])]
+                skips = [self._clip_track(streams[0], start, end, paths[0], True)] + [f.result() for f in others]
+
+            specs = ["a:0"] if len(streams) == 1 else ["v:0", "a:0"]
+            with scheduler.merge_slot(self.session):
+                trim(list(zip(paths, skips, specs)), output_path, end - start)
+
+            with phase("handoff", storage="file"):
+                cached_path = artifact_cache.put_file(self.yt.video_id, [s.itag for s in streams], fmt, output_path,
+                                                      move=True) if self.use_cache else None
+                buffer = SpooledBuffer.from_file(cached_path, owned=False) if cached_path else SpooledBuffer.from_file(output_path)
+            output_path = None
             if self.st_progress_bar:
-                self.st_progress_bar.progress(100, text="Merge complete! ✅")
+                self.st_progress_bar.progress(100, text="Clip complete! ✅")
             return buffer
-            
+
+        except ClipError as e:
+            logging.error("Clip failed: %s", e)
+            self._notify("error", f"❌ Could not cut the clip: {str(e)[:500]}")
+            return None
+
         finally:
-            # Cleanup temp files
-            for _f in [video_path, audio_path, output_path]:
-                try:
-                    if _f and os.path.exists(_f):
-                        os.remove(_f)
-                except Exception as e:
-                    logging.warning(f"Failed to remove temp file {_f}: {e}")
+            shutil.rmtree(workdir, ignore_errors=True)
+            try:
+                if output_path and os.path.exists(output_path):
+                    os.remove(output_path)
+            except Exception as e:
+                logging.warning(f"Failed to remove temp file {output_path}: {e}")
 
 
-    def DownloadAudio(self, quality, st_progress_bar=None):
+    @DOWNLOADS_IN_FLIGHT.track_inprogress(kind="audio")
+    @phase("download", kind="audio")
+    def DownloadAudio(self, quality, st_progress_bar=None, audio_format="m4a", bitrate=DEFAULT_BITRATE):
         """
         Downloads the audio at the specified quality.
         :param quality: The quality of the audio to download
         :type quality: str
         :param st_progress_bar: The Streamlit progress bar to update, defaults to None
-        :type st_progress_bar: st.progress, optional
-        :return: The downloaded audio as a BytesIO buffer
-        :rtype: io.BytesIO
+        :type st_progress_bar: st.progress or any object with a .progress(percent, text=...) method, optional
+        :param audio_format: "m4a" for the stream as downloaded, or a format from `src.transcode.AUDIO_FORMATS`
+        :param bitrate: Target bitrate when transcoding, e.g. "192k"
+        :return: The downloaded audio, spilled to disk if large
+        :rtype: SpooledBuffer
         """
         if not self.yt:
-            st.error("❌ No video object available to download audio.")
+            self._notify("error", "❌ No video object available to download audio.")
             return None
 
-        # Register progress bar and reset percent
+        # Register progress bar and reset percent.
+        # Progress goes through the transfer engine, not the YouTube object,
+        # because cached YouTube objects are shared between sessions.
         self.st_progress_bar = st_progress_bar
         self.last_percent = 0
-        self.yt.register_on_progress_callback(self.on_progress)
 
-        if quality == "highest":
-            stream = self.yt.streams.get_audio_only()
-        else:
-             stream = self.yt.streams.filter(only_audio=True, abr=quality).first()
-             
+        stream = self.select_audio_stream(quality)
         if not stream:
-            st.error(f"❌ No audio stream found for {quality}. Falling back to default.")
-            stream = self.yt.streams.get_audio_only()
-            if not stream:
-                st.error("❌ No audio streams found at all.")
-                return None
+            return None
+
+        if needs_transcode(audio_format):
+            return self._download_transcoded(stream, audio_format, bitrate)
 
-        buffer = io.BytesIO()
-        stream.stream_to_buffer(buffer)
-        buffer.seek(0)
+        cached = self._from_cache(stream.itag, "m4a")
+        if cached is not None:
+            return cached
+
+        buffer = self._single_flight(stream.itag, "m4a", lambda d: d._download_single(stream, "m4a"))
         
         if self.st_progress_bar:
             self.st_progress_bar.progress(100, text="Download complete! ✅")
         return buffer
         
 
+    def _download_transcoded(self, stream, audio_format, bitrate):
+        """
+        Downloads an audio stream straight into an FFmpeg encoder, so encoding overlaps the transfer.
+        :return: The encoded audio as a disk-backed buffer
+        :rtype: SpooledBuffer
+        """
+        if shutil.which("ffmpeg") is None:
+            self._notify(
+                "error",
+                f"❌ FFmpeg is not installed. Converting audio to {audio_format.upper()} requires it. "
+                "If running on Streamlit Cloud, add 'ffmpeg' to your packages.txt file."
+            )
+            return None
+
+        cache_fmt = f"{audio_format}-{bitrate}"
+        cached = self._from_cache(stream.itag, cache_fmt)
+        if cached is not None:
+            return cached
+        return self._single_flight(stream.itag, cache_fmt, lambda d: d._transcode(stream, audio_format, bitrate, cache_fmt))
+
+    def _transcode(self, stream, audio_format, bitrate, cache_fmt):
+        """
+        Runs the transcode and stores the encoded file.
+        :return: The encoded audio as a disk-backed buffer, or None if FFmpeg failed
+        :rtype: SpooledBuffer
+        """
+        try:
+            path = transcode_stream(lambda f: self._transfer(stream, f), audio_format, bitrate)
+        except TranscodeError as e:
+            logging.error("FFmpeg transcode failed: %s", e)
+            self._notify("error", f"❌ FFmpeg failed: {str(e)[:500]}...")
+            return None
+        if self._is_resumable(stream):
+            discard_partial(partial_path(self.yt.video_id, stream.itag))
+
+        with phase("handoff", storage="file"):
+            cached_path = artifact_cache.put_file(self.yt.video_id, stream.itag, cache_fmt, path, move=True) if self.use_cache else None
+            buffer = SpooledBuffer.from_file(cached_path, owned=False) if cached_path else SpooledBuffer.from_file(path)
+        if self.st_progress_bar:
+            self.st_progress_bar.progress(100, text="Conversion complete! ✅")
+        return buffer
+
+
     def get_video_qualities(self):
 
         """
@@ -257,21 +678,7 @@ class YoutubeDownloader:
             return None, "Video object not loaded."
             
         try:
-            if only_audio:
-                if quality == 'highest':
-                    stream = self.yt.streams.get_audio_only()
-                else:
-                    stream = self.yt.streams.filter(only_audio=True, abr=quality).first()
-            else:
-                if quality == "highest":
-                    stream = self.yt.streams.get_highest_resolution()
-                else:
-                    # Try progressive first
-                    stream = self.yt.streams.filter(progressive=True, res=quality, file_extension="mp4").first()
-                
-                if not stream: # Try adaptive
-                    stream = self.yt.streams.filter(adaptive=True, res=quality, mime_type="video/mp4").first()
-            
+            stream = select_link_stream(self.yt, quality, only_audio)
             if stream:
                 return stream.url, None
             else:
@@ -0,0 +1,189 @@
+"""
+    Merge helpers for adaptive (video-only + audio-only) streams.
+    Both tracks are fetched at the same time; on POSIX they are fed to FFmpeg
+    through named pipes so the merge runs while the tracks download. The
+    built-in remuxer (src.remux) can merge them without FFmpeg instead.
+    Choose the default with YTD_MERGER ("ffmpeg" or "remux").
+"""
+
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from src.metrics import phase, MERGE_TAIL_SECONDS, REMUX_FALLBACKS
+from src.remux import remux_merge, RemuxError
+
+MERGERS = ("ffmpeg", "remux")
+
+
+class MergeError(Exception):
+    """Raised when FFmpeg fails to merge the audio and video tracks."""
+
+
+def ffmpeg_merge_cmd(video_path : str, audio_path : str, output_path : str):
+    """
+    Builds the FFmpeg command that muxes one video and one audio input without re-encoding.
+    :return: The command as an argument list
+    :rtype: list[str]
+    """
+    return [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-i", video_path,
+        "-i", audio_path,
+        "-map", "0:v:0", "-map", "1:a:0",
+        "-c", "copy",
+        output_path
+    ]
+
+
+def _release_fifos(proc, fifos):
+    """
+    Waits for FFmpeg to exit, then briefly opens each FIFO for reading.
+    A writer still blocked in open() is released and then sees a broken pipe
+    instead of hanging forever when FFmpeg died before opening its inputs.
+    """
+    proc.wait()
+    for fifo in fifos:
+        try:
+            fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+            os.close(fd)
+        except OSError:
+            pass
+
+
+def _feed(download, stream, path, report_progress, errors, on_error=None):
+    """Downloads one track into `path` and records any failure in `errors`."""
+    try:
+        with open(path, "wb") as f:
+            download(stream, f, report_progress)
+    except BrokenPipeError:
+        errors.append(MergeError("FFmpeg stopped reading its input."))
+    except Exception as e:
+        errors.append(e)
+    if errors and on_error:
+        on_error()
+
+
+def _stderr_text(stderr_file):
+    stderr_file.seek(0)
+    return stderr_file.read().decode("utf-8", errors="replace")
+
+
+def pipelined_merge(video_stream, audio_stream, output_path : str, download):
+    """
+    Downloads both tracks concurrently straight into FFmpeg through named pipes.
+    The video track is fetched on the calling thread so its progress callback
+    runs there; the audio track is fetched on a helper thread.
+    :param video_stream: The adaptive video stream
+    :param audio_stream: The adaptive audio stream
+    :param output_path: Where FFmpeg writes the merged file
+    :param download: Callable (stream, fileobj, report_progress) that writes a stream into fileobj
+    :raises MergeError: If FFmpeg fails
+    """
+    workdir = tempfile.mkdtemp(prefix="ytmerge_")
+    video_fifo = os.path.join(workdir, "video.mp4")
+    audio_fifo = os.path.join(workdir, "audio.mp4")
+    os.mkfifo(video_fifo)
+    os.mkfifo(audio_fifo)
+
+    errors = []
+    with tempfile.TemporaryFile() as stderr_file:
+        proc = subprocess.Popen(
+            ffmpeg_merge_cmd(video_fifo, audio_fifo, output_path),
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr_file
+        )
+        try:
+            threading.Thread(target=_release_fifos, args=(proc, [video_fifo, audio_fifo]), daemon=True).start()
+            audio_thread = threading.Thread(
+                target=_feed, args=(download, audio_stream, audio_fifo, False, errors, proc.kill), daemon=True
+            )
+            audio_thread.start()
+            _feed(download, video_stream, video_fifo, True, errors, proc.kill)
+            audio_thread.join()
+            inputs_done = time.perf_counter()
+            returncode = proc.wait()
+            MERGE_TAIL_SECONDS.observe(time.perf_counter() - inputs_done)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        # A download error is more useful than the broken pipe it caused
+        real_errors = [e for e in errors if not isinstance(e, MergeError)]
+        if real_errors:
+            raise real_errors[0]
+        if returncode != 0 or errors:
+            raise MergeError(_stderr_text(stderr_file) or str(errors[0]))
+
+
+def concurrent_merge(video_stream, audio_stream, output_path : str, download):
+    """
+    Fallback for platforms without named pipes (Windows): both tracks are
+    downloaded concurrently to temp files and merged once both are complete.
+    Arguments are the same as `pipelined_merge`.
+    """
+    workdir = tempfile.mkdtemp(prefix="ytmerge_")
+    video_path = os.path.join(workdir, "video.mp4")
+    audio_path = os.path.join(workdir, "audio.mp4")
+    errors = []
+    try:
+        audio_thread = threading.Thread(
+            target=_feed, args=(download, audio_stream, audio_path, False, errors), daemon=True
+        )
+        audio_thread.start()
+        _feed(download, video_stream, video_path, True, errors)
+        audio_thread.join()
+        if errors:
+            raise errors[0]
+
+        inputs_done = time.perf_counter()
+        proc = subprocess.run(
+            ffmpeg_merge_cmd(video_path, audio_path, output_path),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+        )
+        MERGE_TAIL_SECONDS.observe(time.perf_counter() - inputs_done)
+        if proc.returncode != 0:
+            raise MergeError(proc.stderr)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def ffmpeg_available():
+    """Whether an FFmpeg binary is on the PATH."""
+    return shutil.which("ffmpeg") is not None
+
+
+def merge_streams(video_stream, audio_stream, output_path : str, download, merger=None):
+    """
+    Merges two adaptive streams, pipelining through FIFOs where the OS supports them.
+    The "merge" phase includes the track downloads; `ytd_merge_tail_seconds` is the merger alone.
+    :param merger: "ffmpeg" or "remux", defaults to YTD_MERGER. Tracks the remuxer cannot
+        handle fall back to FFmpeg; without FFmpeg the remuxer is always used.
+    :raises MergeError: If the merge fails
+    """
+    merger = merger or DEFAULT_MERGER
+    if merger not in MERGERS:
+        raise ValueError(f"Unknown merger {merger!r}, expected one of {', '.join(MERGERS)}")
+    if merger == "remux" or not ffmpeg_available():
+        try:
+            with phase("merge", mode="remux"):
+                return remux_merge(video_stream, audio_stream, output_path, download)
+        except RemuxError as e:
+            if not ffmpeg_available():
+                raise MergeError(f"{e}; merging these tracks needs FFmpeg") from e
+            # Remux errors show up in the first bytes, before much was transferred
+            logging.warning("Remux failed, merging with FFmpeg instead: %s", e)
+            REMUX_FALLBACKS.inc()
+    if hasattr(os, "mkfifo"):
+        with phase("merge", mode="pipe"):
+            return pipelined_merge(video_stream, audio_stream, output_path, download)
+    with phase("merge", mode="files"):
+        return concurrent_merge(video_stream, audio_stream, output_path, download)
+
+
+DEFAULT_MERGER = os.environ.get("YTD_MERGER", "ffmpeg")
@@ -0,0 +1,452 @@
+"""
+    Process-wide download metrics.
+    Counters, gauges and histograms live in one registry and can be exported
+    in the Prometheus text format, either from `render()` or from a small HTTP
+    endpoint (`start_http_server`, or set YTD_METRICS_PORT). Metrics of other
+    processes (e.g. job workers) are merged in through `add_collector`. Every timed phase
+    is also logged as a structured record on the "ytd.metrics" logger;
+    `configure_json_logging` (or YTD_LOG_FORMAT=json) prints those as JSON lines.
+"""
+
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import ContextDecorator
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Seconds: from a cached metadata lookup up to a long merge
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# Bytes per second: 64 KB/s up to 1 GB/s
+THROUGHPUT_BUCKETS = tuple(64 * 1024 * 4 ** i for i in range(8))
+
+logger = logging.getLogger("ytd.metrics")
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value : str):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name : str, help : str):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+    def snapshot(self):
+        """Current samples as JSON-serialisable [labels, value] pairs."""
+        return [[list(key), value] for _, key, value in self._samples()]
+
+    def render(self, extra=()):
+        """
+        :param extra: More (label key, value) samples to export, e.g. from another process
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, value in self._samples() + [(self.name, key, value) for key, value in extra]:
+            lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+        return "\n".join(lines)
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_label_key(labels), 0)
+
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. bytes transferred or retries."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class _InProgress(ContextDecorator):
+    def __init__(self, gauge, labels):
+        self._gauge = gauge
+        self._labels = labels
+
+    def _recreate_cm(self):
+        return _InProgress(self._gauge, self._labels)
+
+    def __enter__(self):
+        self._gauge.inc(**self._labels)
+        return self
+
+    def __exit__(self, *exc):
+        self._gauge.dec(**self._labels)
+        return False
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down, e.g. downloads in flight.
+    `set_function` makes a label set read its value from a callable at export time.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name : str, help : str):
+        super().__init__(name, help)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function, **labels):
+        with self._lock:
+            self._functions[_label_key(labels)] = function
+
+    def track_inprogress(self, **labels):
+        """Context manager / decorator that counts the code running inside it."""
+        return _InProgress(self, labels)
+
+    def _samples(self):
+        samples = super()._samples()
+        with self._lock:
+            functions = list(self._functions.items())
+        for key, function in functions:
+            try:
+                samples.append((self.name, key, function()))
+            except Exception:
+                logger.debug("Gauge %s callback failed", self.name, exc_info=True)
+        return samples
+
+    def value(self, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            function = self._functions.get(key)
+        return function() if function else super().value(**labels)
+
+
+class _Timer(ContextDecorator):
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def _recreate_cm(self):
+        # Used as a decorator, every call needs its own start time
+        return _Timer(self._histogram, self._labels)
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._started, **self._labels)
+        return False
+
+
+class Histogram(_Metric):
+    """Observations counted into cumulative buckets, plus their sum and count."""
+
+    kind = "histogram"
+
+    def __init__(self, name : str, help : str, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["buckets"][i] += 1
+                    break
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def time(self, **labels):
+        """Context manager / decorator that observes the seconds spent inside it."""
+        return _Timer(self, labels)
+
+    def value(self, **labels):
+        """The (count, sum) of observations for a label set."""
+        with self._lock:
+            entry = self._values.get(_label_key(labels))
+            return (entry["count"], entry["sum"]) if entry else (0, 0.0)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), {"buckets": list(e["buckets"]), "sum": e["sum"], "count": e["count"]}]
+                    for key, e in self._values.items()]
+
+    def render(self, extra=()):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            entries = [(key, list(e["buckets"]), e["sum"], e["count"]) for key, e in self._values.items()]
+        entries += [(key, e["buckets"], e["sum"], e["count"]) for key, e in extra
+                    if len(e["buckets"]) == len(self.buckets)]
+        for key, buckets, total, count in entries:
+            cumulative = 0
+            for bound, n in zip(self.buckets, buckets):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines)
+
+
+class MetricsRegistry:
+    """Named metrics, created on first use and exported together."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} is already registered as a {metric.kind}")
+            return metric
+
+    def counter(self, name : str, help : str):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name : str, help : str):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name : str, help : str, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def snapshot(self, exclude=()):
+        """
+        Every metric's current samples by name, as JSON-serialisable data for
+        another process to export (see `add_collector`).
+        :param exclude: Names of metrics to leave out
+        :rtype: dict
+        """
+        with self._lock:
+            metrics = [metric for name, metric in self._metrics.items() if name not in exclude]
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def add_collector(self, collect):
+        """
+        Exports samples from elsewhere along with this registry's own.
+        Only metrics this registry also defines are exported.
+        :param collect: Callable returning (labels, snapshot) pairs; every sample
+            of a snapshot is exported with `labels` added, e.g. {"worker": "0"}
+        """
+        with self._lock:
+            self._collectors.append(collect)
+
+    def _collected(self):
+        """Samples of every collector, by metric name."""
+        with self._lock:
+            collectors = list(self._collectors)
+        samples = {}
+        for collect in collectors:
+            try:
+                for labels, snapshot in collect():
+                    for name, entries in snapshot.items():
+                        for key, value in entries:
+                            samples.setdefault(name, []).append((_label_key({**dict(key), **labels}), value))
+            except Exception:
+                logger.debug("Metrics collector failed", exc_info=True)
+        return samples
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format.
+        :rtype: str
+        """
+        collected = self._collected()
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render(collected.get(metric.name, ())) for metric in metrics) + "\n"
+
+
+registry = MetricsRegistry()
+
+PHASE_SECONDS = registry.histogram("ytd_phase_seconds", "Time spent per download phase")
+PHASE_ERRORS = registry.counter("ytd_phase_errors_total", "Failed download phases by exception type")
+TRANSFER_BYTES = registry.counter("ytd_transfer_bytes_total", "Bytes fetched from stream URLs")
+TRANSFER_RESUMED_BYTES = registry.counter("ytd_transfer_resumed_bytes_total", "Bytes reused from partial downloads")
+TRANSFER_RETRIES = registry.counter("ytd_transfer_retries_total", "Byte ranges retried after errors")
+TRANSFER_URL_REFRESHES = registry.counter("ytd_transfer_url_refreshes_total", "Expired stream URLs re-resolved")
+TRANSFER_THROUGHPUT = registry.histogram("ytd_transfer_bytes_per_second", "Throughput of completed transfers",
+                                         buckets=THROUGHPUT_BUCKETS)
+MERGE_TAIL_SECONDS = registry.histogram("ytd_merge_tail_seconds",
+                                        "Time the merger needs after the last input byte arrived")
+REMUX_FALLBACKS = registry.counter("ytd_remux_fallbacks_total", "Merges the remuxer could not do and left to FFmpeg")
+CLIP_BYTES_SKIPPED = registry.counter("ytd_clip_bytes_skipped_total",
+                                    "Stream bytes clips did not transfer because they lie outside the clip")
+TRANSCODE_TAIL_SECONDS = registry.histogram("ytd_transcode_tail_seconds",
+                                            "Time the encoder needs after the last input byte arrived")
+ENCODERS_RUNNING = registry.gauge("ytd_encoders_running", "FFmpeg audio encoders currently running")
+ENCODERS_WAITING = registry.gauge("ytd_encoders_waiting", "Transcodes waiting for a free encoder slot")
+SINGLEFLIGHT_REQUESTS = registry.counter("ytd_singleflight_requests_total",
+                                         "Requests that started (leader) or joined (follower) shared work")
+SINGLEFLIGHT_ACTIVE = registry.gauge("ytd_singleflight_active", "Shared downloads currently running")
+SCHEDULER_QUEUE_DEPTH = registry.gauge("ytd_scheduler_queue_depth", "Requests waiting for bandwidth or a slot")
+SCHEDULER_WAIT_SECONDS = registry.histogram("ytd_scheduler_wait_seconds", "Time spent waiting for bandwidth or a slot")
+RETRIES = registry.counter("ytd_retries_total", "Requests retried, by kind (youtube, range) and error class")
+RETRY_WAIT_SECONDS = registry.histogram("ytd_retry_wait_seconds", "Backoff waited before a retry")
+BREAKER_STATE = registry.gauge("ytd_circuit_breaker_state", "YouTube circuit breaker: 0 closed, 1 half-open, 2 open")
+BREAKER_TRIPS = registry.counter("ytd_circuit_breaker_trips_total", "Times the circuit breaker opened")
+BREAKER_WAIT_SECONDS = registry.histogram("ytd_circuit_breaker_wait_seconds",
+                                          "Time requests waited for the circuit breaker")
+HTTP_REQUESTS = registry.counter("ytd_http_requests_total", "HTTP requests sent through the pooled transport")
+HTTP_CONNECTIONS = registry.gauge("ytd_http_connections", "Pooled transport connections (state=opened since start, or idle)")
+THUMBNAIL_REQUESTS = registry.counter("ytd_thumbnail_requests_total",
+                                      "Thumbnails served, by source (memory, disk, fetch or error)")
+DOWNLOADS_IN_FLIGHT = registry.gauge("ytd_downloads_in_flight", "Downloads currently running")
+BUFFERED_BYTES = registry.gauge("ytd_buffered_bytes", "Bytes held by live result buffers")
+SESSION_BUFFER_BYTES = registry.gauge("ytd_session_buffer_bytes", "Bytes of finished downloads held for UI sessions")
+SESSION_BUFFER_EVICTIONS = registry.counter("ytd_session_buffer_evictions_total",
+                                            "Session buffers spilled to disk or released (spill, drop, idle, dead)")
+JOBS = registry.gauge("ytd_jobs", "Background download jobs by status")
+
+
+class phase(ContextDecorator):
+    """
+    Times one phase of a download into `ytd_phase_seconds{phase=...}`,
+    counts failures in `ytd_phase_errors_total` and logs a structured record.
+    The object bound by `with ... as labels` is a dict; keys added to it
+    inside the block (e.g. labels["cache"] = "hit") become metric labels.
+    """
+
+    def __init__(self, name : str, **labels):
+        self.name = name
+        self.labels = labels
+
+    def _recreate_cm(self):
+        # Used as a decorator, every call needs its own start time and labels
+        return phase(self.name, **self.labels)
+
+    def __enter__(self):
+        self._labels = dict(self.labels)
+        self._started = time.perf_counter()
+        return self._labels
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._started
+        PHASE_SECONDS.observe(seconds, phase=self.name, **self._labels)
+        if exc_type is not None:
+            PHASE_ERRORS.inc(phase=self.name, error=exc_type.__name__, **self._labels)
+        logger.info(
+            "%s %s in %.3fs", self.name, "failed" if exc_type else "done", seconds,
+            extra={"event": "phase", "phase": self.name, "seconds": round(seconds, 6),
+                   "ok": exc_type is None, "error": exc_type.__name__ if exc_type else None, **self._labels}
+        )
+        return False
+
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats log records as one JSON object per line, including `extra` fields."""
+
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                data[key] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str, ensure_ascii=False)
+
+
+def configure_json_logging(level=logging.INFO):
+    """Sends all logging, including phase records, to stderr as JSON lines."""
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_http_server(port : int, addr="0.0.0.0"):
+    """
+    Serves `registry.render()` at http://addr:port/metrics from a daemon thread.
+    Only one server is started per process; later calls return the running one.
+    :rtype: ThreadingHTTPServer
+    """
+    global _server
+    with _server_lock:
+        if _server is not None:
+            return _server
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        _server = ThreadingHTTPServer((addr, port), Handler)
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, daemon=True, name="metrics-http").start()
+        return _server
+
+
+if os.environ.get("YTD_LOG_FORMAT", "").lower() == "json":
+    configure_json_logging()
+if os.environ.get("YTD_METRICS_PORT"):
+    try:
+        start_http_server(int(os.environ["YTD_METRICS_PORT"]))
+    except OSError as e:
+        # Another process (e.g. a second Streamlit worker) already owns the port
+        logging.warning(f"Metrics endpoint not started: {e}")
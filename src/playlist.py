@@ -0,0 +1,149 @@
+"""
+    Lazy playlist enumeration.
+    Video URLs are pulled from pytubefix's paginated generator only as far as
+    needed, and YouTube objects are resolved on demand, prefetching a page at a
+    time on a small shared thread pool.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pytubefix import Playlist
+from src.Safe import safe_youtube
+from src.metrics import phase
+
+PAGE_SIZE = 20
+PREFETCH_WORKERS = 8
+
+# Shared by every session so prefetching stays bounded process-wide
+_prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="playlist-prefetch")
+
+
+def _resolve(url : str):
+    """Resolves a video URL and loads its player response (metadata and stream catalog)."""
+    return safe_youtube(url)
+
+
+class LazyPlaylist:
+    """
+    A playlist whose entries cost nothing until they are needed.
+    Indices are zero-based; `page(n)` returns the indices of the n-th page.
+    """
+
+    def __init__(self, url : str, page_size=PAGE_SIZE):
+        """
+        :param url: The playlist URL
+        :param page_size: Number of entries per page
+        """
+        self.url = url
+        self.page_size = page_size
+        self.pl = Playlist(url)
+        self._urls = []
+        self._url_iter = None
+        self._exhausted = False
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    @property
+    def title(self):
+        return self.pl.title
+
+    @property
+    def playlist_id(self):
+        return self.pl.playlist_id
+
+    @property
+    def known_count(self):
+        """Number of video URLs enumerated so far."""
+        return len(self._urls)
+
+    @property
+    def is_complete(self):
+        """True once every page of the playlist has been enumerated."""
+        return self._exhausted
+
+    def load_until(self, count : int):
+        """
+        Enumerates video URLs until at least `count` are known or the playlist ends.
+        Only the playlist pages needed for that are fetched.
+        :return: The number of known URLs
+        :rtype: int
+        """
+        with self._lock:
+            if self._exhausted or len(self._urls) >= count:
+                return len(self._urls)
+            with phase("playlist_enumerate"):
+                if self._url_iter is None:
+                    self._url_iter = self.pl.url_generator()
+                while not self._exhausted and len(self._urls) < count:
+                    try:
+                        self._urls.append(next(self._url_iter))
+                    except StopIteration:
+                        self._exhausted = True
+            return len(self._urls)
+
+    def load_all(self):
+        """Enumerates every video URL. Still cheap: no video is resolved."""
+        while not self._exhausted:
+            self.load_until(len(self._urls) + self.page_size)
+        return list(self._urls)
+
+    def video_url(self, index : int):
+        self.load_until(index + 1)
+        return self._urls[index] if index < len(self._urls) else None
+
+    def page(self, page_index : int):
+        """
+        Returns the indices of one page, enumerating URLs as far as needed.
+        :rtype: range
+        """
+        start = page_index * self.page_size
+        end = self.load_until(start + self.page_size)
+        return range(start, min(end, start + self.page_size))
+
+    def prefetch(self, indices):
+        """Starts resolving the given entries in the background."""
+        for index in indices:
+            url = self.video_url(index)
+            if url is None:
+                continue
+            with self._lock:
+                if index not in self._futures:
+                    self._futures[index] = _prefetch_pool.submit(_resolve, url)
+
+    def is_resolved(self, index : int):
+        future = self._futures.get(index)
+        return future is not None and future.done()
+
+    def video(self, index : int, timeout=None):
+        """
+        Returns the resolved YouTube object for an entry, waiting for its prefetch if needed.
+        :raises Exception: Whatever resolving the video raised
+        :rtype: YouTube | None
+        """
+        self.prefetch([index])
+        future = self._futures.get(index)
+        if future is None:
+            return None
+        try:
+            return future.result(timeout=timeout)
+        except Exception:
+            # Forget the failure so the entry can be retried on the next call
+            with self._lock:
+                self._futures.pop(index, None)
+            logging.warning("Failed to resolve playlist entry %s", index, exc_info=True)
+            raise
+
+    def videos(self):
+        """Yields resolved YouTube objects in order, a page ahead of the consumer."""
+        page_index = 0
+        while True:
+            indices = self.page(page_index)
+            if not indices:
+                return
+            self.prefetch(indices)
+            self.prefetch(self.page(page_index + 1))
+            for index in indices:
+                yield self.video(index)
+            page_index += 1
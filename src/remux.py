@@ -0,0 +1,442 @@
+"""
+    In-process remuxer for adaptive streams, an alternative to the FFmpeg merge.
+    YouTube's adaptive video/mp4 and audio/mp4 streams are fragmented MP4s
+    (see src.clip): a movie header (moov) with an empty sample table, then
+    moof/mdat fragments. Merging them needs no re-encoding and no new sample
+    table: the two movie headers become one with a track each, and every
+    fragment is copied through with only its track id, sequence number and
+    (if present) absolute data offset rewritten. Fragments are written as
+    soon as they are complete, interleaved by decode time, so the merged
+    file grows while the tracks download; no FFmpeg process, temp tracks or
+    second pass over the output are needed. The result is a fragmented MP4.
+"""
+
+import logging
+import struct
+import threading
+import time
+from collections import deque, namedtuple
+
+from src.metrics import MERGE_TAIL_SECONDS
+
+MAX_AHEAD_BYTES = 32 * 1024 * 1024   # fragments one track may buffer while waiting for the other
+MAX_HEADER_BYTES = 16 * 1024 * 1024  # largest box accepted before the movie header was read
+MAX_BOX_BYTES = 256 * 1024 * 1024    # largest fragment box; a box is held whole before it is written
+VIDEO_TRACK_ID = 1
+AUDIO_TRACK_ID = 2
+# Boxes between fragments that only describe the source file
+SKIPPED_BOXES = ("sidx", "styp", "emsg", "prft", "free", "skip", "mfra", "meta", "uuid")
+TRACK_IDS = {"video": VIDEO_TRACK_ID, "audio": AUDIO_TRACK_ID}
+
+
+class RemuxError(Exception):
+    """Raised when the tracks cannot be remuxed in-process, e.g. because they are not fragmented MP4."""
+
+
+# One moof/mdat pair: decode time in seconds, the raw boxes, and where the moof started in its track
+Fragment = namedtuple("Fragment", ["time", "moof", "mdat", "offset"])
+
+
+def _boxes(buf, start : int, end : int):
+    """
+    Walks the boxes in buf[start:end].
+    :return: (type, offset, header size, size) tuples
+    """
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from(">I4s", buf, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", buf, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise RemuxError(f"Corrupt MP4 box at offset {pos}")
+        yield kind.decode("latin-1"), pos, header, size
+        pos += size
+
+
+def _header_size(buf):
+    return 16 if struct.unpack_from(">I", buf, 0)[0] == 1 else 8
+
+
+def _find(buf, *path):
+    """
+    Locates boxes by path below the container box `buf`, e.g. `_find(moov, "trak", "tkhd")`.
+    :return: (offset, header size, size) of every match
+    """
+    found = [(0, _header_size(buf), len(buf))]
+    for kind in path:
+        found = [(offset, header, size)
+                 for parent, parent_header, parent_size in found
+                 for name, offset, header, size in _boxes(buf, parent + parent_header, parent + parent_size)
+                 if name == kind]
+    return found
+
+
+def _first(buf, *path):
+    found = _find(buf, *path)
+    if not found:
+        raise RemuxError(f"Missing {'/'.join(path)} box")
+    return found[0]
+
+
+def _full_box(buf, location):
+    """Version and the offset right after version/flags of a full box."""
+    offset, header, _ = location
+    return buf[offset + header], offset + header + 4
+
+
+def _read_uint(buf, pos, wide):
+    return struct.unpack_from(">Q" if wide else ">I", buf, pos)[0]
+
+
+def _write_uint(buf, pos, wide, value):
+    struct.pack_into(">Q" if wide else ">I", buf, pos, value)
+
+
+def _box(kind : str, payload : bytes):
+    return struct.pack(">I4s", 8 + len(payload), kind.encode("latin-1")) + payload
+
+
+class _Track:
+    """Parsing state of one input track."""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.track_id = TRACK_IDS[kind]
+        self.buffer = bytearray()
+        self.offset = 0              # stream offset of buffer[0]
+        self.ftyp = None
+        self.moov = None
+        self.source_id = None        # track id in the input, replaced by `track_id`
+        self.timescale = None
+        self.moof = None             # (raw, offset) waiting for its mdat
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.last_time = 0.0
+        self.done = False
+
+    @property
+    def ready(self):
+        return self.moov is not None
+
+
+class Remuxer:
+    """
+    Interleaves a video and an audio track into one fragmented MP4, written to `output` as it arrives.
+    `input("video")` and `input("audio")` return file-like objects for the downloads to write into,
+    each from its own thread; `finish()` writes whatever is still buffered.
+    """
+
+    def __init__(self, output, max_ahead=MAX_AHEAD_BYTES):
+        """
+        :param output: A writable binary file object
+        :param max_ahead: Bytes of fragments one track may buffer while the other has none ready;
+            beyond that fragments are written out of decode order rather than held in memory
+        """
+        self.output = output
+        self.max_ahead = max_ahead
+        self.tracks = {kind: _Track(kind) for kind in TRACK_IDS}
+        self.written = 0
+        self.sequence = 0
+        self.header_written = False
+        self.error = None
+        self._lock = threading.Lock()
+
+    def input(self, kind : str):
+        """
+        The writable end of one track.
+        :param kind: "video" or "audio"
+        """
+        return _RemuxInput(self, self.tracks[kind])
+
+    def abort(self, error):
+        """Makes every further write fail, so the other track's download stops too. The first error is kept."""
+        with self._lock:
+            if self.error is None:
+                self.error = error
+
+    def feed(self, track, data):
+        with self._lock:
+            if self.error is not None:
+                raise RemuxError(f"Remux stopped: {self.error}")
+            track.buffer += data
+            self._guarded(track)
+
+    def close_input(self, track):
+        with self._lock:
+            track.done = True
+            if self.error is None:
+                self._guarded(track)
+
+    def _guarded(self, track):
+        """Parses and writes what `track` delivered; the first failure stops the remux."""
+        try:
+            self._parse(track)
+            self._drain()
+        except RemuxError as e:
+            self.error = e
+            raise
+        except (struct.error, IndexError, ValueError) as e:
+            self.error = RemuxError(f"Malformed {track.kind} track: {e}")
+            raise self.error from e
+        except Exception as e:
+            self.error = e
+            raise
+
+    def finish(self):
+        """
+        Writes the remaining fragments once both tracks are complete.
+        :raises RemuxError: If a track ended before its header or in the middle of a box
+        """
+        with self._lock:
+            if self.error is not None:
+                raise RemuxError(f"Remux stopped: {self.error}")
+            for track in self.tracks.values():
+                if not track.ready:
+                    raise RemuxError(f"The {track.kind} track ended before its movie header")
+                if track.buffer or track.moof is not None:
+                    raise RemuxError(f"The {track.kind} track ended in the middle of a fragment")
+            self._drain()
+
+    # --- parsing ---
+
+    def _parse(self, track):
+        buf = track.buffer
+        while len(buf) >= 8:
+            size, kind = struct.unpack_from(">I4s", buf, 0)
+            kind = kind.decode("latin-1")
+            if not track.ready and kind in ("moof", "mdat"):
+                # Decided by the box header, before a non-fragmented track's media is buffered
+                raise RemuxError(f"The {track.kind} track has media before its movie header")
+            limit = MAX_BOX_BYTES if track.ready else MAX_HEADER_BYTES
+            if size == 1:
+                if len(buf) < 16:
+                    return
+                size = struct.unpack_from(">Q", buf, 8)[0]
+            elif size == 0:
+                if not track.done:
+                    if len(buf) > limit:
+                        raise RemuxError(f"The {track.kind} track has a {kind} box too large to remux")
+                    return               # runs to the end of the track
+                size = len(buf)
+            if size < 8:
+                raise RemuxError(f"Corrupt MP4 box at offset {track.offset} of the {track.kind} track")
+            if size > limit:
+                raise RemuxError(f"The {track.kind} track has a {size} byte {kind} box, too large to remux")
+            if len(buf) < size:
+                return
+            raw = bytes(buf[:size])
+            del buf[:size]
+            offset = track.offset
+            track.offset += size
+            self._on_box(track, kind, raw, offset)
+
+    def _on_box(self, track, kind, raw, offset):
+        if not track.ready:
+            if kind == "ftyp":
+                track.ftyp = raw
+            elif kind == "moov":
+                self._read_moov(track, raw)
+            return
+        if kind == "moof":
+            if track.moof is not None:
+                raise RemuxError(f"The {track.kind} track has a fragment header without media")
+            track.moof = (raw, offset)
+        elif kind == "mdat":
+            if track.moof is None:
+                raise RemuxError(f"The {track.kind} track is not a fragmented MP4")
+            moof, moof_offset = track.moof
+            track.moof = None
+            fragment = Fragment(self._decode_time(track, moof), moof, raw, moof_offset)
+            track.pending.append(fragment)
+            track.pending_bytes += len(moof) + len(raw)
+        elif kind not in SKIPPED_BOXES:
+            logging.debug("Remux skips a %s box in the %s track", kind, track.kind)
+
+    def _read_moov(self, track, raw):
+        moov = bytearray(raw)
+        if not _find(moov, "mvex"):
+            raise RemuxError(f"The {track.kind} track is not a fragmented MP4")
+        traks = _find(moov, "trak")
+        if len(traks) != 1:
+            raise RemuxError(f"The {track.kind} input has {len(traks)} tracks, expected one")
+        version, pos = _full_box(moov, _first(moov, "trak", "tkhd"))
+        track.source_id = _read_uint(moov, pos + (16 if version else 8), False)
+        version, pos = _full_box(moov, _first(moov, "trak", "mdia", "mdhd"))
+        track.timescale = _read_uint(moov, pos + (16 if version else 8), False)
+        if not track.timescale:
+            raise RemuxError(f"The {track.kind} track has no timescale")
+        track.moov = moov
+
+    def _decode_time(self, track, moof):
+        tfdt = _find(moof, "traf", "tfdt")
+        if tfdt:
+            version, pos = _full_box(moof, tfdt[0])
+            track.last_time = _read_uint(moof, pos, version == 1) / track.timescale
+        # Without a tfdt the fragment simply follows the previous one
+        return track.last_time
+
+    # --- writing ---
+
+    def _drain(self):
+        video, audio = self.tracks["video"], self.tracks["audio"]
+        if not self.header_written:
+            if not (video.ready and audio.ready):
+                return
+            self._write(self._header())
+            self.header_written = True
+        while True:
+            candidates = [t for t in (video, audio) if t.pending]
+            if not candidates:
+                return
+            waiting = [t for t in (video, audio) if not t.pending and not t.done]
+            if waiting:
+                # The other track may still deliver an earlier fragment; wait for it unless this one runs too far ahead
+                candidates = [t for t in candidates if t.pending_bytes > self.max_ahead]
+                if not candidates:
+                    return
+            track = min(candidates, key=lambda t: t.pending[0].time)
+            fragment = track.pending.popleft()
+            track.pending_bytes -= len(fragment.moof) + len(fragment.mdat)
+            self._write_fragment(track, fragment)
+
+    def _write(self, data):
+        self.output.write(data)
+        self.written += len(data)
+
+    def _header(self):
+        """ftyp and one moov holding the video's movie header and both tracks."""
+        video, audio = self.tracks["video"], self.tracks["audio"]
+        vmoov, amoov = video.moov, audio.moov
+
+        mvhd_at = _first(vmoov, "mvhd")
+        mvhd = bytearray(vmoov[mvhd_at[0]:mvhd_at[0] + mvhd_at[2]])
+        _write_uint(mvhd, len(mvhd) - 4, False, AUDIO_TRACK_ID + 1)        # next_track_ID
+
+        def movie_timescale(moov):
+            version, pos = _full_box(moov, _first(moov, "mvhd"))
+            return _read_uint(moov, pos + (16 if version else 8), False)
+
+        video_trak = self._trak(video, movie_timescale(vmoov), movie_timescale(vmoov))
+        audio_trak = self._trak(audio, movie_timescale(amoov), movie_timescale(vmoov))
+
+        mvex = b""
+        for offset, _, size in _find(vmoov, "mvex", "mehd"):
+            mvex += vmoov[offset:offset + size]
+        for track in (video, audio):
+            mvex += self._trex(track)
+
+        # Keep the video's other movie-level boxes (udta, ...)
+        extras = b"".join(bytes(vmoov[offset:offset + size]) for kind, offset, _, size
+                          in _boxes(vmoov, _header_size(vmoov), len(vmoov)) if kind not in ("mvhd", "trak", "mvex"))
+        moov = _box("moov", bytes(mvhd) + video_trak + audio_trak + _box("mvex", bytes(mvex)) + extras)
+        return (video.ftyp or audio.ftyp or b"") + moov
+
+    def _trak(self, track, source_timescale, movie_timescale):
+        """A track's trak box with its new id, its movie-timescale durations rescaled if needed."""
+        offset, _, size = _first(track.moov, "trak")
+        trak = bytearray(track.moov[offset:offset + size])
+
+        def rescale(value, wide):
+            unknown = (1 << (64 if wide else 32)) - 1
+            if value == unknown or source_timescale == movie_timescale:
+                return value
+            return value * movie_timescale // source_timescale
+
+        version, pos = _full_box(trak, _first(trak, "tkhd"))
+        id_pos = pos + (16 if version else 8)
+        _write_uint(trak, id_pos, False, track.track_id)
+        duration_pos = id_pos + 8
+        _write_uint(trak, duration_pos, version == 1, rescale(_read_uint(trak, duration_pos, version == 1), version == 1))
+        for location in _find(trak, "edts", "elst"):
+            version, pos = _full_box(trak, location)
+            count = _read_uint(trak, pos, False)
+            entry = pos + 4
+            for _ in range(count):
+                wide = version == 1
+                _write_uint(trak, entry, wide, rescale(_read_uint(trak, entry, wide), wide))
+                entry += 20 if wide else 12
+        return bytes(trak)
+
+    def _trex(self, track):
+        for location in _find(track.moov, "mvex", "trex"):
+            _, pos = _full_box(track.moov, location)
+            if _read_uint(track.moov, pos, False) == track.source_id:
+                offset, _, size = location
+                trex = bytearray(track.moov[offset:offset + size])
+                _write_uint(trex, pos - offset, False, track.track_id)
+                return bytes(trex)
+        raise RemuxError(f"The {track.kind} track has no fragment defaults (trex)")
+
+    def _write_fragment(self, track, fragment):
+        moof = bytearray(fragment.moof)
+        self.sequence += 1
+        _, pos = _full_box(moof, _first(moof, "mfhd"))
+        _write_uint(moof, pos, False, self.sequence)
+        for location in _find(moof, "traf", "tfhd"):
+            flags_pos = location[0] + location[1]
+            flags = int.from_bytes(moof[flags_pos + 1:flags_pos + 4], "big")
+            _, pos = _full_box(moof, location)
+            _write_uint(moof, pos, False, track.track_id)
+            if flags & 0x000001:
+                # An absolute base data offset: move it along with the fragment
+                base = _read_uint(moof, pos + 4, True)
+                _write_uint(moof, pos + 4, True, base - fragment.offset + self.written)
+        self._write(moof)
+        self._write(fragment.mdat)
+
+
+class _RemuxInput:
+    """Writable end of one Remuxer track."""
+
+    def __init__(self, remuxer, track):
+        self._remuxer = remuxer
+        self._track = track
+
+    def write(self, data):
+        self._remuxer.feed(self._track, data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._remuxer.close_input(self._track)
+
+
+def _feed(download, stream, remuxer, kind, report_progress, errors):
+    """Downloads one track into the remuxer and records any failure in `errors`."""
+    track_input = remuxer.input(kind)
+    try:
+        download(stream, track_input, report_progress)
+        track_input.close()
+    except Exception as e:
+        errors.append(e)
+        remuxer.abort(e)
+
+
+def remux_merge(video_stream, audio_stream, output_path : str, download):
+    """
+    Downloads both tracks concurrently and remuxes them into `output_path` while they arrive.
+    The video track is fetched on the calling thread so its progress callback runs there.
+    :param download: Callable (stream, fileobj, report_progress) that writes a stream into fileobj
+    :raises RemuxError: If the tracks are not fragmented MP4 (nothing useful was written)
+    """
+    errors = []
+    with open(output_path, "wb") as output:
+        remuxer = Remuxer(output)
+        audio_thread = threading.Thread(
+            target=_feed, args=(download, audio_stream, remuxer, "audio", False, errors), daemon=True
+        )
+        audio_thread.start()
+        _feed(download, video_stream, remuxer, "video", True, errors)
+        audio_thread.join()
+        if errors:
+            # The first failure stopped the other track; raise that one, not the knock-on error
+            raise remuxer.error or errors[0]
+        inputs_done = time.perf_counter()
+        remuxer.finish()
+    MERGE_TAIL_SECONDS.observe(time.perf_counter() - inputs_done)
@@ -0,0 +1,304 @@
+"""
+    Shared retry and circuit-breaker layer for requests to YouTube.
+    Failures are sorted into error classes (rate_limited, server, network,
+    client); each class has its own retry policy with exponential backoff and
+    full jitter, and a Retry-After header is honoured. One process-wide
+    circuit breaker sees every outcome: when YouTube starts throttling or
+    failing, it opens and every worker waits for the cooldown together instead
+    of hammering it, then a single probe request decides whether to resume.
+    Used for pytubefix's own requests (metadata, playlist pages) through
+    `install()`, and for byte-range transfers in src.transfer.
+    Configure with YTD_BREAKER_THRESHOLD, YTD_BREAKER_COOLDOWN and YTD_BREAKER_MAX_WAIT.
+"""
+
+import email.utils
+import http.client
+import logging
+import os
+import random
+import threading
+import time
+from urllib.error import HTTPError
+
+from src.metrics import RETRIES, RETRY_WAIT_SECONDS, BREAKER_STATE, BREAKER_TRIPS, BREAKER_WAIT_SECONDS
+
+MAX_RETRY_AFTER = 300                # never wait longer than this for a Retry-After header
+DEFAULT_THRESHOLD = 5                # consecutive throttling/server errors that open the breaker
+DEFAULT_COOLDOWN = 5.0               # first open period, doubled for every consecutive trip
+DEFAULT_MAX_COOLDOWN = 300.0
+DEFAULT_MAX_WAIT = 120.0             # a caller gives up after waiting this long for the breaker
+
+
+class CircuitOpenError(Exception):
+    """Raised when a request waited too long for the circuit breaker to close."""
+
+
+def classify(error):
+    """
+    The error class that selects a retry policy.
+    :return: "rate_limited", "server", "client", "network", or None for errors that are not transient
+    :rtype: str | None
+    """
+    if isinstance(error, HTTPError):
+        if error.code == 429:
+            return "rate_limited"
+        if error.code >= 500:
+            return "server"
+        return "client"
+    # URLError, timeouts, resets and short reads
+    if isinstance(error, (OSError, http.client.HTTPException)):
+        return "network"
+    return None
+
+
+def retry_after(error):
+    """
+    Seconds the server asked us to wait in a Retry-After header, or None.
+    Both the delta-seconds and the HTTP-date form are understood.
+    """
+    headers = getattr(error, "headers", None)
+    value = headers.get("Retry-After") if headers is not None else None
+    if not value:
+        return None
+    try:
+        return min(MAX_RETRY_AFTER, max(0.0, float(value)))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return min(MAX_RETRY_AFTER, max(0.0, when.timestamp() - time.time()))
+
+
+class RetryPolicy:
+    """How often, and after how long, one class of errors is retried."""
+
+    def __init__(self, max_retries : int, base_delay : float, max_delay : float):
+        """
+        :param max_retries: Retries before the error is raised
+        :param base_delay: Backoff before the first retry, doubled for each further one
+        :param max_delay: Upper bound of the backoff
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt : int, server_delay=None):
+        """
+        Seconds to wait before retry number `attempt` (0-based): exponential backoff with
+        full jitter, but never less than the delay the server asked for.
+        """
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return backoff if server_delay is None else max(backoff, server_delay)
+
+
+# Client errors (404, expired URLs, ...) are not retried here
+DEFAULT_POLICIES = {
+    "rate_limited": RetryPolicy(max_retries=5, base_delay=2.0, max_delay=60.0),
+    "server": RetryPolicy(max_retries=3, base_delay=1.0, max_delay=30.0),
+    "network": RetryPolicy(max_retries=3, base_delay=0.5, max_delay=10.0),
+}
+
+
+def retry_delay(error, attempt : int, max_retries=None, policies=None):
+    """
+    How long to wait before retrying a failed request.
+    :param attempt: Number of retries already made
+    :param max_retries: Optional cap on the policy's number of retries
+    :return: Seconds to wait, or None if the error must be raised
+    :rtype: float | None
+    """
+    policy = (policies or DEFAULT_POLICIES).get(classify(error))
+    if policy is None:
+        return None
+    limit = policy.max_retries if max_retries is None else min(policy.max_retries, max_retries)
+    if attempt >= limit:
+        return None
+    return policy.delay(attempt, retry_after(error))
+
+
+class CircuitBreaker:
+    """
+    Closed: requests pass. After `threshold` throttling or server errors in a row
+    (or a 429 with Retry-After) it opens, and callers block in `before()` until the
+    cooldown is over. Half-open: one probe request passes while the others keep
+    waiting; its success closes the breaker, its failure opens it for twice as long.
+    Every request let through by `before()` must end in `record()` or `abort()`,
+    or a probe would hold the half-open breaker forever.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, cooldown=DEFAULT_COOLDOWN, max_cooldown=DEFAULT_MAX_COOLDOWN,
+                 max_wait=DEFAULT_MAX_WAIT):
+        """
+        :param threshold: Consecutive failures that open the breaker; 0 disables it
+        :param cooldown: Seconds the breaker first stays open
+        :param max_cooldown: Upper bound of the doubled cooldown
+        :param max_wait: Seconds a caller waits for the breaker before giving up
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_wait = max_wait
+        self.state = self.CLOSED
+        self._failures = 0
+        self._trips = 0
+        self._open_until = 0.0
+        self._probing = False
+        self._probe_thread = None
+        self._cond = threading.Condition()
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    def before(self):
+        """
+        Waits until a request may be sent.
+        :raises CircuitOpenError: If the breaker stayed open for longer than `max_wait`
+        """
+        if not self.enabled:
+            return
+        started = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self.state == self.OPEN and now >= self._open_until:
+                    self.state = self.HALF_OPEN
+                    self._probing = False
+                if self.state == self.CLOSED:
+                    break
+                if self.state == self.HALF_OPEN and not self._probing:
+                    self._probing = True
+                    self._probe_thread = threading.get_ident()
+                    break
+                remaining = started + self.max_wait - now
+                if remaining <= 0:
+                    raise CircuitOpenError(
+                        f"YouTube is throttling requests; gave up after waiting {self.max_wait:g}s."
+                    )
+                # While half-open, wake up when the probe reports back
+                timeout = self._open_until - now if self.state == self.OPEN else remaining
+                self._cond.wait(min(timeout, remaining))
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            BREAKER_WAIT_SECONDS.observe(waited)
+
+    def record(self, error=None):
+        """Reports the outcome of a request let through by `before()`; `error` is None on success."""
+        if not self.enabled:
+            return
+        error_class = classify(error) if error is not None else None
+        with self._cond:
+            if error_class in ("rate_limited", "server"):
+                self._failures += 1
+                server_delay = retry_after(error)
+                if self.state == self.OPEN:
+                    # A request sent before the breaker opened; only a longer Retry-After matters
+                    if server_delay:
+                        self._open_until = max(self._open_until, time.monotonic() + server_delay)
+                elif self.state == self.HALF_OPEN or self._failures >= self.threshold or server_delay:
+                    self._open(server_delay)
+            elif (error is None or error_class == "client") and self.state != self.OPEN:
+                # The server answered normally
+                if self.state == self.HALF_OPEN:
+                    logging.info("Circuit breaker closed")
+                self.state = self.CLOSED
+                self._failures = 0
+                self._trips = 0
+            if self.state == self.HALF_OPEN:
+                # A network error says nothing about YouTube; let the next waiter probe
+                self._probing = False
+            self._cond.notify_all()
+
+    def abort(self):
+        """
+        Reports that a request let through by `before()` ended without an outcome,
+        e.g. because its thread was interrupted. If it was the probe, the next waiter probes instead.
+        """
+        if not self.enabled:
+            return
+        with self._cond:
+            if self.state == self.HALF_OPEN and self._probing and self._probe_thread == threading.get_ident():
+                self._probing = False
+                self._cond.notify_all()
+
+    def _open(self, server_delay=None):
+        cooldown = min(self.max_cooldown, self.cooldown * 2 ** self._trips)
+        if server_delay:
+            cooldown = max(cooldown, server_delay)
+        self._trips += 1
+        self._failures = 0
+        self._open_until = time.monotonic() + cooldown
+        self.state = self.OPEN
+        BREAKER_TRIPS.inc()
+        logging.warning("Circuit breaker open for %.1fs after repeated YouTube errors", cooldown)
+
+    def stats(self):
+        """
+        Current state and, while open, seconds until the next probe.
+        :rtype: dict
+        """
+        with self._cond:
+            return {
+                "state": self.state,
+                "failures": self._failures,
+                "trips": self._trips,
+                "reopens_in": max(0.0, self._open_until - time.monotonic()) if self.state == self.OPEN else 0.0,
+            }
+
+
+def call(fn, kind : str, max_retries=None, policies=None, circuit=None):
+    """
+    Calls `fn()` through the circuit breaker, retrying transient errors by their policy.
+    :param kind: Label for the retry metrics, e.g. "youtube"
+    :param max_retries: Optional cap on every policy's number of retries
+    :param circuit: The circuit breaker to use, defaults to the process-wide one
+    :return: Whatever `fn` returns
+    :raises Exception: The last error once it is not retried any more
+    """
+    circuit = circuit or breaker
+    attempt = 0
+    while True:
+        circuit.before()
+        try:
+            result = fn()
+        except Exception as e:
+            circuit.record(e)
+            delay = retry_delay(e, attempt, max_retries, policies)
+            if delay is None:
+                raise
+            wait_before_retry(kind, e, delay, attempt)
+            attempt += 1
+            continue
+        except BaseException:
+            # Interrupted, e.g. by a Streamlit rerun: no outcome, but a probe must not stay taken
+            circuit.abort()
+            raise
+        circuit.record()
+        return result
+
+
+def wait_before_retry(kind : str, error, delay : float, attempt : int):
+    """Records a retry in the metrics and log, then sleeps for its backoff."""
+    error_class = classify(error)
+    RETRIES.inc(kind=kind, error=error_class)
+    RETRY_WAIT_SECONDS.observe(delay, kind=kind)
+    logging.warning("%s request failed (%s: %s), retry %s in %.1fs", kind, error_class, error, attempt + 1, delay)
+    time.sleep(delay)
+
+
+def _env_float(name, default):
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+
+breaker = CircuitBreaker(
+    threshold=int(_env_float("YTD_BREAKER_THRESHOLD", DEFAULT_THRESHOLD)),
+    cooldown=_env_float("YTD_BREAKER_COOLDOWN", DEFAULT_COOLDOWN),
+    max_wait=_env_float("YTD_BREAKER_MAX_WAIT", DEFAULT_MAX_WAIT),
+)
+_STATE_VALUES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+BREAKER_STATE.set_function(lambda: _STATE_VALUES[breaker.state])
@@ -0,0 +1,258 @@
+"""
+    Process-wide bandwidth shaping and fair scheduling of downloads.
+    Bytes are granted per byte range (before each range request) from a
+    global token bucket and an optional per-session bucket; waiting requests
+    are served round-robin across sessions, so one session with many
+    connections cannot starve the others. Active download jobs and FFmpeg
+    merges are limited by fair slots that are also handed out round-robin.
+    Every limit is off by default; configure with YTD_BANDWIDTH_LIMIT,
+    YTD_SESSION_BANDWIDTH_LIMIT (bytes per second), YTD_MAX_TRANSFERS and YTD_MAX_MERGES.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from src.metrics import SCHEDULER_QUEUE_DEPTH, SCHEDULER_WAIT_SECONDS
+
+DEFAULT_SESSION = "default"
+BURST_SECONDS = 1.0                  # a bucket holds at most one second of its rate
+
+
+class _Bucket:
+    """A token bucket that may go into debt by one grant, so grants of any size make progress."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = rate * BURST_SECONDS if rate else 0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self):
+        return not self.rate or self.tokens > 0
+
+    def wait_time(self):
+        """Seconds until the bucket is ready again."""
+        return 0.0 if self.ready() else -self.tokens / self.rate
+
+    def take(self, amount):
+        if self.rate:
+            self.tokens -= amount
+
+
+class _FairQueue:
+    """
+    Waiters grouped by session. The head of the queue is the oldest waiter of
+    the first eligible session; a served session moves to the back of the line.
+    """
+
+    def __init__(self):
+        self._sessions = OrderedDict()
+
+    def __len__(self):
+        return sum(len(tickets) for tickets in self._sessions.values())
+
+    def push(self, session, ticket):
+        self._sessions.setdefault(session, deque()).append(ticket)
+
+    def head(self, eligible=None):
+        for session, tickets in self._sessions.items():
+            if eligible is None or eligible(session):
+                return tickets[0]
+        return None
+
+    def sessions(self):
+        return list(self._sessions)
+
+    def remove(self, session, ticket, served=True):
+        tickets = self._sessions[session]
+        tickets.remove(ticket)
+        if not tickets:
+            del self._sessions[session]
+        elif served:
+            self._sessions.move_to_end(session)
+
+
+class FairSlots:
+    """A semaphore whose free slots are handed to waiting sessions in turn."""
+
+    def __init__(self, name : str, limit=None):
+        """
+        :param name: Label for metrics
+        :param limit: Maximum concurrent holders, None for unlimited
+        """
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self._queue = _FairQueue()
+        self._cond = threading.Condition()
+
+    @property
+    def waiting(self):
+        with self._cond:
+            return len(self._queue)
+
+    def acquire(self, session=DEFAULT_SESSION):
+        if not self.limit:
+            return
+        ticket = object()
+        started = time.monotonic()
+        with self._cond:
+            self._queue.push(session, ticket)
+            try:
+                while not (self.active < self.limit and self._queue.head() is ticket):
+                    self._cond.wait()
+            except BaseException:
+                self._queue.remove(session, ticket, served=False)
+                self._cond.notify_all()
+                raise
+            self._queue.remove(session, ticket)
+            self.active += 1
+        SCHEDULER_WAIT_SECONDS.observe(time.monotonic() - started, queue=self.name)
+
+    def release(self):
+        if not self.limit:
+            return
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, session=DEFAULT_SESSION):
+        self.acquire(session)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class BandwidthShaper:
+    """Grants bytes from a global and a per-session token bucket, round-robin across sessions."""
+
+    def __init__(self, global_rate=None, session_rate=None):
+        """
+        :param global_rate: Bytes per second for the whole process, None for unlimited
+        :param session_rate: Bytes per second for each session, None for unlimited
+        """
+        self.global_rate = global_rate
+        self.session_rate = session_rate
+        self._global = _Bucket(global_rate)
+        self._sessions = {}
+        self._queue = _FairQueue()
+        self._cond = threading.Condition()
+
+    @property
+    def enabled(self):
+        return bool(self.global_rate or self.session_rate)
+
+    @property
+    def waiting(self):
+        with self._cond:
+            return len(self._queue)
+
+    def _bucket(self, session):
+        bucket = self._sessions.get(session)
+        if bucket is None:
+            bucket = self._sessions[session] = _Bucket(self.session_rate)
+        return bucket
+
+    def acquire(self, amount : int, session=DEFAULT_SESSION):
+        """Blocks until `amount` bytes may be transferred for `session`."""
+        if not self.enabled:
+            return
+        ticket = object()
+        started = time.monotonic()
+        with self._cond:
+            self._queue.push(session, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._global.refill(now)
+                    for waiting in self._queue.sessions():
+                        self._bucket(waiting).refill(now)
+                    head = self._queue.head(lambda s: self._bucket(s).ready())
+                    if head is ticket and self._global.ready():
+                        break
+                    if head is None:
+                        # Every waiting session is over its own cap
+                        timeout = min(self._bucket(s).wait_time() for s in self._queue.sessions())
+                    else:
+                        timeout = self._global.wait_time() or None
+                    self._cond.wait(timeout)
+            except BaseException:
+                self._queue.remove(session, ticket, served=False)
+                self._cond.notify_all()
+                raise
+            self._queue.remove(session, ticket)
+            self._global.take(amount)
+            self._bucket(session).take(amount)
+            self._prune()
+            self._cond.notify_all()
+        SCHEDULER_WAIT_SECONDS.observe(time.monotonic() - started, queue="bandwidth")
+
+    def _prune(self):
+        """Drops buckets of idle sessions that have refilled; a new bucket would be identical."""
+        now = time.monotonic()
+        waiting = set(self._queue.sessions())
+        for session, bucket in list(self._sessions.items()):
+            if session not in waiting:
+                bucket.refill(now)
+                if bucket.tokens >= bucket.capacity:
+                    del self._sessions[session]
+
+
+class Scheduler:
+    """Bandwidth, transfer and merge limits shared by every download in the process."""
+
+    def __init__(self, global_rate=None, session_rate=None, max_transfers=None, max_merges=None):
+        self.bandwidth = BandwidthShaper(global_rate, session_rate)
+        self.transfers = FairSlots("transfer", max_transfers)
+        self.merges = FairSlots("merge", max_merges)
+
+    def throttle(self, amount : int, session=None):
+        """Waits until `amount` bytes may be fetched; called before each range request."""
+        self.bandwidth.acquire(amount, session or DEFAULT_SESSION)
+
+    def transfer_slot(self, session=None):
+        """Context manager holding one of the active download slots."""
+        return self.transfers.slot(session or DEFAULT_SESSION)
+
+    def merge_slot(self, session=None):
+        """Context manager holding one of the FFmpeg merge slots."""
+        return self.merges.slot(session or DEFAULT_SESSION)
+
+    def stats(self):
+        """
+        Current queue depths and limits.
+        :rtype: dict
+        """
+        return {
+            "bandwidth": {"global_rate": self.bandwidth.global_rate, "session_rate": self.bandwidth.session_rate,
+                          "waiting": self.bandwidth.waiting},
+            "transfers": {"limit": self.transfers.limit, "active": self.transfers.active,
+                          "waiting": self.transfers.waiting},
+            "merges": {"limit": self.merges.limit, "active": self.merges.active, "waiting": self.merges.waiting},
+        }
+
+
+def _env_int(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+scheduler = Scheduler(
+    global_rate=_env_int("YTD_BANDWIDTH_LIMIT"),
+    session_rate=_env_int("YTD_SESSION_BANDWIDTH_LIMIT"),
+    max_transfers=_env_int("YTD_MAX_TRANSFERS"),
+    max_merges=_env_int("YTD_MAX_MERGES"),
+)
+SCHEDULER_QUEUE_DEPTH.set_function(lambda: scheduler.bandwidth.waiting, queue="bandwidth")
+SCHEDULER_QUEUE_DEPTH.set_function(lambda: scheduler.transfers.waiting, queue="transfer")
+SCHEDULER_QUEUE_DEPTH.set_function(lambda: scheduler.merges.waiting, queue="merge")
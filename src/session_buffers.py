@@ -0,0 +1,235 @@
+"""
+    Process-wide bookkeeping for the result buffers UI sessions keep around.
+    Every finished download a session holds on to is registered here under
+    (session, name). The manager keeps all sessions together under a memory
+    budget: least recently used buffers are first spilled to disk, then dropped
+    once a disk budget is exceeded too (a dropped download can simply be
+    fetched again, usually from the artifact cache). Buffers of sessions that
+    went away or sat idle too long are released.
+    Streamlit keeps every file a download button serves in memory as one bytes
+    object, so saving a buffer copies it whole into RAM, even a spilled one;
+    buffers above YTD_MAX_SAVE_BYTES are not served that way at all.
+    Configure with YTD_BUFFER_MEMORY_BYTES, YTD_BUFFER_DISK_BYTES, YTD_BUFFER_IDLE_SECONDS
+    and YTD_MAX_SAVE_BYTES.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from src.buffers import release_buffer
+from src.metrics import SESSION_BUFFER_BYTES, SESSION_BUFFER_EVICTIONS
+
+DEFAULT_MEMORY_BYTES = 512 * 1024 * 1024         # 512MB across all sessions
+DEFAULT_DISK_BYTES = 10 * 1024 * 1024 * 1024     # 10GB
+DEFAULT_IDLE_SECONDS = 60 * 60                   # an hour without touching any of its buffers
+DEAD_SESSION_GRACE = 2 * 60                      # a session may reconnect within this time
+DEFAULT_MAX_SAVE_BYTES = 1024 * 1024 * 1024      # 1GB; the largest file copied into memory for a download button
+
+
+class BufferExpired(Exception):
+    """Raised when a buffer was released to stay within budget and must be downloaded again."""
+
+
+class BufferTooLarge(Exception):
+    """Raised when a buffer is too large to be served from memory by a download button."""
+
+
+class _Entry:
+    __slots__ = ("buffer", "used_at")
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.used_at = time.monotonic()
+
+
+class BufferManager:
+    """LRU over every session's buffers, with a memory and a disk budget."""
+
+    def __init__(self, memory_bytes=DEFAULT_MEMORY_BYTES, disk_bytes=DEFAULT_DISK_BYTES,
+                 idle_seconds=DEFAULT_IDLE_SECONDS, max_save_bytes=DEFAULT_MAX_SAVE_BYTES):
+        """
+        :param memory_bytes: Total size of in-memory buffers before the least recently used spill to disk
+        :param disk_bytes: Total size of spilled buffers before the least recently used are dropped
+        :param idle_seconds: Sessions that have not used their buffers for this long are released
+        :param max_save_bytes: Largest buffer `reader` serves; larger ones would need as much RAM per click
+        """
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.idle_seconds = idle_seconds
+        self.max_save_bytes = max_save_bytes
+        self._entries = OrderedDict()        # (session, name) -> _Entry, least recently used first
+        self._missing_since = {}             # session -> when it was first seen inactive
+        self._lock = threading.RLock()
+
+    def put(self, session, name : str, buffer):
+        """
+        Registers a session's buffer, replacing (and releasing) any buffer under the same name.
+        Other buffers may be spilled or dropped to make room.
+        """
+        key = (session, name)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            self._entries[key] = _Entry(buffer)
+            self._missing_since.pop(session, None)
+        if previous is not None and previous.buffer is not buffer:
+            release_buffer(previous.buffer)
+        self.enforce()
+        return buffer
+
+    def get(self, session, name : str):
+        """
+        A session's buffer, marked as recently used.
+        :return: The buffer, or None if there is none or it was dropped
+        """
+        key = (session, name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.buffer.closed:
+                del self._entries[key]
+                return None
+            entry.used_at = time.monotonic()
+            self._entries.move_to_end(key)
+            return entry.buffer
+
+    def can_save(self, size : int):
+        """Whether a file of `size` bytes may be served by `reader`."""
+        return not self.max_save_bytes or size <= self.max_save_bytes
+
+    def reader(self, session, name : str, load=None):
+        """
+        A deferred `data` callable for `st.download_button` that reads the buffer when clicked.
+        Streamlit needs the file as bytes, so every click copies the whole buffer into memory.
+        :param load: Optional callable returning the buffer when it is not held (any more); it is then held
+        :raises BufferExpired: At click time, if the buffer was dropped in the meantime and there is no `load`
+        :raises BufferTooLarge: At click time, if the buffer is larger than `max_save_bytes`
+        """
+        def _read():
+            buffer = self.get(session, name)
+            if buffer is None:
+                if load is None:
+                    raise BufferExpired("This file was released to free memory; please download it again.")
+                buffer = self.put(session, name, load())
+            if not self.can_save(buffer.size):
+                raise BufferTooLarge(f"This file is larger than the {self.max_save_bytes:,} bytes a browser download may use.")
+            return buffer.getvalue()
+        return _read
+
+    def release(self, session, name=None):
+        """Releases one of a session's buffers, or all of them when `name` is None."""
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == session and (name is None or key[1] == name)]
+            entries = [self._entries.pop(key) for key in keys]
+        for entry in entries:
+            release_buffer(entry.buffer)
+
+    def _usage(self):
+        memory = disk = 0
+        for entry in self._entries.values():
+            buffer = entry.buffer
+            if buffer.closed:
+                continue
+            if not buffer.on_disk:
+                memory += buffer.size
+            elif buffer.owned:
+                # Files borrowed from the artifact cache are budgeted there
+                disk += buffer.size
+        return memory, disk
+
+    def enforce(self):
+        """Spills, then drops, least recently used buffers until both budgets are met."""
+        dropped = []
+        with self._lock:
+            memory, disk = self._usage()
+            for key, entry in list(self._entries.items()):
+                if memory <= self.memory_bytes:
+                    break
+                buffer = entry.buffer
+                if buffer.closed or buffer.on_disk:
+                    continue
+                size = buffer.size
+                if self.disk_bytes and disk + size <= self.disk_bytes:
+                    try:
+                        buffer.rollover()
+                        disk += size
+                        SESSION_BUFFER_EVICTIONS.inc(action="spill")
+                    except OSError as e:
+                        logging.warning(f"Failed to spill buffer to disk: {e}")
+                        dropped.append(self._entries.pop(key))
+                else:
+                    dropped.append(self._entries.pop(key))
+                memory -= size
+            for key, entry in list(self._entries.items()):
+                if disk <= self.disk_bytes:
+                    break
+                buffer = entry.buffer
+                if buffer.closed or not buffer.on_disk or not buffer.owned:
+                    continue
+                disk -= buffer.size
+                dropped.append(self._entries.pop(key))
+        for entry in dropped:
+            SESSION_BUFFER_EVICTIONS.inc(action="drop")
+            release_buffer(entry.buffer)
+
+    def reap(self, is_alive=None):
+        """
+        Releases the buffers of sessions that went away or have been idle too long.
+        :param is_alive: Optional callable (session) -> bool; a session reported dead
+            for longer than DEAD_SESSION_GRACE is released
+        :return: The number of sessions released
+        :rtype: int
+        """
+        now = time.monotonic()
+        with self._lock:
+            last_used = {}
+            for (session, _), entry in self._entries.items():
+                last_used[session] = max(last_used.get(session, 0), entry.used_at)
+        expired = set()
+        for session, used_at in last_used.items():
+            if self.idle_seconds and now - used_at > self.idle_seconds:
+                expired.add((session, "idle"))
+            elif is_alive is not None and not is_alive(session):
+                with self._lock:
+                    since = self._missing_since.setdefault(session, now)
+                if now - since > DEAD_SESSION_GRACE:
+                    expired.add((session, "dead"))
+            else:
+                with self._lock:
+                    self._missing_since.pop(session, None)
+        for session, reason in expired:
+            logging.info("Releasing buffers of %s session %s", reason, session)
+            SESSION_BUFFER_EVICTIONS.inc(action=reason)
+            self.release(session)
+            with self._lock:
+                self._missing_since.pop(session, None)
+        return len(expired)
+
+    def stats(self):
+        """
+        Current usage against the budgets.
+        :rtype: dict
+        """
+        with self._lock:
+            memory, disk = self._usage()
+            return {
+                "sessions": len({session for session, _ in self._entries}),
+                "buffers": len(self._entries),
+                "memory_bytes": memory,
+                "memory_budget": self.memory_bytes,
+                "disk_bytes": disk,
+                "disk_budget": self.disk_bytes,
+            }
+
+
+buffer_manager = BufferManager(
+    memory_bytes=int(os.environ.get("YTD_BUFFER_MEMORY_BYTES", DEFAULT_MEMORY_BYTES)),
+    disk_bytes=int(os.environ.get("YTD_BUFFER_DISK_BYTES", DEFAULT_DISK_BYTES)),
+    idle_seconds=int(os.environ.get("YTD_BUFFER_IDLE_SECONDS", DEFAULT_IDLE_SECONDS)),
+    max_save_bytes=int(os.environ.get("YTD_MAX_SAVE_BYTES", DEFAULT_MAX_SAVE_BYTES)),
+)
+SESSION_BUFFER_BYTES.set_function(lambda: buffer_manager.stats()["memory_bytes"], storage="memory")
+SESSION_BUFFER_BYTES.set_function(lambda: buffer_manager.stats()["disk_bytes"], storage="disk")
@@ -0,0 +1,161 @@
+"""
+    Process-wide deduplication of identical in-flight work.
+    The first request for a key starts the work on a background thread; later
+    requests for the same key attach to it instead of repeating it. Every
+    attached request gets the live progress and messages of the shared work
+    and its own copy of the result, and can leave (e.g. because its Streamlit
+    session was stopped) without affecting the others.
+    A process that dedupes its work elsewhere (the job workers, whose store
+    shares identical jobs) turns it off with `in_flight.enabled = False`; the
+    work then runs on the calling thread, so whatever stops the caller stops it.
+"""
+
+import logging
+import queue
+import threading
+
+from src.metrics import SINGLEFLIGHT_REQUESTS, SINGLEFLIGHT_ACTIVE
+
+_DONE = object()
+
+
+class _Flight:
+    """One running piece of shared work and the requests waiting for it."""
+
+    def __init__(self, key):
+        self.key = key
+        self.result = None
+        self.error = None
+        self.finished = False
+        self.subscribers = {}
+        self.last_progress = None
+        self.lock = threading.Lock()
+        self._next_token = 0
+
+    def subscribe(self):
+        """Registers a waiter and replays the latest progress to it."""
+        events = queue.SimpleQueue()
+        with self.lock:
+            token = self._next_token
+            self._next_token += 1
+            self.subscribers[token] = events
+            if self.last_progress is not None:
+                events.put(self.last_progress)
+        return token, events
+
+    def broadcast(self, event):
+        with self.lock:
+            if event[0] == "progress":
+                self.last_progress = event
+            subscribers = list(self.subscribers.values())
+        for events in subscribers:
+            events.put(event)
+
+
+class _FlightProgress:
+    """Progress-bar stand-in handed to the shared work; forwards updates to every waiter."""
+
+    def __init__(self, flight):
+        self._flight = flight
+
+    def progress(self, percent, text=None):
+        self._flight.broadcast(("progress", percent, text))
+
+
+class SingleFlight:
+    """A registry of in-flight work keyed by what it produces."""
+
+    def __init__(self):
+        self.enabled = True
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._flights)
+
+    def is_running(self, key):
+        with self._lock:
+            return key in self._flights
+
+    def run(self, key, work, progress=None, on_message=None, share=None, release=None):
+        """
+        Runs `work` for `key`, or waits for the identical work that is already running.
+        Progress and messages are delivered on the calling thread.
+        :param key: Hashable identity of the result, e.g. (video_id, itags, format)
+        :param work: Callable (progress, notify) -> result; `progress` has a
+            `.progress(percent, text=...)` method and `notify` takes (level, text)
+        :param progress: Optional object with a `.progress(percent, text=...)` method
+        :param on_message: Optional callable (level, text)
+        :param share: Callable returning this caller's own copy of the result; by default the result itself
+        :param release: Callable freeing the shared result once every waiter has its copy
+        :return: This caller's copy of the result
+        :raises Exception: Whatever `work` raised
+        """
+        if not self.enabled:
+            return work(progress, on_message)
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight(key)
+            token, events = flight.subscribe()
+        SINGLEFLIGHT_REQUESTS.inc(role="leader" if leader else "follower")
+        if leader:
+            threading.Thread(
+                target=self._execute, args=(flight, work, release), daemon=True, name="singleflight"
+            ).start()
+        else:
+            logging.info("Joining in-flight download %s", key)
+
+        try:
+            while True:
+                event = events.get()
+                if event is _DONE:
+                    break
+                kind, first, second = event
+                if kind == "progress" and progress is not None:
+                    progress.progress(first, text=second)
+                elif kind == "message" and on_message is not None:
+                    on_message(first, second)
+            if flight.error is not None:
+                raise flight.error
+            if share is None or flight.result is None:
+                return flight.result
+            return share(flight.result)
+        finally:
+            self._leave(flight, token, release)
+
+    def _execute(self, flight, work, release):
+        notify = lambda level, text: flight.broadcast(("message", level, text))
+        try:
+            flight.result = work(_FlightProgress(flight), notify)
+        except BaseException as e:
+            flight.error = e
+        with self._lock:
+            # From here on, new requests for the key start fresh work
+            del self._flights[flight.key]
+        with flight.lock:
+            flight.finished = True
+            subscribers = list(flight.subscribers.values())
+        for events in subscribers:
+            events.put(_DONE)
+        if not subscribers:
+            # Everyone left before the work finished
+            self._release(flight, release)
+
+    def _leave(self, flight, token, release):
+        with flight.lock:
+            flight.subscribers.pop(token, None)
+            last = flight.finished and not flight.subscribers
+        if last:
+            self._release(flight, release)
+
+    @staticmethod
+    def _release(flight, release):
+        if release is not None and flight.result is not None:
+            release(flight.result)
+
+
+in_flight = SingleFlight()
+SINGLEFLIGHT_ACTIVE.set_function(lambda: len(in_flight))
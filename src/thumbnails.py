@@ -0,0 +1,274 @@
+"""
+    Local thumbnail cache for the UI.
+    Thumbnails are fetched once (in parallel batches, over the pooled
+    transport), downsized to the display width and re-encoded as small JPEGs.
+    Results are kept in a memory LRU in front of an on-disk LRU with a byte
+    budget, and handed to `st.image` as bytes, so browsers never pull the
+    full-size images from YouTube's CDN. Shared by every session.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from src.metrics import THUMBNAIL_REQUESTS
+from src.transport import transport
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "ytd_thumbnails")
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024    # 100MB
+DEFAULT_MEMORY_ENTRIES = 512
+DEFAULT_WIDTH = 480                      # about twice the thumbnail column, for high-DPI screens
+JPEG_QUALITY = 80
+FETCH_WORKERS = 8
+FETCH_TIMEOUT = 10
+FAILURE_TTL = 60                         # seconds before a failed thumbnail is tried again
+
+
+def video_thumbnail_url(video_id : str, variant="hqdefault"):
+    """The thumbnail URL of a video, known before the video itself is resolved."""
+    return f"https://i.ytimg.com/vi/{video_id}/{variant}.jpg"
+
+
+def resize_image(data : bytes, width : int):
+    """
+    Downsizes an image to `width` pixels wide (never upscales) and encodes it as JPEG.
+    Without Pillow the image is returned unchanged.
+    :rtype: bytes
+    """
+    if Image is None:
+        return data
+    with Image.open(io.BytesIO(data)) as img:
+        img = img.convert("RGB")
+        if img.width > width:
+            img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        return out.getvalue()
+
+
+class ThumbnailCache:
+    """Resized thumbnails in a memory LRU backed by an LRU-by-access-time disk cache."""
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES,
+                 memory_entries=DEFAULT_MEMORY_ENTRIES, width=DEFAULT_WIDTH):
+        """
+        :param directory: Where resized thumbnails are stored
+        :param max_bytes: Disk budget; 0 keeps thumbnails in memory only
+        :param memory_entries: Number of thumbnails kept in memory
+        :param width: Width thumbnails are downsized to, in pixels
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.width = width
+        self._memory = OrderedDict()
+        self._failures = {}
+        self._fetching = {}
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="thumbnails")
+
+    def _key(self, url : str):
+        return hashlib.sha256(f"{url}:{self.width}".encode("utf-8")).hexdigest()
+
+    def _path(self, key : str):
+        return os.path.join(self.directory, key[:2], key + ".jpg")
+
+    def _remember(self, key, data):
+        with self._lock:
+            self._memory[key] = data
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def _read_disk(self, key):
+        if not self.max_bytes:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def _write_disk(self, key, data):
+        if not self.max_bytes:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Failed to cache thumbnail: {e}")
+            return
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(data)
+            over = self._disk_bytes is None or self._disk_bytes > self.max_bytes
+        if over:
+            self.evict(keep=path)
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith(".tmp_"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self, keep=None):
+        """Removes least recently used thumbnails until the disk cache fits its budget."""
+        with self._lock:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError as e:
+                    logging.warning(f"Failed to evict cached thumbnail {path}: {e}")
+            self._disk_bytes = total
+
+    def _load(self, url : str):
+        """Disk, then network; runs on the fetch pool."""
+        key = self._key(url)
+        data = self._read_disk(key)
+        if data is not None:
+            THUMBNAIL_REQUESTS.inc(source="disk")
+        else:
+            try:
+                response = transport.request(url, timeout=FETCH_TIMEOUT)
+                data = resize_image(response.read(), self.width)
+            except Exception as e:
+                logging.warning("Failed to fetch thumbnail %s: %s", url, e)
+                THUMBNAIL_REQUESTS.inc(source="error")
+                with self._lock:
+                    self._failures[url] = time.monotonic()
+                return None
+            THUMBNAIL_REQUESTS.inc(source="fetch")
+            self._write_disk(key, data)
+        self._remember(key, data)
+        return data
+
+    def _submit(self, url : str):
+        """The future loading `url`, shared with any load already running."""
+        with self._lock:
+            future = self._fetching.get(url)
+            if future is not None:
+                return future
+            future = self._fetching[url] = self._pool.submit(self._load, url)
+        # Outside the lock: the callback runs right here if the load already finished
+        future.add_done_callback(lambda _: self._forget(url))
+        return future
+
+    def _forget(self, url):
+        with self._lock:
+            self._fetching.pop(url, None)
+
+    def _peek(self, url : str):
+        key = self._key(url)
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+        return data
+
+    def cached(self, url : str):
+        """
+        The resized thumbnail if it is in memory, without touching disk or network.
+        :rtype: bytes | None
+        """
+        data = self._peek(url)
+        if data is not None:
+            THUMBNAIL_REQUESTS.inc(source="memory")
+        return data
+
+    def _recently_failed(self, url):
+        with self._lock:
+            failed_at = self._failures.get(url)
+            if failed_at is not None and time.monotonic() - failed_at > FAILURE_TTL:
+                del self._failures[url]
+                failed_at = None
+        return failed_at is not None
+
+    def prefetch(self, urls):
+        """Starts loading thumbnails in the background; already cached ones are skipped."""
+        for url in urls:
+            if url and self._key(url) not in self._memory and not self._recently_failed(url):
+                self._submit(url)
+
+    def get(self, url : str, timeout=FETCH_TIMEOUT):
+        """
+        The resized thumbnail, loading it if needed.
+        :return: JPEG bytes, or None if it could not be loaded
+        :rtype: bytes | None
+        """
+        if not url:
+            return None
+        data = self.cached(url)
+        if data is not None or self._recently_failed(url):
+            return data
+        try:
+            return self._submit(url).result(timeout=timeout)
+        except Exception:
+            return None
+
+    def get_many(self, urls, timeout=FETCH_TIMEOUT):
+        """
+        Loads a batch of thumbnails in parallel.
+        :return: {url: JPEG bytes or None}
+        :rtype: dict
+        """
+        urls = [url for url in dict.fromkeys(urls) if url]
+        self.prefetch(urls)
+        pending = [self._fetching.get(url) for url in urls]
+        wait([future for future in pending if future is not None], timeout=timeout)
+        return {url: self._peek(url) for url in urls}
+
+    def stats(self):
+        """
+        Memory and disk usage.
+        :rtype: dict
+        """
+        entries = self._entries() if self.max_bytes else []
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_bytes": sum(len(data) for data in self._memory.values()),
+                "files": len(entries),
+                "bytes": sum(size for _, size, _ in entries),
+                "max_bytes": self.max_bytes,
+                "fetching": len(self._fetching),
+            }
+
+
+thumbnail_cache = ThumbnailCache(
+    directory=os.environ.get("YTD_THUMBNAIL_CACHE_DIR", DEFAULT_CACHE_DIR),
+    max_bytes=int(os.environ.get("YTD_THUMBNAIL_CACHE_BYTES", DEFAULT_MAX_BYTES)),
+)
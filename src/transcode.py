@@ -0,0 +1,133 @@
+"""
+    Audio transcoding with FFmpeg, pipelined with the download.
+    Bytes are written into the encoder's stdin as they arrive, so encoding
+    overlaps the network transfer. Every encoder is a single-threaded FFmpeg
+    process and at most one runs per CPU core, process-wide, so playlist-wide
+    audio jobs use all cores without oversubscribing them.
+"""
+
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+from src.metrics import phase, ENCODERS_WAITING, ENCODERS_RUNNING, TRANSCODE_TAIL_SECONDS
+
+# Output formats offered for audio downloads. "m4a" is YouTube's own AAC
+# stream and is returned as downloaded, without an FFmpeg pass.
+AUDIO_FORMATS = {
+    "mp3": {"ext": ".mp3", "mime": "audio/mpeg", "codec": "libmp3lame", "muxer": "mp3"},
+    "m4a": {"ext": ".m4a", "mime": "audio/mp4", "codec": None, "muxer": None},
+    "opus": {"ext": ".opus", "mime": "audio/ogg", "codec": "libopus", "muxer": "ogg"},
+    "ogg": {"ext": ".ogg", "mime": "audio/ogg", "codec": "libvorbis", "muxer": "ogg"},
+    "flac": {"ext": ".flac", "mime": "audio/flac", "codec": "flac", "muxer": "flac"},
+}
+AUDIO_BITRATES = ["320k", "256k", "192k", "128k", "96k"]
+DEFAULT_AUDIO_FORMAT = "mp3"
+DEFAULT_BITRATE = "192k"
+MAX_ENCODERS = int(os.environ.get("YTD_MAX_ENCODERS", 0)) or os.cpu_count() or 1
+
+# Shared by every session and playlist worker
+_encoder_slots = threading.BoundedSemaphore(MAX_ENCODERS)
+
+
+class TranscodeError(Exception):
+    """Raised when FFmpeg fails to transcode an audio stream."""
+
+
+def needs_transcode(fmt : str):
+    """True if `fmt` is produced by FFmpeg rather than served as downloaded."""
+    return audio_format(fmt)["codec"] is not None
+
+
+def audio_format(fmt : str):
+    """
+    Looks up an output format.
+    :raises ValueError: For unknown formats
+    :rtype: dict
+    """
+    try:
+        return AUDIO_FORMATS[fmt]
+    except KeyError:
+        raise ValueError(f"Unsupported audio format {fmt!r}; choose one of {', '.join(AUDIO_FORMATS)}") from None
+
+
+def ffmpeg_transcode_cmd(fmt : str, bitrate : str, output_path : str, input_path="pipe:0"):
+    """
+    Builds the FFmpeg command that encodes the audio of `input_path` (stdin by default).
+    :return: The command as an argument list
+    :rtype: list[str]
+    """
+    spec = audio_format(fmt)
+    cmd = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-i", input_path,
+        "-vn", "-map", "0:a:0",
+        "-c:a", spec["codec"],
+        # One core per encoder; concurrency comes from running several encoders
+        "-threads", "1",
+    ]
+    if spec["codec"] != "flac":
+        cmd += ["-b:a", bitrate]
+    return cmd + ["-f", spec["muxer"], output_path]
+
+
+def transcode_stream(download, fmt=DEFAULT_AUDIO_FORMAT, bitrate=DEFAULT_BITRATE, output_path=None):
+    """
+    Downloads a stream straight into an FFmpeg encoder.
+    Waits for a free encoder slot first, so the download only starts when it can be consumed.
+    The input must be streamable (YouTube's fragmented M4A and WebM audio are).
+    :param download: Callable (fileobj) that writes the stream into fileobj
+    :param fmt: Output format, a key of AUDIO_FORMATS that needs transcoding
+    :param bitrate: Target bitrate such as "192k" (ignored for lossless formats)
+    :param output_path: Where the encoded file is written; a temp file by default
+    :return: The path of the encoded file
+    :rtype: str
+    :raises TranscodeError: If FFmpeg fails
+    """
+    if output_path is None:
+        fd, output_path = tempfile.mkstemp(prefix="ytaudio_", suffix=audio_format(fmt)["ext"])
+        os.close(fd)
+
+    with ENCODERS_WAITING.track_inprogress():
+        _encoder_slots.acquire()
+    try:
+        with ENCODERS_RUNNING.track_inprogress(), phase("transcode", codec=audio_format(fmt)["codec"]), \
+                tempfile.TemporaryFile() as stderr_file:
+            proc = subprocess.Popen(
+                ffmpeg_transcode_cmd(fmt, bitrate, output_path),
+                stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr_file
+            )
+            broken_pipe = False
+            try:
+                try:
+                    download(proc.stdin)
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    # FFmpeg exited early; its stderr explains why
+                    broken_pipe = True
+                inputs_done = time.perf_counter()
+                returncode = proc.wait()
+                TRANSCODE_TAIL_SECONDS.observe(time.perf_counter() - inputs_done)
+            finally:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+                try:
+                    proc.stdin.close()
+                except (BrokenPipeError, OSError):
+                    pass
+            if returncode != 0 or broken_pipe:
+                stderr_file.seek(0)
+                raise TranscodeError(stderr_file.read().decode("utf-8", errors="replace")
+                                     or "FFmpeg stopped reading its input.")
+    except BaseException:
+        try:
+            os.remove(output_path)
+        except OSError:
+            pass
+        raise
+    finally:
+        _encoder_slots.release()
+    return output_path
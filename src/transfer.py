@@ -0,0 +1,568 @@
+"""
+    Parallel ranged transfer engine for pytubefix streams.
+    Splits a stream's known filesize into byte ranges, fetches them over
+    several concurrent connections and writes them back in order.
+    Large transfers can be made resumable: completed ranges are kept in a
+    partial file with a small JSON sidecar, so a retry continues where it stopped.
+"""
+
+import http.client
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.error import HTTPError, URLError
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from pytubefix import request
+from src.transport import transport
+from src.metrics import (phase, TRANSFER_BYTES, TRANSFER_RESUMED_BYTES, TRANSFER_RETRIES,
+                         TRANSFER_URL_REFRESHES, TRANSFER_THROUGHPUT)
+from src.scheduler import scheduler
+from src.resilience import breaker, retry_delay, wait_before_retry, CircuitOpenError
+
+DEFAULT_CONNECTIONS = 4
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_TIMEOUT = 30
+
+PARTIAL_DIR = os.path.join(tempfile.gettempdir(), "ytd_partials")
+PARTIAL_MAX_AGE = 24 * 60 * 60       # partial downloads older than a day are discarded
+SIDECAR_SAVE_INTERVAL = 1.0          # seconds between sidecar writes
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# HTTP statuses YouTube returns once a deciphered stream URL has expired
+EXPIRED_URL_STATUSES = (403, 410)
+
+
+class TransferError(Exception):
+    """Raised when a byte range could not be fetched after all retries."""
+
+
+def plan_ranges(total : int, chunk_size : int):
+    """
+    Splits a file of `total` bytes into inclusive (start, end) byte ranges.
+    :param total: The size of the file in bytes
+    :param chunk_size: The size of each range in bytes
+    :return: A list of (start, end) tuples
+    :rtype: list[tuple[int, int]]
+    """
+    return [(start, min(start + chunk_size, total) - 1) for start in range(0, total, chunk_size)]
+
+
+class StreamUrl:
+    """
+    The signed URL of a stream, shared by all workers of one transfer.
+    When YouTube rejects it as expired, the first worker to notice asks
+    `refresh` for a new one; the others pick that up instead of refreshing again.
+    """
+
+    def __init__(self, url : str, refresh=None):
+        self.url = url
+        self._refresh = refresh
+        self._lock = threading.Lock()
+
+    def refresh(self, stale_url : str):
+        """
+        Replaces `stale_url` with a freshly resolved one.
+        :return: The current URL
+        :raises TransferError: If no refresh callback was given
+        """
+        with self._lock:
+            if self.url != stale_url:
+                return self.url
+            if self._refresh is None:
+                raise TransferError("Stream URL expired and cannot be refreshed.")
+            logging.info("Stream URL expired, resolving a new one")
+            TRANSFER_URL_REFRESHES.inc()
+            self.url = self._refresh()
+            return self.url
+
+
+def fetch_range(url : str, start : int, end : int, timeout=DEFAULT_TIMEOUT):
+    """
+    Fetches a single byte range of a stream URL.
+    YouTube expects the range as a `range=` query parameter instead of a header.
+    The request goes over a pooled keep-alive connection.
+    :return: The bytes of the range
+    :rtype: bytes
+    """
+    response = transport.request(f"{url}&range={start}-{end}", method="GET", timeout=timeout)
+    try:
+        data = response.read()
+    except http.client.IncompleteRead as e:
+        data = e.partial
+    expected = end - start + 1
+    if len(data) != expected:
+        # A dropped connection; retried like any other network error
+        raise http.client.IncompleteRead(data, expected - len(data))
+    TRANSFER_BYTES.inc(len(data))
+    return data
+
+
+def fetch_range_with_retry(url, start : int, end : int, max_retries=DEFAULT_MAX_RETRIES, timeout=DEFAULT_TIMEOUT,
+                           session=None):
+    """
+    Fetches a byte range, retrying only that range on transient errors.
+    Retries back off by the error's policy in src.resilience (honouring Retry-After),
+    and every attempt passes the shared circuit breaker, so all transfers slow
+    down together while YouTube throttles. An expired URL is refreshed once
+    per expiry and does not count as a retry. Every attempt first waits for
+    its bytes from the shared bandwidth scheduler.
+    :param url: The stream URL as a string, or a `StreamUrl`
+    :param max_retries: Upper bound on retries, whatever the error's policy allows
+    :param session: Who the bytes are for, for per-session bandwidth limits and fair queuing
+    :raises TransferError: If the range fails with an error that is not retried, after the last retry,
+        or when the circuit breaker stays open too long
+    """
+    source = url if isinstance(url, StreamUrl) else StreamUrl(url)
+    tries = 0
+    refreshed = False
+    while True:
+        current = source.url
+        scheduler.throttle(end - start + 1, session)
+        try:
+            breaker.before()
+        except CircuitOpenError as e:
+            raise TransferError(f"Range {start}-{end} failed: {e}") from e
+        try:
+            data = fetch_range(current, start, end, timeout=timeout)
+        except HTTPError as e:
+            breaker.record(e)
+            if e.code in EXPIRED_URL_STATUSES and not refreshed:
+                source.refresh(current)
+                refreshed = True
+                continue
+            error = e
+        except (URLError, http.client.HTTPException, socket.timeout, OSError) as e:
+            breaker.record(e)
+            error = e
+        except BaseException:
+            # Anything else ends the transfer; a probe must not stay taken
+            breaker.abort()
+            raise
+        else:
+            breaker.record()
+            return data
+        delay = retry_delay(error, tries, max_retries)
+        if delay is None:
+            raise TransferError(f"Range {start}-{end} failed after {tries} retries: {error}") from error
+        TRANSFER_RETRIES.inc()
+        wait_before_retry("range", error, delay, tries)
+        tries += 1
+
+
+class ResumeState:
+    """
+    A partial download on disk: `<path>.part` holds the data written so far
+    at its final offsets, and `<path>.part.json` records the completed byte ranges.
+    """
+
+    def __init__(self, path : str, total : int, chunk_size : int):
+        """
+        :param path: Final path of the file; the partial lives next to it
+        :param total: Size of the complete file in bytes
+        :param chunk_size: Range size; a sidecar written with another size is ignored
+        """
+        self.path = path
+        self.part_path = path + ".part"
+        self.sidecar_path = path + ".part.json"
+        self.total = total
+        self.chunk_size = chunk_size
+        self._ranges = plan_ranges(total, chunk_size)
+        self._done = set()
+        self._lock = threading.Lock()
+        self._last_save = 0.0
+        self._load()
+        self._file = open(self.part_path, "r+b" if os.path.exists(self.part_path) else "w+b")
+        self._file.truncate(total)
+
+    def _load(self):
+        try:
+            with open(self.sidecar_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("total") != self.total or data.get("chunk_size") != self.chunk_size \
+                or not os.path.exists(self.part_path):
+            return
+        for start, end in data.get("done", []):
+            for index in range(start // self.chunk_size, (end + 1) // self.chunk_size + 1):
+                if index < len(self._ranges):
+                    r_start, r_end = self._ranges[index]
+                    if start <= r_start and r_end <= end:
+                        self._done.add(index)
+
+    def done_ranges(self):
+        """
+        Completed byte ranges, merged.
+        :rtype: list[list[int]]
+        """
+        merged = []
+        for index in sorted(self._done):
+            start, end = self._ranges[index]
+            if merged and merged[-1][1] + 1 == start:
+                merged[-1][1] = end
+            else:
+                merged.append([start, end])
+        return merged
+
+    @property
+    def bytes_done(self):
+        return sum(end - start + 1 for start, end in (self._ranges[i] for i in self._done))
+
+    def is_done(self, index : int):
+        return index in self._done
+
+    def write(self, index : int, data : bytes):
+        """Writes a completed range at its offset and records it."""
+        with self._lock:
+            self._file.seek(self._ranges[index][0])
+            self._file.write(data)
+            self._done.add(index)
+            if time.monotonic() - self._last_save >= SIDECAR_SAVE_INTERVAL:
+                self._save()
+
+    def read(self, index : int):
+        with self._lock:
+            start, end = self._ranges[index]
+            self._file.seek(start)
+            return self._file.read(end - start + 1)
+
+    def _save(self):
+        # The data must be on disk before the sidecar claims it is
+        self._file.flush()
+        tmp_path = self.sidecar_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"total": self.total, "chunk_size": self.chunk_size, "done": self.done_ranges()}, f)
+        os.replace(tmp_path, self.sidecar_path)
+        self._last_save = time.monotonic()
+
+    def close(self):
+        """Saves progress and closes the partial file, keeping it for a later resume."""
+        with self._lock:
+            if self._file.closed:
+                return
+            try:
+                self._save()
+            except OSError as e:
+                logging.warning(f"Failed to save resume state for {self.path}: {e}")
+            self._file.close()
+
+    def finish(self):
+        """Moves the complete partial file to its final path and drops the sidecar."""
+        with self._lock:
+            self._file.close()
+            os.replace(self.part_path, self.path)
+            try:
+                os.remove(self.sidecar_path)
+            except OSError:
+                pass
+
+
+def _sequential_download(stream, output, on_progress=None, session=None):
+    """Fallback for streams without a known filesize: one connection, in order."""
+    written = 0
+    total = getattr(stream, 'filesize_approx', 0) or 0
+    started = time.perf_counter()
+    with phase("transfer", mode="sequential"):
+        for chunk in request.stream(stream.url):
+            scheduler.throttle(len(chunk), session)
+            output.write(chunk)
+            written += len(chunk)
+            TRANSFER_BYTES.inc(len(chunk))
+            if on_progress:
+                on_progress(stream, chunk, max(total - written, 0))
+    _observe_throughput(written, time.perf_counter() - started)
+    return written
+
+
+def _observe_throughput(fetched : int, seconds : float):
+    """Records the network throughput of one finished transfer."""
+    if fetched > 0 and seconds > 0:
+        TRANSFER_THROUGHPUT.observe(fetched / seconds)
+
+
+def parallel_download(stream, output, connections=DEFAULT_CONNECTIONS, chunk_size=None,
+                      max_retries=DEFAULT_MAX_RETRIES, on_progress=None, timeout=DEFAULT_TIMEOUT,
+                      state=None, refresh_url=None, session=None, span=None):
+    """
+    Downloads a stream over several connections into a writable file object.
+    Ranges are written strictly in order, so `output` may be a pipe.
+    At most `connections * 2` ranges are held in memory at any time.
+    Progress is reported from the calling thread, which keeps Streamlit happy.
+    :param stream: The pytubefix stream to download
+    :param output: A writable binary file object, or None to only fill `state`
+    :param connections: Number of concurrent connections
+    :param chunk_size: Size of each range in bytes, defaults to `request.default_range_size`
+    :param max_retries: Retries per range before the whole transfer fails
+    :param on_progress: Callback with the pytubefix signature (stream, chunk, bytes_remaining)
+    :param state: Optional `ResumeState`; ranges it already has are not fetched again
+    :param refresh_url: Optional callable returning a fresh URL when the current one expires
+    :param session: Who the transfer is for, see `src.scheduler`
+    :param span: Optional inclusive (first, last) byte range to download instead of the whole
+        stream; progress then counts down the bytes left in the span
+    :return: The number of bytes transferred (including resumed bytes)
+    :rtype: int
+    """
+    if span is not None:
+        if state is not None:
+            raise ValueError("A partial span cannot be resumed.")
+        first, last = span
+        total = last - first + 1
+    else:
+        first = 0
+        total = getattr(stream, 'filesize', 0) or 0
+        if total <= 0:
+            return _sequential_download(stream, output, on_progress, session)
+
+    chunk_size = state.chunk_size if state else (chunk_size or request.default_range_size)
+    connections = max(1, int(connections or 1))
+    ranges = [(start + first, end + first) for start, end in plan_ranges(total, chunk_size)]
+    window = connections * 2
+    source = StreamUrl(stream.url, refresh_url)
+    todo = [i for i in range(len(ranges)) if not (state and state.is_done(i))]
+
+    pending = {}
+    futures = {}
+    next_submit = 0
+    next_write = 0
+    written = 0
+    resumed = 0
+
+    started = time.perf_counter()
+    pool = ThreadPoolExecutor(max_workers=connections, thread_name_prefix="transfer")
+    try:
+        with phase("transfer", mode="parallel"):
+            while next_write < len(ranges):
+                # Keep the pool busy, but never run more than `window` ranges ahead of the writer
+                while next_submit < len(todo) and todo[next_submit] < next_write + window:
+                    index = todo[next_submit]
+                    start, end = ranges[index]
+                    futures[pool.submit(fetch_range_with_retry, source, start, end, max_retries, timeout, session)] = index
+                    next_submit += 1
+
+                if state and state.is_done(next_write) and next_write not in pending:
+                    # Resumed range: replay it from the partial file if someone is reading
+                    data = state.read(next_write) if output is not None else b""
+                    start, end = ranges[next_write]
+                    written += end - start + 1
+                    resumed += end - start + 1
+                    next_write += 1
+                    if output is not None:
+                        output.write(data)
+                    if on_progress:
+                        on_progress(stream, data, total - written)
+                    continue
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = futures.pop(future)
+                    data = future.result()
+                    if state:
+                        state.write(index, data)
+                    pending[index] = data
+
+                while next_write in pending:
+                    data = pending.pop(next_write)
+                    if output is not None:
+                        output.write(data)
+                    written += len(data)
+                    next_write += 1
+                    if on_progress:
+                        on_progress(stream, data, total - written)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        if source.url != stream.url:
+            stream.url = source.url
+
+    TRANSFER_RESUMED_BYTES.inc(resumed)
+    _observe_throughput(written - resumed, time.perf_counter() - started)
+    return written
+
+
+def _lock_file(fd):
+    """Blocks until this process holds an exclusive lock on the open file `fd`."""
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return
+    while True:
+        try:
+            # Gives up after about ten seconds; keep waiting like flock does
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+
+def _unlock_file(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+class PartialLock:
+    """
+    Serialises work on one partial path across threads and processes (job
+    workers share PARTIAL_DIR): a per-path lock in this process plus an OS lock
+    on `<path>.lock`. Reentrant within a thread, so a caller can hold it across
+    a download and the handoff of the finished file.
+    """
+
+    def __init__(self, path : str):
+        self.lock_path = path + ".lock"
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._depth == 0:
+            try:
+                fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    _lock_file(fd)
+                    # Keeps purge_stale_partials from removing a lock file that is in use
+                    os.utime(self.lock_path)
+                except BaseException:
+                    os.close(fd)
+                    raise
+            except BaseException:
+                self._lock.release()
+                raise
+            self._fd = fd
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            fd, self._fd = self._fd, None
+            try:
+                _unlock_file(fd)
+            finally:
+                os.close(fd)
+        self._lock.release()
+        return False
+
+
+_partial_locks = {}
+_partial_locks_guard = threading.Lock()
+
+
+def partial_lock(path : str):
+    """
+    The lock guarding a partial path, see `PartialLock`.
+    Hold it while the finished file at `path` is read or moved away.
+    :rtype: PartialLock
+    """
+    with _partial_locks_guard:
+        lock = _partial_locks.get(path)
+        if lock is None:
+            lock = _partial_locks[path] = PartialLock(path)
+        return lock
+
+
+def partial_path(video_id : str, itag : int, directory=PARTIAL_DIR):
+    """
+    The stable path a stream is downloaded to, so a new request for the same stream resumes it.
+    Stale partials in `directory` are discarded on the way.
+    :rtype: str
+    """
+    os.makedirs(directory, exist_ok=True)
+    purge_stale_partials(directory)
+    return os.path.join(directory, f"{video_id}_{itag}")
+
+
+def purge_stale_partials(directory=PARTIAL_DIR, max_age=PARTIAL_MAX_AGE):
+    """Removes partial downloads that have not been touched for `max_age` seconds."""
+    cutoff = time.time() - max_age
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def discard_partial(path : str):
+    """Removes a downloaded file together with any partial data and sidecar."""
+    # Waits for anyone still downloading or replaying it, e.g. another job worker
+    with partial_lock(path):
+        for p in (path, path + ".part", path + ".part.json"):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+
+def resumable_download(stream, path : str, output=None, connections=DEFAULT_CONNECTIONS, chunk_size=None,
+                       max_retries=DEFAULT_MAX_RETRIES, on_progress=None, timeout=DEFAULT_TIMEOUT,
+                       refresh_url=None, session=None):
+    """
+    Downloads a stream to `path`, resuming from a previous partial download if there is one.
+    On failure the partial file and its sidecar are kept for the next attempt.
+    Other threads and processes working on the same path are waited for (see `partial_lock`).
+    :param path: Final path of the file, usually from `partial_path`
+    :param output: Optional file object (e.g. an FFmpeg pipe) that also receives the bytes in order
+    :return: `path`, once the file is complete
+    :rtype: str
+    :raises TransferError: If a range fails after all retries
+    :raises ValueError: If the stream's filesize is unknown
+    """
+    total = getattr(stream, 'filesize', 0) or 0
+    if total <= 0:
+        raise ValueError("Resumable downloads need a known filesize.")
+    chunk_size = chunk_size or request.default_range_size
+
+    with partial_lock(path):
+        if os.path.exists(path) and os.path.getsize(path) == total:
+            # Finished earlier (e.g. the merge failed afterwards): replay it from disk
+            logging.info("Using already downloaded file %s", path)
+            with open(path, "rb") as f:
+                written = 0
+                while True:
+                    data = f.read(COPY_CHUNK_SIZE)
+                    if not data:
+                        break
+                    written += len(data)
+                    if output is not None:
+                        output.write(data)
+                    if on_progress:
+                        on_progress(stream, data, total - written)
+            return path
+
+        state = ResumeState(path, total, chunk_size)
+        if state.bytes_done:
+            logging.info("Resuming %s from %s of %s bytes", path, state.bytes_done, total)
+        try:
+            parallel_download(
+                stream, output,
+                connections=connections,
+                max_retries=max_retries,
+                on_progress=on_progress,
+                timeout=timeout,
+                state=state,
+                refresh_url=refresh_url,
+                session=session
+            )
+        except BaseException:
+            state.close()
+            raise
+        state.finish()
+        return path
@@ -0,0 +1,340 @@
+"""
+    Pooled keep-alive HTTP transport shared by every download and metadata fetch.
+    pytubefix opens a new urllib connection for every request; here one
+    process-wide pool keeps connections to each host alive and reuses them
+    across byte ranges, sessions and metadata calls. `install()` routes
+    pytubefix's own requests (watch pages, InnerTube, playlists) through it.
+    The default backend is urllib3 (HTTP/1.1); set YTD_HTTP2=1 to use httpx
+    with HTTP/2 when `httpx[http2]` is installed. YTD_HTTP_POOL_SIZE sets the
+    number of kept-alive connections per host. pytubefix's requests also go
+    through the shared retry policies and circuit breaker (src.resilience).
+"""
+
+import http.client
+import io
+import json
+import logging
+import os
+import socket
+import threading
+from collections import Counter
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+from urllib.request import getproxies
+
+import urllib3
+from pytubefix import request as pytube_request
+
+from src.metrics import HTTP_REQUESTS, HTTP_CONNECTIONS
+from src import resilience
+
+try:
+    import httpx
+    import h2  # noqa: F401  (httpx needs it for HTTP/2)
+except ImportError:
+    httpx = None
+
+DEFAULT_POOL_SIZE = 32               # kept-alive connections per host
+MAX_REDIRECTS = 5
+# Same headers pytubefix sends
+BASE_HEADERS = {"User-Agent": "Mozilla/5.0", "accept-language": "en-US,en"}
+
+
+def _timeout(timeout):
+    """pytubefix passes socket's "global default" sentinel; anything but a number means no timeout."""
+    return timeout if isinstance(timeout, (int, float)) else None
+
+
+def _prepare(method, headers, data):
+    """Builds the method, headers and body the way pytubefix's `_execute_request` does."""
+    merged = dict(BASE_HEADERS)
+    if headers:
+        merged.update(headers)
+    if data and not isinstance(data, bytes):
+        data = bytes(json.dumps(data), encoding="utf-8")
+    return method or ("POST" if data else "GET"), merged, data
+
+
+def _http_error(url, status, reason, headers, body):
+    return HTTPError(url, status, reason, headers, io.BytesIO(body))
+
+
+class PooledResponse:
+    """
+    The part of `urlopen`'s response interface pytubefix and src.transfer use.
+    The connection goes back to the pool once the body has been read, or when
+    the response is closed or garbage collected: pytubefix's `request.stream`
+    drops responses it stops reading (its Content-Length probe and any stream
+    the caller abandons), and those must not take their connection with them.
+    """
+
+    def __init__(self, url, status, reason, headers, read, release):
+        self.url = url
+        self.status = self.code = status
+        self.reason = reason
+        self.headers = headers
+        self._read = read
+        self._release = release
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def read(self, amt=None):
+        data = self._read(amt)
+        if amt is None or not data:
+            self.close()
+        return data
+
+    def close(self):
+        if self._release is not None:
+            self._release()
+            self._release = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            # Too late to report anything; the pool replaces a broken connection
+            pass
+
+
+def _counting_pool(pool_cls, on_connect):
+    """A pool class whose connections report every (re)connect, which urllib3 does not count."""
+    class Connection(pool_cls.ConnectionCls):
+        def connect(self):
+            super().connect()
+            on_connect(self.host)
+
+    return type(pool_cls.__name__, (pool_cls,), {"ConnectionCls": Connection})
+
+
+class _Urllib3Backend:
+    protocol = "HTTP/1.1"
+
+    def __init__(self, pool_size):
+        self._opened = Counter()
+        self._lock = threading.Lock()
+        # Connection errors on a reused keep-alive connection are retried once on
+        # a fresh one; every other retry is left to the callers, as with urlopen
+        retries = urllib3.Retry(total=None, connect=1, read=1, status=0, other=0,
+                                redirect=MAX_REDIRECTS, raise_on_status=False)
+        kwargs = dict(num_pools=64, maxsize=pool_size, block=False, retries=retries)
+        proxy = getproxies().get("https")
+        self.manager = urllib3.ProxyManager(proxy, **kwargs) if proxy else urllib3.PoolManager(**kwargs)
+        self.manager.pool_classes_by_scheme = {
+            "http": _counting_pool(urllib3.HTTPConnectionPool, self._on_connect),
+            "https": _counting_pool(urllib3.HTTPSConnectionPool, self._on_connect),
+        }
+
+    def _on_connect(self, host):
+        with self._lock:
+            self._opened[host] += 1
+
+    def send(self, url, method, headers, data, timeout):
+        try:
+            response = self.manager.request(method, url, headers=headers, body=data, timeout=timeout,
+                                            preload_content=False)
+        except urllib3.exceptions.MaxRetryError as e:
+            raise URLError(e.reason) from e
+        except urllib3.exceptions.HTTPError as e:
+            raise URLError(e) from e
+
+        if response.status >= 400:
+            body = self._read(response, None)
+            self._release(response)
+            raise _http_error(url, response.status, response.reason, response.headers, body)
+        return PooledResponse(url, response.status, response.reason, response.headers,
+                              lambda amt: self._read(response, amt), lambda: self._release(response))
+
+    @staticmethod
+    def _release(response):
+        if not (response.closed or response.length_remaining == 0):
+            # Unread body bytes would corrupt the next request on this connection
+            response.close()
+        response.release_conn()
+
+    @staticmethod
+    def _read(response, amt):
+        try:
+            return response.read(amt)
+        except urllib3.exceptions.ReadTimeoutError as e:
+            raise socket.timeout(str(e)) from e
+        except urllib3.exceptions.ProtocolError as e:
+            # Surfaces like urlopen's errors so existing retry handling applies
+            if any(isinstance(arg, http.client.IncompleteRead) for arg in e.args):
+                raise http.client.IncompleteRead(b"") from e
+            raise ConnectionError(str(e)) from e
+
+    def pools(self):
+        """(host, connections opened, idle connections) per host."""
+        idle = Counter()
+        for key in list(self.manager.pools.keys()):
+            pool = self.manager.pools.get(key)
+            if pool is not None and pool.pool is not None:
+                idle[pool.host] += sum(1 for conn in list(pool.pool.queue)
+                                       if conn is not None and getattr(conn, "sock", None) is not None)
+        with self._lock:
+            opened = dict(self._opened)
+        for host in set(opened) | set(idle):
+            yield host, opened.get(host, 0), idle[host]
+
+    def close(self):
+        self.manager.clear()
+
+
+class _Http2Backend:
+    protocol = "HTTP/2"
+
+    def __init__(self, pool_size):
+        self.client = httpx.Client(
+            http2=True, follow_redirects=True, max_redirects=MAX_REDIRECTS, timeout=None,
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=pool_size),
+        )
+
+    def send(self, url, method, headers, data, timeout):
+        try:
+            response = self.client.send(
+                self.client.build_request(method, url, headers=headers, content=data, timeout=timeout),
+                stream=True
+            )
+        except httpx.TimeoutException as e:
+            raise URLError(socket.timeout(str(e))) from e
+        except httpx.TransportError as e:
+            raise URLError(e) from e
+
+        if response.status_code >= 400:
+            body = self._read(response)
+            raise _http_error(url, response.status_code, response.reason_phrase, response.headers, body)
+        body = None
+
+        def read(amt):
+            nonlocal body
+            if body is None:
+                body = io.BytesIO(self._read(response))
+            return body.read(-1 if amt is None else amt)
+        return PooledResponse(url, response.status_code, response.reason_phrase, response.headers, read, response.close)
+
+    @staticmethod
+    def _read(response):
+        try:
+            return response.read()
+        except httpx.TimeoutException as e:
+            raise socket.timeout(str(e)) from e
+        except httpx.TransportError as e:
+            raise ConnectionError(str(e)) from e
+        finally:
+            response.close()
+
+    def pools(self):
+        # httpx does not count opened connections; report the open ones instead
+        pool = getattr(getattr(self.client, "_transport", None), "_pool", None)
+        by_host = Counter()
+        idle = Counter()
+        for conn in list(getattr(pool, "connections", [])):
+            host = conn._origin.host.decode("ascii", errors="replace")
+            by_host[host] += 1
+            if conn.is_idle():
+                idle[host] += 1
+        for host, count in by_host.items():
+            yield host, count, idle[host]
+
+    def close(self):
+        self.client.close()
+
+
+class Transport:
+    """One connection pool per process, used by transfers and by pytubefix."""
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, http2=False):
+        """
+        :param pool_size: Kept-alive connections per host; busier hosts open extra, short-lived ones
+        :param http2: Use httpx with HTTP/2; falls back to urllib3 when httpx[http2] is missing
+        """
+        if http2 and httpx is None:
+            logging.warning("HTTP/2 needs `pip install httpx[http2]`; using HTTP/1.1 keep-alive instead")
+            http2 = False
+        self.pool_size = pool_size
+        self.backend = _Http2Backend(pool_size) if http2 else _Urllib3Backend(pool_size)
+        self._requests = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def protocol(self):
+        return self.backend.protocol
+
+    def request(self, url : str, method=None, headers=None, data=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        """
+        Sends a request on a pooled connection; a drop-in for pytubefix's `request._execute_request`.
+        :return: A response with `read()` and `info()`
+        :rtype: PooledResponse
+        :raises HTTPError: For 4xx/5xx responses, like urlopen
+        :raises URLError: If the host cannot be reached
+        """
+        if not url.lower().startswith("http"):
+            raise ValueError("Invalid URL")
+        method, headers, data = _prepare(method, headers, data)
+        with self._lock:
+            self._requests[urlsplit(url).hostname] += 1
+        HTTP_REQUESTS.inc()
+        response = self.backend.send(url, method, headers, data, _timeout(timeout))
+        if method == "HEAD":
+            # There is no body to read, and callers only look at the headers
+            response.close()
+        return response
+
+    def stats(self):
+        """
+        Pool size and connection reuse per host.
+        :rtype: dict
+        """
+        with self._lock:
+            requests = dict(self._requests)
+        hosts = {}
+        for host, opened, idle in self.backend.pools():
+            entry = hosts.setdefault(host, {"requests": requests.get(host, 0), "connections_opened": 0, "idle": 0})
+            entry["connections_opened"] += opened
+            entry["idle"] += idle
+        for entry in hosts.values():
+            entry["reused"] = max(0, entry["requests"] - entry["connections_opened"])
+        total_requests = sum(requests.values())
+        total_opened = sum(entry["connections_opened"] for entry in hosts.values())
+        return {
+            "protocol": self.protocol,
+            "pool_size": self.pool_size,
+            "requests": total_requests,
+            "connections_opened": total_opened,
+            "reuse_ratio": round(1 - total_opened / total_requests, 3) if total_requests else 0.0,
+            "hosts": hosts,
+        }
+
+    def close(self):
+        self.backend.close()
+
+
+def _youtube_request(*args, **kwargs):
+    return resilience.call(lambda: transport.request(*args, **kwargs), kind="youtube")
+
+
+def install():
+    """Routes pytubefix's HTTP requests through the shared pool, with retries and the circuit breaker."""
+    pytube_request._execute_request = _youtube_request
+
+
+transport = Transport(
+    pool_size=int(os.environ.get("YTD_HTTP_POOL_SIZE", 0)) or DEFAULT_POOL_SIZE,
+    http2=os.environ.get("YTD_HTTP2", "").lower() in ("1", "true", "yes"),
+)
+HTTP_CONNECTIONS.set_function(lambda: transport.stats()["connections_opened"], state="opened")
+HTTP_CONNECTIONS.set_function(lambda: sum(h["idle"] for h in transport.stats()["hosts"].values()), state="idle")
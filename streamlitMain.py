@@ -1,7 +1,19 @@
 import streamlit as st
-from src.main import YoutubeDownloader
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+import asyncio
+from src.engine import DownloadEngine
 from src.Safe import safe_filename
-import time
+from src.cache import video_id_from_url
+from src.buffers import SpooledBuffer
+from src.session_buffers import buffer_manager
+from src.bulk import DEFAULT_WORKERS
+from src.thumbnails import thumbnail_cache, video_thumbnail_url
+from src.links import LinkBatch, EXPORT_FORMATS, DEFAULT_WORKERS as DEFAULT_LINK_WORKERS
+from src.clip import parse_timestamp, format_timestamp
+from src.jobs import job_store, worker_pool, ACTIVE_STATUSES, READY_STATUSES, FAILED, PLAYLIST_ZIP
+from src.transcode import AUDIO_FORMATS, AUDIO_BITRATES, DEFAULT_AUDIO_FORMAT, DEFAULT_BITRATE, needs_transcode
+import os, time
 
 # --- Page Config ---
 st.set_page_config(page_title="YouTube Downloader", page_icon="🎬", layout="centered")
@@ -10,25 +22,253 @@ st.title("🚀 YouTube Downloader")
 # --- Initialize Session State ---
 if 'downloader' not in st.session_state:
     st.session_state.downloader = None
-if 'video_buffer' not in st.session_state:
-    st.session_state.video_buffer = None
-if 'audio_buffer' not in st.session_state:
-    st.session_state.audio_buffer = None
-if 'playlist_buffers' not in st.session_state:
-    # This will be a dictionary to hold buffers for each video in the playlist
-    st.session_state.playlist_buffers = {}
+if 'playlist_links' not in st.session_state:
+    # Direct links for every playlist entry, re-resolved only once they expire
+    st.session_state.playlist_links = None
 if 'current_url' not in st.session_state:
     st.session_state.current_url = ""
 
+# --- Engine: all download logic lives in src/, this file only renders ---
+@st.cache_resource
+def get_engine():
+    # One engine per server process, shared by every session
+    return DownloadEngine()
+
+engine = get_engine()
+
+@st.cache_resource
+def get_workers():
+    # Downloads run as jobs in worker processes, so they survive reruns, reconnects and closed tabs
+    return worker_pool.start()
+
+job_workers = get_workers()
+
+def ui_events(progress_bar=None):
+    """Maps engine events onto Streamlit elements; runs on the script thread."""
+    def handle(event):
+        if event.kind == "progress" and progress_bar is not None:
+            progress_bar.progress(event.percent, text=event.text)
+        elif event.kind == "message":
+            if event.level == "error":
+                st.error(event.text)
+            else:
+                st.write(event.text)
+    return handle
+
+def session_id():
+    """This browser session's id; bandwidth and download slots are shared fairly between sessions."""
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else None
+
+# Job files opened for Save are held by the process-wide buffer manager,
+# not in session_state, so all sessions share one memory budget
+def release_buffers(name=None):
+    buffer_manager.release(session_id(), name)
+
+def reap_buffers():
+    """Releases buffers of sessions whose browser tab closed or that sat idle too long."""
+    is_alive = runtime.get_instance().is_active_session if runtime.exists() else None
+    buffer_manager.reap(is_alive)
+
+reap_buffers()
+
+def buffer_usage_caption():
+    stats = buffer_manager.stats()
+    mb = 1024 * 1024
+    st.sidebar.caption(
+        f"Held downloads: {stats['buffers']} across {stats['sessions']} sessions — "
+        f"{stats['memory_bytes'] / mb:,.0f}/{stats['memory_budget'] / mb:,.0f} MB in memory, "
+        f"{stats['disk_bytes'] / mb:,.0f} MB on disk"
+    )
+
+THUMBNAIL_WAIT = 2  # seconds a render waits for thumbnails before falling back to the CDN URL
+
+def thumbnail(url, wait=THUMBNAIL_WAIT):
+    """The locally cached, downsized thumbnail; falls back to the CDN URL if it is not ready in time."""
+    return thumbnail_cache.get(url, timeout=wait) or url
+
+def resolve(url):
+    return asyncio.run(engine.resolve(url, on_event=ui_events()))
+
+# --- Background jobs: ids live in the page URL (?job=...), so a reload or reconnect finds them again ---
+JOB_POLL_SECONDS = 1
+MAX_BROWSER_JOBS = 20
+rendered_jobs = set()  # jobs shown next to their button in this run; the sidebar lists the rest
+
+def browser_jobs():
+    """This page's jobs, oldest first; ids of purged jobs are dropped."""
+    jobs = job_store.get_many(st.query_params.get_all("job"))
+    if len(jobs) != len(st.query_params.get_all("job")):
+        st.query_params["job"] = [job["id"] for job in jobs]
+    return jobs
+
+def submit_job(slot, url, quality, file_name, mime, **options):
+    # Returns the running job instead if anyone already asked for the same download
+    job_id = job_store.submit(url, quality, slot=slot, file_name=file_name, mime=mime, session=session_id(), **options)
+    job_workers.start()  # replaces workers that died
+    others = [job["id"] for job in browser_jobs() if job["id"] != job_id]
+    st.query_params["job"] = others[-(MAX_BROWSER_JOBS - 1):] + [job_id]
+
+def forget_job(job_id):
+    job_store.cancel(job_id, session=session_id())
+    release_buffers(f"job_{job_id}")
+    st.query_params["job"] = [i for i in st.query_params.get_all("job") if i != job_id]
+
+def job_reader(job):
+    """
+    Deferred download_button data. The job's file is opened as a disk-backed buffer
+    held by the buffer manager like every other download; collecting it marks the job collected.
+    Streamlit serves the file from memory, so each click copies it whole (see `save_button`).
+    """
+    # The session id is taken now: the callable runs outside the script thread
+    load = lambda: SpooledBuffer.from_file(job_store.collect(job["id"]), owned=False)
+    return buffer_manager.reader(session_id(), f"job_{job['id']}", load=load)
+
+def save_button(job, label, key=None):
+    """The Save button for a finished job, or why its file is too large to save from the browser."""
+    if not buffer_manager.can_save(job["size"] or 0):
+        mb = 1024 * 1024
+        st.warning(
+            f"{job['file_name']} is {job['size'] / mb:,.0f} MB, more than the {buffer_manager.max_save_bytes / mb:,.0f} MB "
+            "a browser download may hold in memory (YTD_MAX_SAVE_BYTES). "
+            "Use a direct link or the command-line downloader for files this large."
+        )
+        return
+    st.download_button(label=label, data=job_reader(job), file_name=job["file_name"], mime=job["mime"], key=key)
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def job_progress(job_id):
+    """Polls a queued or running job; reruns the page once it has finished."""
+    job = job_store.get(job_id)
+    if job is None or job["status"] not in ACTIVE_STATUSES:
+        st.rerun()
+    if job["status"] == "queued":
+        st.progress(0, text="Waiting for a free download slot...")
+    else:
+        st.progress(job["percent"], text=job["message"] or "Downloading...")
+
+def show_job(job):
+    """
+    Progress while a job runs, or why it failed.
+    :return: True once its file is ready
+    """
+    rendered_jobs.add(job["id"])
+    if job["status"] in ACTIVE_STATUSES:
+        job_progress(job["id"])
+    elif job["status"] == FAILED:
+        st.error(f"❌ Download failed: {job['error']}")
+    return job["status"] in READY_STATUSES
+
+def slot_job(slot, url):
+    """
+    Shows the newest job for `slot` and the video at `url` where its button is.
+    :return: The job once its file is ready, else None
+    """
+    video_id = video_id_from_url(url) or url
+    job = next((j for j in reversed(browser_jobs())
+                if j["slot"] == slot and (video_id_from_url(j["url"]) or j["url"]) == video_id), None)
+    if job is not None and show_job(job):
+        return job
+    return None
+
+def jobs_sidebar():
+    """Jobs that are not shown next to their button, e.g. after a reload or for another URL."""
+    jobs = [job for job in browser_jobs() if job["id"] not in rendered_jobs]
+    if not jobs:
+        return
+    with st.sidebar:
+        st.subheader("📥 Downloads")
+        for job in jobs:
+            st.caption(job["file_name"])
+            if show_job(job):
+                save_button(job, "💾 Save", key=f"job_save_{job['id']}")
+            if st.button("✖ Remove", key=f"job_forget_{job['id']}"):
+                forget_job(job["id"])
+                st.rerun()
+
+def audio_output_options(key):
+    """Output format and bitrate pickers for audio downloads."""
+    formats = list(AUDIO_FORMATS)
+    audio_format = st.selectbox("Save audio as", formats, index=formats.index(DEFAULT_AUDIO_FORMAT), key=f"{key}_format")
+    bitrate = st.selectbox(
+        "Bitrate", AUDIO_BITRATES, index=AUDIO_BITRATES.index(DEFAULT_BITRATE), key=f"{key}_bitrate",
+        # m4a is saved as downloaded and FLAC is lossless
+        disabled=not needs_transcode(audio_format) or audio_format == "flac"
+    )
+    return audio_format, bitrate
+
 # --- Helper function to reset state on new URL ---
 def reset_state_on_new_url(new_url):
-    if new_url != st.session_state.current_url:
+    # Every tab calls this; an empty URL in another tab must not release this tab's downloads
+    if new_url and new_url != st.session_state.current_url:
+        # Free memory / temp files held by the previous URL's downloads
+        release_buffers()
         st.session_state.downloader = None
-        st.session_state.video_buffer = None
-        st.session_state.audio_buffer = None
-        st.session_state.playlist_buffers = {}
+        st.session_state.playlist_links = None
         st.session_state.current_url = new_url
 
+# --- One playlist entry; a fragment, so its buttons and progress redraw only this entry ---
+@st.fragment
+def playlist_entry(pl, index, quality, download_type, audio_format, bitrate, links):
+    idx = index + 1
+    try:
+        yt = pl.video(index)
+    except Exception as e:
+        st.error(f"❌ {idx}. Failed to load video: {e}")
+        return
+    video_id = yt.video_id
+    
+    with st.expander(f"**{idx}. {yt.title}** ({time.strftime('%M:%S', time.gmtime(yt.length))})"):
+        
+        c1, c2 = st.columns([1, 2])
+        with c1:
+            st.image(thumbnail(video_thumbnail_url(video_id), wait=0), width='stretch')
+        with c2:
+            st.caption(f"by {yt.author} | {yt.views:,} views")
+            
+            # --- Button 1: Get IDM Link ---
+            if st.button("🔗 Get IDM Link", key=f"idm_btn_{video_id}"):
+                entry = links.get(yt.watch_url) if links else None
+                if entry:
+                    # Already resolved by the whole-playlist batch
+                    st.success("✅ Link generated! Copy this into your download manager.")
+                    st.code(entry["link"])
+                else:
+                    with st.spinner(f"Getting link for: {yt.title}..."):
+                        try:
+                            # Create a new downloader just for this video
+                            video_downloader = resolve(yt.watch_url)
+                            link, error = video_downloader.get_direct_link(
+                                quality=quality, 
+                                only_audio=(download_type == "Audio")
+                            )
+                            if link:
+                                st.success("✅ Link generated! Copy this into your download manager.")
+                                st.code(link)
+                            else:
+                                st.error(f"❌ Could not get link: {error}")
+                        except Exception as e:
+                            st.error(f"❌ Error: {e}")
+
+            # --- Button 2: Manual Download ---
+            file_ext = AUDIO_FORMATS[audio_format]["ext"] if download_type == "Audio" else ".mp4"
+            mime_type = AUDIO_FORMATS[audio_format]["mime"] if download_type == "Audio" else "video/mp4"
+            file_name = safe_filename(f"{yt.title}{file_ext}")
+            
+            if st.button("⬇️ Manual Download", key=f"dl_btn_{video_id}"):
+                # Queued as a background job; the worker resolves the video itself
+                if download_type == "Audio":
+                    submit_job(f"playlist:{video_id}", yt.watch_url, quality, file_name=file_name, mime=mime_type,
+                               audio=True, audio_format=audio_format, bitrate=bitrate)
+                else:
+                    submit_job(f"playlist:{video_id}", yt.watch_url, quality, file_name=file_name, mime=mime_type)
+
+            # --- Progress, then the actual download button once the file is ready ---
+            job = slot_job(f"playlist:{video_id}", yt.watch_url)
+            if job:
+                save_button(job, f"💾 Save {job['file_name']}", key=f"save_btn_{video_id}")
+
+
 # --- UI Tabs ---
 tab1, tab2, tab3 = st.tabs(["🎬 Single Video", "📂 Playlist", "🎵 Audio Only"])
 
@@ -46,7 +286,7 @@ with tab1:
         if not st.session_state.downloader:
             with st.spinner("Loading video info..."):
                 try:
-                    st.session_state.downloader = YoutubeDownloader(url)
+                    st.session_state.downloader = resolve(url)
                 except Exception as e:
                     st.error(f"❌ Failed to load video. Check URL or try again. Error: {e}")
                     st.session_state.downloader = None
@@ -57,7 +297,7 @@ with tab1:
             
             col1, col2 = st.columns([1, 2])
             with col1:
-                st.image(yt.thumbnail_url, width='stretch')
+                st.image(thumbnail(yt.thumbnail_url), width='stretch')
             with col2:
                 st.subheader(yt.title)
                 st.caption(f"by {yt.author} | {yt.views:,} views | Length: {time.strftime('%H:%M:%S', time.gmtime(yt.length))}")
@@ -71,30 +311,32 @@ with tab1:
             else:
                 quality = st.selectbox("Select Video Quality", video_qualities, key="video_quality_select")
                 
-                # --- Download Buttons ---
+                # --- Download Buttons: the download runs as a background job ---
                 if st.button("⬇️ Download Video", key="video_download_button"):
-                    st.session_state.video_buffer = None # Clear old buffer
-                    progress_bar = st.progress(0, text="Starting download...")
-                    with st.spinner("Downloading..."):
+                    submit_job("video", url, quality, file_name=safe_filename(f"{yt.title}_{quality}.mp4"), mime="video/mp4")
+
+                # --- Progress, then the Save Button once the file is ready ---
+                job = slot_job("video", url)
+                if job:
+                    save_button(job, "💾 Save Video File")
+
+                # --- Clip: only the fragments covering the range are downloaded ---
+                with st.expander("✂️ Download a Clip"):
+                    clip_col1, clip_col2 = st.columns(2)
+                    clip_start = clip_col1.text_input("Start", value="0:00", key="clip_start")
+                    clip_end = clip_col2.text_input("End", value=format_timestamp(min(yt.length or 60, 60)), key="clip_end")
+                    if st.button("✂️ Download Clip", key="clip_download_button"):
                         try:
-                            buffer = st.session_state.downloader.Download(
-                                quality=quality, 
-                                st_progress_bar=progress_bar
-                            )
-                            st.session_state.video_buffer = buffer
-                        except Exception as e:
-                            st.error(f"❌ Download failed: {e}")
-                            progress_bar.empty()
-
-                # --- Show Save Button if buffer is ready ---
-                if st.session_state.video_buffer:
-                    file_name = safe_filename(f"{yt.title}_{quality}.mp4")
-                    st.download_button(
-                        label="💾 Save Video File",
-                        data=st.session_state.video_buffer,
-                        file_name=file_name,
-                        mime="video/mp4"
-                    )
+                            clip = (parse_timestamp(clip_start), parse_timestamp(clip_end))
+                        except ValueError as e:
+                            st.error(f"❌ {e}. Use seconds or H:MM:SS.")
+                            clip = None
+                        if clip:
+                            clip_name = safe_filename(f"{yt.title}_{quality}_{clip_start}-{clip_end}.mp4".replace(":", "."))
+                            submit_job("clip", url, quality, file_name=clip_name, mime="video/mp4", clip=clip)
+                    job = slot_job("clip", url)
+                    if job:
+                        save_button(job, "💾 Save Clip")
 
                 # --- Direct Link (IDM) Expander ---
                 with st.expander("🔗 Get Direct Link (for IDM, etc.)"):
@@ -120,7 +362,7 @@ with tab2:
         if not st.session_state.downloader:
             with st.spinner("Loading playlist info... This may take a moment."):
                 try:
-                    st.session_state.downloader = YoutubeDownloader(pl_url)
+                    st.session_state.downloader = resolve(pl_url)
                 except Exception as e:
                     st.error(f"❌ Failed to load playlist. Check URL or try again. Error: {e}")
                     st.session_state.downloader = None
@@ -131,9 +373,11 @@ with tab2:
             yt_info = st.session_state.downloader.yt # Get info from first video
             
             st.subheader(pl.title)
-            st.caption(f"by {yt_info.author} | {len(pl.videos)} videos")
+            count_text = f"{pl.known_count}" if pl.is_complete else f"{pl.known_count}+"
+            st.caption(f"by {yt_info.author} | {count_text} videos")
             st.divider()
 
+            audio_format, bitrate = "m4a", DEFAULT_BITRATE
             col1, col2 = st.columns(2)
             with col1:
                 download_type = st.radio("Download as:", ("Video", "Audio"), horizontal=True, key="playlist_type_radio")
@@ -147,89 +391,94 @@ with tab2:
                 else:
                     audio_qualities = st.session_state.downloader.get_audio_qualities()
                     quality = st.selectbox("Select Audio Quality", audio_qualities, key="playlist_quality_select_aud")
+                    audio_format, bitrate = audio_output_options("playlist_audio")
             
             st.divider()
-            st.write(f"**Found {len(pl.videos)} videos:**")
 
-            # --- Iterate through all videos and create an expander for each ---
-            for idx, yt in enumerate(pl.videos, 1):
-                video_id = yt.video_id
-                
-                with st.expander(f"**{idx}. {yt.title}** ({time.strftime('%M:%S', time.gmtime(yt.length))})"):
-                    
-                    c1, c2 = st.columns([1, 2])
-                    with c1:
-                        st.image(yt.thumbnail_url, width='stretch')
-                    with c2:
-                        st.caption(f"by {yt.author} | {yt.views:,} views")
-                        
-                        # --- Button 1: Get IDM Link ---
-                        if st.button("🔗 Get IDM Link", key=f"idm_btn_{video_id}"):
-                            with st.spinner(f"Getting link for: {yt.title}..."):
-                                try:
-                                    # Create a new downloader just for this video
-                                    video_downloader = YoutubeDownloader(yt.watch_url)
-                                    link, error = video_downloader.get_direct_link(
-                                        quality=quality, 
-                                        only_audio=(download_type == "Audio")
-                                    )
-                                    if link:
-                                        st.success("✅ Link generated! Copy this into your download manager.")
-                                        st.code(link)
-                                    else:
-                                        st.error(f"❌ Could not get link: {error}")
-                                except Exception as e:
-                                    st.error(f"❌ Error: {e}")
-
-                        # --- Button 2: Manual Download ---
-                        file_ext = ".mp3" if download_type == "Audio" else ".mp4"
-                        mime_type = "audio/mpeg" if download_type == "Audio" else "video/mp4"
-                        file_name = safe_filename(f"{yt.title}{file_ext}")
-                        
-                        if st.button("⬇️ Manual Download", key=f"dl_btn_{video_id}"):
-                            # Clear buffer for this specific video
-                            st.session_state.playlist_buffers[video_id] = None 
-                            
-                            progress_placeholder = st.empty() # Placeholder for this video's progress bar
-                            progress_bar = progress_placeholder.progress(0, text="Starting download...")
-                            
-                            with st.spinner(f"Downloading: {yt.title}..."):
-                                try:
-                                    # Create downloader just-in-time
-                                    video_downloader = YoutubeDownloader(yt.watch_url)
-                                    
-                                    if download_type == "Audio":
-                                        buffer = video_downloader.DownloadAudio(
-                                            quality=quality,
-                                            st_progress_bar=progress_bar
-                                        )
-                                    else:
-                                        buffer = video_downloader.Download(
-                                            quality=quality, 
-                                            st_progress_bar=progress_bar
-                                        )
-                                    
-                                    if buffer:
-                                        # Save buffer to our dictionary with video_id as key
-                                        st.session_state.playlist_buffers[video_id] = buffer
-                                        progress_placeholder.empty() # Clear progress bar
-                                    else:
-                                        st.error("Download failed, buffer is empty.")
-                                        progress_placeholder.empty()
-                                        
-                                except Exception as e:
-                                    st.error(f"❌ Download failed: {e}")
-                                    progress_placeholder.empty()
-
-                        # --- Show the actual download button if the buffer exists ---
-                        if st.session_state.playlist_buffers.get(video_id):
-                            st.download_button(
-                                label=f"💾 Save {file_name}",
-                                data=st.session_state.playlist_buffers[video_id],
-                                file_name=file_name,
-                                mime=mime_type,
-                                key=f"save_btn_{video_id}"
-                            )
+            # --- Whole playlist as a single ZIP ---
+            with st.expander("📦 Download whole playlist (ZIP)"):
+                workers = st.number_input("Parallel downloads", min_value=1, max_value=8, value=DEFAULT_WORKERS, key="playlist_zip_workers")
+                if st.button("⬇️ Download All", key="playlist_zip_button"):
+                    # Queued as a background job; the worker lists and downloads the playlist itself
+                    zip_options = dict(audio=True, audio_format=audio_format, bitrate=bitrate) if download_type == "Audio" else {}
+                    submit_job("playlist_zip", pl_url, quality, file_name=safe_filename(f"{pl.title}.zip"),
+                               mime="application/zip", kind=PLAYLIST_ZIP, workers=int(workers), **zip_options)
+
+                # --- Progress, then the per-video report and the Save button once the ZIP is ready ---
+                job = slot_job("playlist_zip", pl_url)
+                if job:
+                    report = job["report"] or []
+                    failed = [r for r in report if not r["ok"]]
+                    if failed:
+                        st.warning(f"{len(failed)} of {len(report)} videos failed:")
+                        for r in failed:
+                            st.caption(f"{r['index']}. {r['title'] or r['url']} — {r['error']}")
+                    save_button(job, "💾 Save Playlist ZIP", key="playlist_zip_save")
+
+            # --- Direct links for the whole playlist, for download managers ---
+            only_audio = download_type == "Audio"
+            links = st.session_state.playlist_links
+            if links is not None and not links.matches(quality, only_audio):
+                links = st.session_state.playlist_links = None
+            with st.expander("🔗 Direct links for the whole playlist (IDM, aria2)"):
+                link_workers = st.number_input("Parallel lookups", min_value=1, max_value=16, value=DEFAULT_LINK_WORKERS, key="playlist_links_workers")
+                label = "🔄 Refresh expired links" if links else "🔗 Get All Links"
+                if st.button(label, key="playlist_links_button"):
+                    if links is None:
+                        with st.spinner("Listing playlist videos..."):
+                            links = st.session_state.playlist_links = LinkBatch(pl.load_all(), quality, only_audio)
+                    links.workers = int(link_workers)
+                    links_progress = st.progress(0, text="Resolving links...")
+
+                    def _on_link_done(done, total, entry):
+                        status = "✅" if entry["link"] else "❌"
+                        links_progress.progress(int(done / total * 100), text=f"Resolving {done}/{total}... {status} {entry['title'] or entry['url']}")
+
+                    resolved = links.resolve(on_item_done=_on_link_done)
+                    links_progress.progress(100, text=f"Resolved {resolved} links ✅" if resolved else "All links are still valid ✅")
+
+                if links:
+                    ready = links.ready
+                    st.write(f"**{len(ready)} of {len(links)} links ready.**")
+                    if links.expires_at:
+                        st.caption(f"First link expires at {time.strftime('%H:%M', time.localtime(links.expires_at))}; refresh to renew only the expired ones.")
+                    if not only_audio and any(not e["has_audio"] for e in ready):
+                        st.caption("Some videos are only available at this quality without audio.")
+                    for entry in links.failed:
+                        st.caption(f"❌ {entry['index']}. {entry['title'] or entry['url']} — {entry['error']}")
+                    if ready:
+                        c1, c2 = st.columns(2)
+                        for column, fmt, label in ((c1, "urls", "💾 URL list"), (c2, "aria2", "💾 aria2 input file")):
+                            with column:
+                                st.download_button(
+                                    label=label,
+                                    data=EXPORT_FORMATS[fmt]["render"](links),
+                                    file_name=safe_filename(f"{pl.title}{EXPORT_FORMATS[fmt]['ext']}"),
+                                    mime="text/plain",
+                                    key=f"playlist_links_{fmt}"
+                                )
+
+            # --- Pagination: only the visible page is enumerated and resolved ---
+            page_number = st.number_input("Page", min_value=1, value=1, step=1, key="playlist_page_input")
+            page = pl.page(page_number - 1)
+            if not page:
+                st.info("No more videos in this playlist.")
+            else:
+                pl.prefetch(page)
+                # Warm the next page in the background while this one renders
+                pl.prefetch(pl.page(page_number))
+                # Thumbnails only need the video id, so they load alongside the metadata
+                video_ids = [video_id_from_url(pl.video_url(i) or "") for i in (*page, *pl.page(page_number))]
+                thumbnail_urls = [video_thumbnail_url(v) for v in video_ids if v]
+                thumbnail_cache.prefetch(thumbnail_urls)
+                # One short wait for the whole page, instead of one per entry
+                thumbnail_cache.get_many(thumbnail_urls[:len(page)], timeout=THUMBNAIL_WAIT)
+                more = "" if pl.is_complete else "+"
+                st.write(f"**Showing videos {page.start + 1}-{page.stop} of {pl.known_count}{more}:**")
+
+            # --- Entries appear one by one as their metadata resolves ---
+            for index in page:
+                playlist_entry(pl, index, quality, download_type, audio_format, bitrate, links)
 
 
 # ------------------------------------------
@@ -245,7 +494,7 @@ with tab3:
         if not st.session_state.downloader:
             with st.spinner("Loading audio info..."):
                 try:
-                    st.session_state.downloader = YoutubeDownloader(audio_url)
+                    st.session_state.downloader = resolve(audio_url)
                 except Exception as e:
                     st.error(f"❌ Failed to load video. Check URL or try again. Error: {e}")
                     st.session_state.downloader = None
@@ -256,7 +505,7 @@ with tab3:
             
             col1, col2 = st.columns([1, 2])
             with col1:
-                st.image(yt.thumbnail_url, width='stretch')
+                st.image(thumbnail(yt.thumbnail_url), width='stretch')
             with col2:
                 st.subheader(yt.title)
                 st.caption(f"by {yt.author} | {yt.views:,} views")
@@ -269,31 +518,18 @@ with tab3:
                 st.warning("No audio streams found.")
             else:
                 audio_quality = st.selectbox("Select Audio Quality", audio_qualities, key="audio_quality_select")
+                audio_format, bitrate = audio_output_options("audio_tab")
+                audio_spec = AUDIO_FORMATS[audio_format]
                 
-                # --- Download Buttons ---
+                # --- Download Buttons: the download runs as a background job ---
                 if st.button("⬇️ Download Audio", key="audio_download_button"):
-                    st.session_state.audio_buffer = None # Clear old buffer
-                    progress_bar = st.progress(0, text="Starting download...")
-                    with st.spinner("Downloading..."):
-                        try:
-                            buffer = st.session_state.downloader.DownloadAudio(
-                                quality=audio_quality, 
-                                st_progress_bar=progress_bar
-                            )
-                            st.session_state.audio_buffer = buffer
-                        except Exception as e:
-                            st.error(f"❌ Download failed: {e}")
-                            progress_bar.empty()
-
-                # --- Show Save Button if buffer is ready ---
-                if st.session_state.audio_buffer:
-                    file_name = safe_filename(f"{yt.title}.mp3")
-                    st.download_button(
-                        label="💾 Save Audio File (.mp3)",
-                        data=st.session_state.audio_buffer,
-                        file_name=file_name,
-                        mime="audio/mpeg"
-                    )
+                    submit_job("audio", audio_url, audio_quality, file_name=safe_filename(f"{yt.title}{audio_spec['ext']}"),
+                               mime=audio_spec["mime"], audio=True, audio_format=audio_format, bitrate=bitrate)
+
+                # --- Progress, then the Save Button once the file is ready ---
+                job = slot_job("audio", audio_url)
+                if job:
+                    save_button(job, f"💾 Save Audio File ({os.path.splitext(job['file_name'])[1]})")
 
                 # --- Direct Link (IDM) Expander ---
                 with st.expander("🔗 Get Direct Link (for IDM, etc.)"):
@@ -304,4 +540,8 @@ with tab3:
                                 st.success("✅ Link generated! Copy this into your download manager.")
                                 st.code(link)
                             else:
-                                st.error(f"❌ Could not get link: {error}")
\ No newline at end of file
+                                st.error(f"❌ Could not get link: {error}")
+
+# --- Jobs not shown above, and the shared buffer budget, after this run's downloads ---
+jobs_sidebar()
+buffer_usage_caption()